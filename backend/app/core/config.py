@@ -16,18 +16,118 @@ class Settings(BaseModel):
     REDIS_PORT: int = int(os.getenv("REDIS_PORT", "6379"))
     REDIS_DB: int = int(os.getenv("REDIS_DB", "0"))
     REDIS_PASSWORD: str = os.getenv("REDIS_PASSWORD", "")
+    REDIS_MAX_CONNECTIONS: int = int(os.getenv("REDIS_MAX_CONNECTIONS", "50"))  # 异步连接池上限
+    # 会话队列后端：redis支持生成端和分发端分布在多个进程，memory为单进程部署的进程内有界队列，不经过序列化和网络往返
+    QUEUE_BACKEND: str = os.getenv("QUEUE_BACKEND", "redis")
+    MEMORY_QUEUE_SIZE: int = int(os.getenv("MEMORY_QUEUE_SIZE", "1000"))  # 进程内每个会话队列的上限，超出时丢弃最早的消息
+    # 会话队列存储方式：list为LPUSH/RPOP轮询，stream为XADD/XREAD BLOCK，所有空闲会话共用一个阻塞读取
+    QUEUE_TRANSPORT: str = os.getenv("QUEUE_TRANSPORT", "list")
+    STREAM_MAXLEN: int = int(os.getenv("STREAM_MAXLEN", "1000"))  # 每个会话流的近似最大长度
+    STREAM_READ_COUNT: int = int(os.getenv("STREAM_READ_COUNT", "20"))  # 每次从一个会话流读取的最大条数
+    STREAM_BLOCK_MS: int = int(os.getenv("STREAM_BLOCK_MS", "5000"))  # XREAD BLOCK的超时时间
+    # 会话键（messages:*、tokens:*）的滑动过期时间，0表示不过期；清理任务定期SCAN回收没有过期时间的遗留键
+    # （为0时只有开启SESSION_ROUTING=redis才回收，并跳过仍持有连接租约的会话）
+    SESSION_KEY_TTL: int = int(os.getenv("SESSION_KEY_TTL", "600"))
+    SESSION_SWEEP_INTERVAL: int = int(os.getenv("SESSION_SWEEP_INTERVAL", "300"))
+    # 会话路由：local为连接和生成器在同一进程；redis为多节点部署，生成任务由任意节点认领，经Redis队列交付给持有连接的节点
+    SESSION_ROUTING: str = os.getenv("SESSION_ROUTING", "local")
+    SESSION_LEASE_SECONDS: int = int(os.getenv("SESSION_LEASE_SECONDS", "15"))  # 连接/生成租约时长，心跳间隔为其三分之一
+    NODE_GENERATOR_CAPACITY: int = int(os.getenv("NODE_GENERATOR_CAPACITY", "200"))  # 每个节点最多认领的生成任务数
     
     # DeepSeek API配置
     DEEPSEEK_BASE_URL: str = os.getenv("DEEPSEEK_BASE_URL", "https://api.deepseek.com")
     DEEPSEEK_API_KEY: str = os.getenv("DEEPSEEK_API_KEY", "")
     
     # WebSocket配置
-    WS_PING_INTERVAL: int = int(os.getenv("WS_PING_INTERVAL", "30"))
+    WS_PING_INTERVAL: int = int(os.getenv("WS_PING_INTERVAL", "30"))  # 服务端发送ping的间隔，0为关闭心跳
+    WS_PONG_TIMEOUT: int = int(os.getenv("WS_PONG_TIMEOUT", "10"))  # 超过WS_PING_INTERVAL+WS_PONG_TIMEOUT秒未收到客户端消息时断开
+    # 准入控制：本进程同时生成的会话数上限，0表示不限制（此时启动日志给出按下式估算的单进程上限）。按上游预算估算时，单个独立会话每秒约消耗
+    # MESSAGES_PER_SECOND/1.5/GENERATION_BATCH_SIZE次请求，上限约为 DEEPSEEK_RATE_LIMIT / 该值 / 进程数
+    # （RATE_LIMIT_BACKEND=redis时令牌桶为集群共享，还需除以节点数）；开启合并生成或消息缓存时多个会话共用请求，可相应放大；
+    # 达到上限时新连接最多ADMISSION_QUEUE_SIZE个排队等待ADMISSION_WAIT_SECONDS秒，其余拒绝并建议ADMISSION_RETRY_AFTER秒后重试
+    MAX_ACTIVE_SESSIONS: int = int(os.getenv("MAX_ACTIVE_SESSIONS", "0"))
+    ADMISSION_QUEUE_SIZE: int = int(os.getenv("ADMISSION_QUEUE_SIZE", "20"))
+    ADMISSION_WAIT_SECONDS: int = int(os.getenv("ADMISSION_WAIT_SECONDS", "30"))
+    ADMISSION_RETRY_AFTER: int = int(os.getenv("ADMISSION_RETRY_AFTER", "10"))
     
     # 应用配置
     THREAD_COUNT: int = int(os.getenv("THREAD_COUNT", "10"))
     MESSAGES_PER_SECOND: int = int(os.getenv("MESSAGES_PER_SECOND", "10"))
-    
+    # 批量下发（客户端连接时以batch=true开启）：每个时间窗口把已就绪的消息合并为一帧，每帧最多WS_BATCH_MAX_SIZE条
+    WS_BATCH_WINDOW_MS: int = int(os.getenv("WS_BATCH_WINDOW_MS", "500"))
+    WS_BATCH_MAX_SIZE: int = int(os.getenv("WS_BATCH_MAX_SIZE", "5"))
+    # 断线重连：连接断开后会话和生成器保留WS_RESUME_GRACE_SECONDS秒（0表示立即结束），客户端带session_id和last_seq重连后补发错过的消息
+    WS_RESUME_GRACE_SECONDS: int = int(os.getenv("WS_RESUME_GRACE_SECONDS", "30"))
+    WS_REPLAY_BUFFER_SIZE: int = int(os.getenv("WS_REPLAY_BUFFER_SIZE", "100"))  # 每个会话保留的最近已下发消息条数
+    # 慢客户端：连接待发送的消息达到WS_OUTBOX_SIZE条时按策略处理——drop_oldest丢弃最早的消息，
+    # coalesce暂停从队列取消息直到积压发完（批量模式的客户端每帧合并最多WS_BATCH_MAX_SIZE条，普通客户端逐条发送），
+    # disconnect断开连接；单帧发送超过WS_SEND_TIMEOUT秒时断开连接
+    WS_OUTBOX_SIZE: int = int(os.getenv("WS_OUTBOX_SIZE", "50"))
+    WS_SLOW_CLIENT_POLICY: str = os.getenv("WS_SLOW_CLIENT_POLICY", "coalesce")
+    WS_SEND_TIMEOUT: float = float(os.getenv("WS_SEND_TIMEOUT", "10"))
+
+    # 生成引擎配置
+    # thread: 每个会话独立的线程池（默认）；async: 所有会话共享一个事件循环调度器
+    GENERATION_ENGINE: str = os.getenv("GENERATION_ENGINE", "thread")
+    WORKERS_PER_SESSION: int = int(os.getenv("WORKERS_PER_SESSION", "12"))
+    # async引擎共享的HTTP连接池配置
+    DEEPSEEK_HTTP2: bool = os.getenv("DEEPSEEK_HTTP2", "true").lower() == "true"
+    HTTP_MAX_CONNECTIONS: int = int(os.getenv("HTTP_MAX_CONNECTIONS", "100"))
+    HTTP_MAX_KEEPALIVE: int = int(os.getenv("HTTP_MAX_KEEPALIVE", "20"))
+    HTTP_KEEPALIVE_EXPIRY: float = float(os.getenv("HTTP_KEEPALIVE_EXPIRY", "30"))
+
+    # DeepSeek全局请求预算
+    # 令牌桶：每秒请求数(0为不限速)与突发容量；RATE_LIMIT_BACKEND为redis时集群共享令牌桶
+    DEEPSEEK_RATE_LIMIT: float = float(os.getenv("DEEPSEEK_RATE_LIMIT", "20"))
+    DEEPSEEK_BURST: int = int(os.getenv("DEEPSEEK_BURST", "40"))
+    RATE_LIMIT_BACKEND: str = os.getenv("RATE_LIMIT_BACKEND", "local")
+    # AIMD并发窗口：成功时加性增长，429/5xx或延迟突增时乘性减小
+    DEEPSEEK_MIN_CONCURRENCY: int = int(os.getenv("DEEPSEEK_MIN_CONCURRENCY", "2"))
+    DEEPSEEK_MAX_CONCURRENCY: int = int(os.getenv("DEEPSEEK_MAX_CONCURRENCY", "64"))
+    DEEPSEEK_INITIAL_CONCURRENCY: int = int(os.getenv("DEEPSEEK_INITIAL_CONCURRENCY", "16"))
+    AIMD_INCREASE: float = float(os.getenv("AIMD_INCREASE", "1"))
+    AIMD_DECREASE: float = float(os.getenv("AIMD_DECREASE", "0.5"))
+    LATENCY_SPIKE_SECONDS: float = float(os.getenv("LATENCY_SPIKE_SECONDS", "10"))
+
+    # 批量生成：每次API请求生成的消息条数，1为每次生成一句
+    GENERATION_BATCH_SIZE: int = int(os.getenv("GENERATION_BATCH_SIZE", "1"))
+    # 流式补全：逐行解析SSE增量，每完成一行立即入队
+    DEEPSEEK_STREAM: bool = os.getenv("DEEPSEEK_STREAM", "false").lower() == "true"
+
+    # 共享消息缓存：按(情绪类型, 字数)缓存已生成的消息，会话优先从缓存取用
+    MESSAGE_CACHE_ENABLED: bool = os.getenv("MESSAGE_CACHE_ENABLED", "false").lower() == "true"
+    MESSAGE_CACHE_BACKEND: str = os.getenv("MESSAGE_CACHE_BACKEND", "local")  # local 或 redis
+    MESSAGE_CACHE_SIZE: int = int(os.getenv("MESSAGE_CACHE_SIZE", "5000"))
+    MESSAGE_CACHE_TTL: int = int(os.getenv("MESSAGE_CACHE_TTL", "600"))
+    MESSAGE_CACHE_MAX_SERVES: int = int(os.getenv("MESSAGE_CACHE_MAX_SERVES", "20"))
+    MESSAGE_CACHE_REDIS_BUCKET_SIZE: int = int(os.getenv("MESSAGE_CACHE_REDIS_BUCKET_SIZE", "200"))
+
+    # 会话队列水位：达到高水位暂停生成，分发端消费到低水位以下时恢复
+    QUEUE_HIGH_WATERMARK: int = int(os.getenv("QUEUE_HIGH_WATERMARK", "50"))
+    QUEUE_LOW_WATERMARK: int = int(os.getenv("QUEUE_LOW_WATERMARK", "10"))
+
+    # 合并生成：参数相同的会话订阅同一个共享生成器，生成结果扇出给所有订阅者
+    GENERATION_COALESCE: bool = os.getenv("GENERATION_COALESCE", "false").lower() == "true"
+    COALESCE_LOG_SIZE: int = int(os.getenv("COALESCE_LOG_SIZE", "200"))
+
+    # 预设语句文件（每行一句），为空时使用app/data/fallback_phrases.txt；开启mmap时不把整个文件读入内存
+    FALLBACK_CORPUS_PATH: str = os.getenv("FALLBACK_CORPUS_PATH", "")
+    FALLBACK_CORPUS_MMAP: bool = os.getenv("FALLBACK_CORPUS_MMAP", "false").lower() == "true"
+
+    # 字数调节：按字数范围统计输出被过滤的比例，接受率低于目标时自动调整max_tokens、温度和提示词
+    LENGTH_TUNING_ENABLED: bool = os.getenv("LENGTH_TUNING_ENABLED", "true").lower() == "true"
+    LENGTH_ACCEPT_TARGET: float = float(os.getenv("LENGTH_ACCEPT_TARGET", "0.8"))
+    LENGTH_TUNING_WINDOW: int = int(os.getenv("LENGTH_TUNING_WINDOW", "20"))
+
+    # DeepSeek熔断器：连续失败达到阈值时打开，打开时间按次数指数增长，到期后半开放行探测请求
+    BREAKER_FAILURE_THRESHOLD: int = int(os.getenv("BREAKER_FAILURE_THRESHOLD", "5"))
+    BREAKER_OPEN_SECONDS: float = float(os.getenv("BREAKER_OPEN_SECONDS", "5"))
+    BREAKER_MAX_OPEN_SECONDS: float = float(os.getenv("BREAKER_MAX_OPEN_SECONDS", "120"))
+    BREAKER_HALF_OPEN_PROBES: int = int(os.getenv("BREAKER_HALF_OPEN_PROBES", "1"))
+    # 请求失败后的重试退避：从RETRY_BACKOFF_BASE秒开始指数增长，带随机抖动
+    RETRY_BACKOFF_BASE: float = float(os.getenv("RETRY_BACKOFF_BASE", "1"))
+    RETRY_BACKOFF_MAX: float = float(os.getenv("RETRY_BACKOFF_MAX", "30"))
+
     # 预设的夸夸语句（当DeepSeek API未配置时使用）
     DEFAULT_MESSAGES: list = [
         "你真是太棒了！",
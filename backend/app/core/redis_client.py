@@ -1,6 +1,40 @@
 import redis
+import redis.asyncio
 from app.core.config import settings
 
+# 原子地增加token计数并把一批消息推入会话列表，同时刷新两个键的过期时间，返回入队后的队列长度
+# KEYS[1]为队列，KEYS[2]为计数器（可省略）；ARGV[1]为token数，ARGV[2]为过期秒数（0表示不过期），其余为消息
+LIST_ENQUEUE_SCRIPT = """
+if KEYS[2] and tonumber(ARGV[1]) ~= 0 then
+    redis.call('INCRBY', KEYS[2], ARGV[1])
+end
+for i = 3, #ARGV do
+    redis.call('LPUSH', KEYS[1], ARGV[i])
+end
+if tonumber(ARGV[2]) > 0 then
+    for _, key in ipairs(KEYS) do
+        redis.call('EXPIRE', key, ARGV[2])
+    end
+end
+return redis.call('LLEN', KEYS[1])
+"""
+
+# 流模式下的同一操作，ARGV[3]为流的近似最大长度，其余为消息
+STREAM_ENQUEUE_SCRIPT = """
+if KEYS[2] and tonumber(ARGV[1]) ~= 0 then
+    redis.call('INCRBY', KEYS[2], ARGV[1])
+end
+for i = 4, #ARGV do
+    redis.call('XADD', KEYS[1], 'MAXLEN', '~', ARGV[3], '*', 'm', ARGV[i])
+end
+if tonumber(ARGV[2]) > 0 then
+    for _, key in ipairs(KEYS) do
+        redis.call('EXPIRE', key, ARGV[2])
+    end
+end
+return redis.call('XLEN', KEYS[1])
+"""
+
 class RedisClient:
     """Redis客户端类，用于管理Redis连接和操作"""
     
@@ -13,6 +47,32 @@ class RedisClient:
             password=settings.REDIS_PASSWORD,
             decode_responses=True  # 自动将字节解码为字符串
         )
+        # 供事件循环使用的异步连接，所有WebSocket分发任务共享同一个连接池
+        self.async_connection = self._create_async_connection(decode_responses=True)
+        # 读取会话队列的异步连接，消息是二进制帧，不做UTF-8解码
+        self.async_queue_connection = self._create_async_connection(decode_responses=False)
+        # 会话队列的存储方式: list（LPUSH/RPOP）或 stream（XADD/XREAD）
+        self.queue_transport = settings.QUEUE_TRANSPORT
+        self.stream_maxlen = settings.STREAM_MAXLEN
+        # 会话键的滑动过期时间，每次入队、出队时刷新
+        self.session_ttl = max(0, settings.SESSION_KEY_TTL)
+        if self.queue_transport == "stream":
+            self._enqueue_script = self.connection.register_script(STREAM_ENQUEUE_SCRIPT)
+        else:
+            self._enqueue_script = self.connection.register_script(LIST_ENQUEUE_SCRIPT)
+    
+    @staticmethod
+    def _create_async_connection(decode_responses):
+        return redis.asyncio.Redis(
+            connection_pool=redis.asyncio.ConnectionPool(
+                host=settings.REDIS_HOST,
+                port=settings.REDIS_PORT,
+                db=settings.REDIS_DB,
+                password=settings.REDIS_PASSWORD,
+                max_connections=settings.REDIS_MAX_CONNECTIONS,
+                decode_responses=decode_responses
+            )
+        )
     
     def ping(self):
         """测试Redis连接"""
@@ -20,26 +80,58 @@ class RedisClient:
     
     def push_message(self, queue_name, message):
         """向队列推送消息"""
-        return self.connection.lpush(queue_name, message)
-    
-    def pop_message(self, queue_name, timeout=0):
-        """从队列获取消息，支持阻塞操作"""
-        if timeout > 0:
-            # 阻塞式获取
-            result = self.connection.brpop(queue_name, timeout)
-            return result[1] if result else None
-        else:
-            # 非阻塞式获取
-            return self.connection.rpop(queue_name)
+        return self.enqueue(queue_name, None, [message])
+    
+    def push_messages(self, queue_name, messages):
+        """一次往返向队列推送多条消息，队首到队尾保持传入顺序，返回入队后的队列长度"""
+        return self.enqueue(queue_name, None, messages)
+    
+    def enqueue(self, queue_name, counter_name, messages, tokens=0, client=None):
+        """在一次往返中原子地增加token计数并推入一批消息
+        
+        计数和消息要么都写入要么都不写入，不会因进程在两次调用之间退出而不一致
+        
+        Args:
+            queue_name: 队列名称
+            counter_name: token计数器名称，为None时只推入消息
+            messages: 已编码的消息列表，队首到队尾保持传入顺序
+            tokens: 计入计数器的token数
+            client: 在管道上执行时传入管道，此时命令结果（入队后的队列长度）随管道返回
+        
+        Returns:
+            入队后的队列长度；传入管道时返回管道本身
+        """
+        keys = [queue_name] if counter_name is None else [queue_name, counter_name]
+        args = [tokens, self.session_ttl]
+        if self.queue_transport == "stream":
+            args.append(self.stream_maxlen)
+        return self._enqueue_script(keys=keys, args=args + list(messages), client=client or self.connection)
     
     def get_queue_length(self, queue_name):
         """获取队列长度"""
+        if self.queue_transport == "stream":
+            return self.connection.xlen(queue_name)
         return self.connection.llen(queue_name)
     
     def clear_queue(self, queue_name):
         """清空队列"""
         return self.connection.delete(queue_name)
     
+    async def init_session(self, queue_name, counter_name):
+        """会话开始时清空旧队列、创建计数器并设置过期时间，在一个事务中完成"""
+        pipe = self.async_connection.pipeline(transaction=True)
+        pipe.delete(queue_name)
+        pipe.incrby(counter_name, 0)
+        if self.session_ttl:
+            pipe.expire(counter_name, self.session_ttl)
+        await pipe.execute()
+    
+    def refresh_ttl(self, client, *keys):
+        """在连接或管道上刷新会话键的过期时间"""
+        if self.session_ttl:
+            for key in keys:
+                client.expire(key, self.session_ttl)
+    
     def increment_counter(self, counter_name, amount=1):
         """增加计数器值"""
         return self.connection.incrby(counter_name, amount)
@@ -48,6 +140,34 @@ class RedisClient:
         """获取计数器值"""
         value = self.connection.get(counter_name)
         return int(value) if value else 0
+    
+    async def get_counter_async(self, counter_name):
+        """异步获取计数器值"""
+        value = await self.async_connection.get(counter_name)
+        return int(value) if value else 0
+    
+    async def pop_messages_with_stats(self, queue_name, counter_name, count=1):
+        """一次往返最多取出count条消息，同时读取计数器值和出队后的队列长度
+        
+        Returns:
+            (按入队顺序排列的消息帧列表, 计数器值, 队列长度)
+        """
+        pipe = self.async_queue_connection.pipeline(transaction=False)
+        for _ in range(count):
+            pipe.rpop(queue_name)
+        pipe.get(counter_name)
+        pipe.llen(queue_name)
+        self.refresh_ttl(pipe, queue_name, counter_name)
+        results = await pipe.execute()
+        messages = [message for message in results[:count] if message is not None]
+        counter, queue_length = results[count:count + 2]
+        return messages, int(counter) if counter else 0, queue_length
+    
+    async def close_async(self):
+        """关闭异步连接池"""
+        for connection in (self.async_connection, self.async_queue_connection):
+            await connection.close()
+            await connection.connection_pool.disconnect()
 
 # 创建全局Redis客户端实例
 redis_client = RedisClient()
@@ -0,0 +1,95 @@
+import asyncio
+from collections import deque
+
+from app.core.config import settings
+
+
+class AdmissionController:
+    """按上游请求预算限制本进程同时生成的会话数
+
+    上限由MAX_ACTIVE_SESSIONS显式配置，未配置时不限制。每个会话从建立到结束（包括重连宽限期）占用一个名额；
+    名额用完时新连接进入有界的等待队列，按先后顺序获得释放的名额，队列已满或等待超时则拒绝，并给出建议的重试间隔。
+    """
+
+    def __init__(self):
+        """初始化准入控制"""
+        self.capacity = max(0, settings.MAX_ACTIVE_SESSIONS)  # 0表示不限制
+        if not self.capacity and settings.DEEPSEEK_API_KEY and settings.DEEPSEEK_RATE_LIMIT > 0:
+            # 单个独立会话每秒约需要的请求数，估算方法见config.py中MAX_ACTIVE_SESSIONS的说明
+            per_session = settings.MESSAGES_PER_SECOND / 1.5 / max(1, settings.GENERATION_BATCH_SIZE)
+            print(
+                f"未配置MAX_ACTIVE_SESSIONS，准入控制已关闭：DeepSeek请求预算为每秒 {settings.DEEPSEEK_RATE_LIMIT:g} 次，"
+                f"按每个会话每秒约 {per_session:.2f} 次请求估算，单进程约可支撑 {int(settings.DEEPSEEK_RATE_LIMIT / per_session)} 个会话"
+            )
+        self.queue_size = max(0, settings.ADMISSION_QUEUE_SIZE)
+        self.wait_timeout = max(1, settings.ADMISSION_WAIT_SECONDS)
+        self.retry_after = max(1, settings.ADMISSION_RETRY_AFTER)
+        self.active = set()  # 已获得名额的会话ID
+        self.waiters = deque()  # 等待名额的 (会话ID, future)
+        self.stats = {
+            "admitted": 0,
+            "queued": 0,
+            "rejected": 0,
+            "timed_out": 0,
+        }
+
+    def try_acquire(self, session_id):
+        """有空余名额时立即占用，返回是否成功"""
+        if self.capacity and len(self.active) >= self.capacity:
+            return False
+        self.active.add(session_id)
+        self.stats["admitted"] += 1
+        return True
+
+    def can_wait(self):
+        """等待队列是否还有空位"""
+        return len(self.waiters) < self.queue_size
+
+    async def wait(self, session_id):
+        """排队等待名额
+
+        Returns:
+            是否获得名额，队列已满或等待超时时返回False
+        """
+        if not self.can_wait():
+            self.stats["rejected"] += 1
+            return False
+
+        future = asyncio.get_running_loop().create_future()
+        entry = (session_id, future)
+        self.waiters.append(entry)
+        self.stats["queued"] += 1
+        try:
+            return await asyncio.wait_for(future, self.wait_timeout)
+        except asyncio.TimeoutError:
+            self.stats["timed_out"] += 1
+            return False
+        finally:
+            if entry in self.waiters:
+                self.waiters.remove(entry)
+
+    def release(self, session_id):
+        """会话结束时归还名额，按排队顺序交给等待中的连接"""
+        if session_id not in self.active:
+            return
+        self.active.discard(session_id)
+        while self.waiters and (not self.capacity or len(self.active) < self.capacity):
+            waiting_id, future = self.waiters.popleft()
+            if future.done():
+                continue
+            self.active.add(waiting_id)
+            self.stats["admitted"] += 1
+            future.set_result(True)
+
+    def snapshot(self):
+        """返回准入控制状态，用于监控"""
+        return {
+            "capacity": self.capacity,
+            "active_sessions": len(self.active),
+            "waiting": len(self.waiters),
+            "queue_size": self.queue_size,
+            **self.stats,
+        }
+
+# 创建全局准入控制实例
+admission_controller = AdmissionController()
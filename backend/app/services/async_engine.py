@@ -0,0 +1,346 @@
+import asyncio
+import time
+
+import httpx
+
+from app.core.config import settings
+from app.services.deepseek_common import (
+    COMPLETIONS_PATH,
+    CompletionStreamParser,
+    build_headers,
+    build_request_data,
+    estimate_tokens,
+    split_messages,
+)
+from app.services.backpressure import queue_backpressure
+from app.services.circuit_breaker import circuit_breaker, parse_retry_after
+from app.services.fallback_corpus import fallback_corpus
+from app.services.length_tuner import length_tuner
+from app.services.message_cache import SeenMessages, message_cache
+from app.services.rate_limiter import deepseek_limiter
+
+class AsyncGenerationEngine:
+    """异步生成引擎，所有会话的请求协程运行在同一个事件循环上，共享一个连接池化的HTTP客户端
+
+    与线程引擎相比，会话数增加时不会创建新的线程和连接，内存占用与线程数保持平稳
+    """
+
+    def __init__(self, base_url, api_key):
+        """初始化引擎
+
+        Args:
+            base_url: DeepSeek API地址
+            api_key: DeepSeek API密钥
+        """
+        self.base_url = base_url
+        self.api_key = api_key
+        self.client = None  # 懒加载，保证在事件循环中创建
+        self.session_tasks = {}  # 每个会话的请求协程任务
+        self.sessions = {}  # 每个会话的共享参数，协程每轮请求前读取
+
+    def _get_client(self):
+        """获取共享的HTTP客户端，首次调用时创建"""
+        if self.client is None:
+            limits = httpx.Limits(
+                max_connections=settings.HTTP_MAX_CONNECTIONS,
+                max_keepalive_connections=settings.HTTP_MAX_KEEPALIVE,
+                keepalive_expiry=settings.HTTP_KEEPALIVE_EXPIRY
+            )
+            try:
+                self.client = httpx.AsyncClient(
+                    base_url=self.base_url,
+                    headers=build_headers(self.api_key),
+                    http2=settings.DEEPSEEK_HTTP2,
+                    limits=limits,
+                    timeout=30.0
+                )
+            except ImportError:
+                # 未安装h2时退回HTTP/1.1
+                print("未安装HTTP/2依赖(h2)，异步引擎使用HTTP/1.1")
+                self.client = httpx.AsyncClient(
+                    base_url=self.base_url,
+                    headers=build_headers(self.api_key),
+                    limits=limits,
+                    timeout=30.0
+                )
+        return self.client
+
+    def start_session(self, emotion_type, session_id, min_length, max_length, worker_count, emit, add_tokens, batch_size=1, stream=False, seen=None):
+        """为会话启动请求协程
+
+        Args:
+            emotion_type: 用户请求的情绪类型
+            session_id: 会话ID或共享生成器ID
+            min_length: 最小字数
+            max_length: 最大字数
+            worker_count: 该会话的并发请求协程数
+            emit: 同步函数emit(messages, tokens)，把一批消息交给下游
+            add_tokens: 同步函数add_tokens(tokens)，补记流式请求的token差额
+            batch_size: 每次请求生成的消息条数
+            stream: 是否使用流式补全
+            seen: 该会话已收到的消息，用于从共享缓存取消息时去重
+        """
+        self.stop_session(session_id)
+        # 会话参数由该会话的所有协程共享
+        session = {
+            "emotion_type": emotion_type,
+            "session_id": session_id,
+            "emit": emit,
+            "add_tokens": add_tokens,
+            "min_length": min_length,
+            "max_length": max_length,
+            "batch_size": batch_size,
+            "stream": stream,
+            "seen": seen if seen is not None else SeenMessages(),
+        }
+        self.sessions[session_id] = session
+        self.session_tasks[session_id] = [
+            asyncio.create_task(self._request_loop(session, i), name=f"session-{session_id}-{i}")
+            for i in range(worker_count)
+        ]
+
+    def stop_session(self, session_id):
+        """取消会话的所有请求协程，进行中的HTTP请求（包括流式读取）会随之中断
+
+        Args:
+            session_id: 会话ID
+        """
+        self.sessions.pop(session_id, None)
+        tasks = self.session_tasks.pop(session_id, None)
+        if not tasks:
+            return False
+        for task in tasks:
+            task.cancel()
+        return True
+
+    def update_session(self, session_id, min_length, max_length):
+        """就地更新会话的字数范围，协程在下一轮请求时生效
+
+        Args:
+            session_id: 会话ID
+            min_length: 新的最小字数
+            max_length: 新的最大字数
+        """
+        session = self.sessions.get(session_id)
+        if session is None:
+            return False
+        session["min_length"] = min_length
+        session["max_length"] = max_length
+        return True
+
+    async def close(self):
+        """停止所有会话并关闭共享的HTTP客户端"""
+        for session_id in list(self.session_tasks):
+            self.stop_session(session_id)
+        if self.client is not None:
+            await self.client.aclose()
+            self.client = None
+
+    async def _push(self, session, messages, tokens):
+        """把一批消息交给会话的下游
+
+        同步Redis调用放到默认线程池执行，避免阻塞事件循环
+        """
+        await asyncio.to_thread(session["emit"], messages, tokens)
+
+    async def _push_fallback(self, session, worker_id):
+        """API不可用时用一条预设消息代替"""
+        # 使用协程序号和时间戳确保每个协程获取不同的消息
+        message = fallback_corpus.pick(session["min_length"], session["max_length"], int(time.time()) + worker_id)
+        await self._push(session, [message], estimate_tokens(message))
+        print(f"[会话 {session['session_id']} 协程 {worker_id}] 使用预设消息 '{session['emotion_type']}': {message}")
+
+    @staticmethod
+    def _draw_cached(session):
+        """按会话当前参数从共享缓存取消息"""
+        return message_cache.draw(
+            session["emotion_type"],
+            session["min_length"],
+            session["max_length"],
+            session["batch_size"],
+            session["seen"]
+        )
+
+    async def _post_completion(self, client, request_data):
+        """以普通方式请求补全，并把结果反馈给限流器和熔断器
+
+        Returns:
+            (状态码, 补全文本或错误信息, 总token数)
+        """
+        request_start = time.monotonic()
+        try:
+            response = await client.post(COMPLETIONS_PATH, json=request_data)
+        except asyncio.CancelledError:
+            deepseek_limiter.release()
+            circuit_breaker.release_probe()
+            raise
+        except Exception:
+            deepseek_limiter.release(latency=time.monotonic() - request_start, error=True)
+            circuit_breaker.record(error=True)
+            raise
+        deepseek_limiter.release(response.status_code, time.monotonic() - request_start)
+        circuit_breaker.record(response.status_code, retry_after=parse_retry_after(response.headers.get("Retry-After")))
+
+        if response.status_code != 200:
+            return response.status_code, response.text, None
+
+        result = response.json()
+        content = result["choices"][0]["message"]["content"].strip()
+        tokens = result.get("usage", {}).get("total_tokens", estimate_tokens(content))
+        return response.status_code, content, tokens
+
+    async def _stream_completion(self, client, request_data, on_lines):
+        """以SSE流式请求补全，每完成一行就交给on_lines处理
+
+        协程被取消时退出async with，连接随之关闭，上游停止生成
+
+        Returns:
+            (状态码, 错误信息, usage给出的总token数)
+        """
+        request_start = time.monotonic()
+        released = False
+        try:
+            async with client.stream("POST", COMPLETIONS_PATH, json=request_data) as response:
+                # 以首字节耗时作为限流器的延迟信号
+                deepseek_limiter.release(response.status_code, time.monotonic() - request_start)
+                circuit_breaker.record(response.status_code, retry_after=parse_retry_after(response.headers.get("Retry-After")))
+                released = True
+
+                if response.status_code != 200:
+                    await response.aread()
+                    return response.status_code, response.text, None
+
+                parser = CompletionStreamParser()
+                async for raw_line in response.aiter_lines():
+                    lines = parser.feed(raw_line)
+                    if lines:
+                        await on_lines(lines)
+                    if parser.done:
+                        break
+                else:
+                    lines = parser.finish()
+                    if lines:
+                        await on_lines(lines)
+                return response.status_code, None, parser.total_tokens
+        except asyncio.CancelledError:
+            if not released:
+                deepseek_limiter.release()
+                circuit_breaker.release_probe()
+            raise
+        except Exception:
+            if not released:
+                deepseek_limiter.release(latency=time.monotonic() - request_start, error=True)
+                circuit_breaker.record(error=True)
+            raise
+
+    async def _request_loop(self, session, worker_id):
+        """单个请求协程，持续请求DeepSeek API直到被取消
+
+        Args:
+            session: 会话参数
+            worker_id: 协程序号，用于日志
+        """
+        session_id = session["session_id"]
+        emotion_type = session["emotion_type"]
+        log_prefix = f"[会话 {session_id} 协程 {worker_id}]"
+        print(f"{log_prefix} 开始生成 '{emotion_type}' 类型消息 ({session['min_length']}-{session['max_length']} 字)")
+        client = self._get_client()
+        failures = 0  # 连续失败次数，决定重试前的退避时间
+
+        try:
+            while True:
+                # 队列达到高水位时挂起，直到分发端消费到低水位
+                await queue_backpressure.wait_async(session_id)
+
+                # 优先从共享缓存取消息，缓存中没有该会话未收到过的消息时才请求API补充
+                if message_cache.use_redis:
+                    cached = await asyncio.to_thread(self._draw_cached, session)
+                else:
+                    cached = self._draw_cached(session)
+                if cached:
+                    messages = [message for message, _ in cached]
+                    await self._push(session, messages, sum(tokens for _, tokens in cached))
+                    session["seen"].add(messages)
+                    print(f"{log_prefix} 缓存命中 {len(messages)} 条 '{emotion_type}' 消息: {' / '.join(messages)}")
+                    await asyncio.sleep(1)
+                    continue
+
+                # 熔断器打开时不请求上游，直接使用预设消息
+                if not circuit_breaker.allow():
+                    await self._push_fallback(session, worker_id)
+                    await asyncio.sleep(circuit_breaker.backoff(0))
+                    continue
+
+                # 获取全局请求预算
+                try:
+                    await deepseek_limiter.acquire_async()
+                except asyncio.CancelledError:
+                    circuit_breaker.release_probe()
+                    raise
+                try:
+                    min_length = session["min_length"]
+                    max_length = session["max_length"]
+                    request_data = build_request_data(
+                        emotion_type,
+                        min_length,
+                        max_length,
+                        session["batch_size"],
+                        session["stream"],
+                        **length_tuner.params(min_length, max_length)
+                    )
+
+                    # 本次请求入队的消息数与按估算计入的token数
+                    produced = {"messages": 0, "tokens": 0}
+
+                    async def accept(lines, tokens=None):
+                        # 按行拆分并过滤不符合长度要求的消息
+                        messages, rejected = split_messages("\n".join(lines), min_length, max_length)
+                        length_tuner.record(min_length, max_length, messages, rejected)
+                        for message in rejected:
+                            print(f"{log_prefix} 消息长度不符合要求 ({len(message)} 字): {message}")
+                        if not messages:
+                            return
+                        if tokens is None:
+                            tokens = sum(estimate_tokens(message) for message in messages)
+                        await self._push(session, messages, tokens)
+                        session["seen"].add(messages)
+                        if message_cache.use_redis:
+                            await asyncio.to_thread(message_cache.put, emotion_type, messages, tokens)
+                        else:
+                            message_cache.put(emotion_type, messages, tokens)
+                        produced["messages"] += len(messages)
+                        produced["tokens"] += tokens
+                        print(f"{log_prefix} 成功生成 {len(messages)} 条 '{emotion_type}' 消息: {' / '.join(messages)} (tokens: {tokens})")
+
+                    if session["stream"]:
+                        # 流式请求：每完成一行立即入队，结束后按usage补齐token计数
+                        status_code, error_text, total_tokens = await self._stream_completion(client, request_data, accept)
+                        if produced["messages"] and total_tokens and total_tokens > produced["tokens"]:
+                            await asyncio.to_thread(session["add_tokens"], total_tokens - produced["tokens"])
+                    else:
+                        status_code, content, total_tokens = await self._post_completion(client, request_data)
+                        error_text = content
+                        if status_code == 200:
+                            await accept([content], total_tokens)
+
+                    if status_code == 200:
+                        failures = 0
+                        await asyncio.sleep(1 if produced["messages"] else 0.5)
+                    else:
+                        print(f"{log_prefix} API请求失败: {status_code} {error_text}")
+                        # 如果API请求失败，使用预设消息
+                        await self._push_fallback(session, worker_id)
+                        # 按指数退避（带抖动）再重试，避免所有协程同时重试
+                        await asyncio.sleep(circuit_breaker.backoff(failures))
+                        failures += 1
+
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    print(f"{log_prefix} 发生异常: {str(e)}")
+                    await asyncio.sleep(circuit_breaker.backoff(failures + 1))
+                    failures += 1
+
+        except asyncio.CancelledError:
+            print(f"{log_prefix} 会话已停止，退出生成循环")
+            raise
@@ -0,0 +1,172 @@
+import asyncio
+import threading
+
+from app.core.config import settings
+
+class FlowGate:
+    """单个会话的生产闸门，线程和协程都可以在上面等待，打开时立即唤醒，不需要轮询"""
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.event.set()
+        self.lock = threading.Lock()
+        self.async_waiters = []  # 等待闸门打开的协程 (loop, future)
+
+    @property
+    def is_open(self):
+        return self.event.is_set()
+
+    def close(self):
+        self.event.clear()
+
+    def open(self):
+        with self.lock:
+            self.event.set()
+            for loop, future in self.async_waiters:
+                loop.call_soon_threadsafe(self._wake, future)
+            self.async_waiters.clear()
+
+    @staticmethod
+    def _wake(future):
+        if not future.done():
+            future.set_result(None)
+
+    def wait(self):
+        """阻塞等待闸门打开，供线程引擎使用"""
+        self.event.wait()
+
+    async def wait_async(self):
+        """等待闸门打开，供async引擎使用"""
+        with self.lock:
+            if self.event.is_set():
+                return
+            future = asyncio.get_running_loop().create_future()
+            entry = (future.get_loop(), future)
+            self.async_waiters.append(entry)
+        try:
+            await future
+        finally:
+            with self.lock:
+                if entry in self.async_waiters:
+                    self.async_waiters.remove(entry)
+
+
+class QueueBackpressure:
+    """会话消息队列的水位控制
+
+    生成端入队后队列长度达到高水位时关闭该会话的闸门，生成线程/协程在闸门上挂起；
+    分发端出队时只在闸门关闭期间检查队列长度，降到低水位以下时打开闸门唤醒生成端。
+    """
+
+    def __init__(self):
+        """初始化水位控制器"""
+        self.high_watermark = max(1, settings.QUEUE_HIGH_WATERMARK)
+        self.low_watermark = min(max(0, settings.QUEUE_LOW_WATERMARK), self.high_watermark - 1)
+        self.gates = {}
+        self.listeners = []  # 闸门状态变化回调 (session_id, paused)
+        self.lock = threading.Lock()
+        self.stats = {
+            "pauses": 0,
+            "resumes": 0,
+        }
+
+    def add_listener(self, listener):
+        """注册闸门状态变化回调，回调参数为(session_id, paused)"""
+        self.listeners.append(listener)
+
+    def register(self, session_id):
+        """为会话创建闸门"""
+        with self.lock:
+            self.gates[session_id] = FlowGate()
+
+    def unregister(self, session_id):
+        """移除会话闸门，并唤醒仍在等待的生成端让其退出"""
+        with self.lock:
+            gate = self.gates.pop(session_id, None)
+        if gate is not None:
+            gate.open()
+
+    def is_paused(self, session_id):
+        """会话的生成端是否处于暂停状态"""
+        gate = self.gates.get(session_id)
+        return gate is not None and not gate.is_open
+
+    def on_enqueued(self, session_id, queue_length):
+        """生成端入队后调用，队列达到高水位时暂停该会话的生成
+
+        Args:
+            session_id: 会话ID
+            queue_length: 入队后的队列长度
+        """
+        if queue_length >= self.high_watermark and self.pause(session_id):
+            print(f"[会话 {session_id}] 队列长度 {queue_length} 达到高水位，暂停生成")
+
+    def on_dequeued(self, session_id, queue_length):
+        """分发端在生成暂停期间出队后调用，队列降到低水位以下时恢复生成
+
+        Args:
+            session_id: 会话ID
+            queue_length: 出队后的队列长度
+        """
+        if queue_length <= self.low_watermark and self.resume(session_id):
+            print(f"[会话 {session_id}] 队列长度 {queue_length} 降到低水位，恢复生成")
+
+    def pause(self, session_id):
+        """关闭会话闸门，返回状态是否发生变化"""
+        gate = self.gates.get(session_id)
+        if gate is None:
+            return False
+        with self.lock:
+            if not gate.is_open:
+                return False
+            gate.close()
+            self.stats["pauses"] += 1
+        self._notify(session_id, True)
+        return True
+
+    def resume(self, session_id):
+        """打开会话闸门，返回状态是否发生变化"""
+        gate = self.gates.get(session_id)
+        if gate is None:
+            return False
+        with self.lock:
+            if gate.is_open:
+                return False
+            gate.open()
+            self.stats["resumes"] += 1
+        self._notify(session_id, False)
+        return True
+
+    def _notify(self, session_id, paused):
+        for listener in self.listeners:
+            try:
+                listener(session_id, paused)
+            except Exception as e:
+                print(f"[会话 {session_id}] 水位闸门回调异常: {str(e)}")
+
+    def wait(self, session_id):
+        """生成线程在闸门关闭时挂起，直到分发端把队列消费到低水位或会话结束"""
+        gate = self.gates.get(session_id)
+        if gate is not None:
+            gate.wait()
+
+    async def wait_async(self, session_id):
+        """生成协程在闸门关闭时挂起，直到分发端把队列消费到低水位或会话结束"""
+        gate = self.gates.get(session_id)
+        if gate is not None:
+            await gate.wait_async()
+
+    def snapshot(self):
+        """返回水位控制状态，用于监控"""
+        with self.lock:
+            gates = list(self.gates.values())
+            return {
+                "high_watermark": self.high_watermark,
+                "low_watermark": self.low_watermark,
+                "sessions": len(gates),
+                "paused_sessions": sum(1 for gate in gates if not gate.is_open),
+                **self.stats,
+            }
+
+# 创建全局水位控制器实例
+queue_backpressure = QueueBackpressure()
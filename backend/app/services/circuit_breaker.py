@@ -0,0 +1,188 @@
+import random
+import threading
+import time
+from collections import deque
+from email.utils import parsedate_to_datetime
+
+from app.core.config import settings
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+def parse_retry_after(value):
+    """解析Retry-After响应头，支持秒数和HTTP日期两种格式，无法解析时返回None"""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class CircuitBreaker:
+    """DeepSeek请求的熔断器，所有会话共用
+
+    连续失败达到阈值（或上游返回Retry-After）时打开，打开期间不再发起上游请求，
+    由调用方直接使用预设语句；打开时间按连续打开次数指数增长并加入随机抖动，
+    到期后进入半开状态，只放行少量探测请求，探测成功则关闭，失败则再次打开。
+    """
+
+    def __init__(self):
+        """初始化熔断器"""
+        self.failure_threshold = max(1, settings.BREAKER_FAILURE_THRESHOLD)
+        self.base_open_seconds = settings.BREAKER_OPEN_SECONDS
+        self.max_open_seconds = max(self.base_open_seconds, settings.BREAKER_MAX_OPEN_SECONDS)
+        self.half_open_probes = max(1, settings.BREAKER_HALF_OPEN_PROBES)
+        self.retry_base = settings.RETRY_BACKOFF_BASE
+        self.retry_max = max(self.retry_base, settings.RETRY_BACKOFF_MAX)
+
+        self.state = CLOSED
+        self.failures = 0  # 关闭状态下的连续失败次数
+        self.open_count = 0  # 连续打开的次数，决定下一次打开的时长
+        self.open_until = 0.0
+        self.probes_in_flight = 0
+        self.listeners = []  # 状态变化回调 (old_state, new_state, reason)
+        self.transitions = deque(maxlen=20)  # 最近的状态变化，用于监控
+        self.lock = threading.Lock()
+        self.stats = {
+            "opened": 0,
+            "half_opened": 0,
+            "closed": 0,
+            "rejected": 0,
+            "probes": 0,
+            "failures": 0,
+        }
+
+    def add_listener(self, listener):
+        """注册状态变化回调，回调参数为(old_state, new_state, reason)"""
+        self.listeners.append(listener)
+
+    def allow(self):
+        """是否可以发起一次上游请求
+
+        打开期间返回False；半开状态下只放行有限个探测请求，放行后必须调用record或release_probe归还
+        """
+        transition = None
+        with self.lock:
+            if self.state == OPEN:
+                if time.monotonic() < self.open_until:
+                    self.stats["rejected"] += 1
+                    return False
+                transition = self._transition(HALF_OPEN, "打开时间已到")
+            if self.state == HALF_OPEN:
+                if self.probes_in_flight >= self.half_open_probes:
+                    self.stats["rejected"] += 1
+                    allowed = False
+                else:
+                    self.probes_in_flight += 1
+                    self.stats["probes"] += 1
+                    allowed = True
+            else:
+                allowed = True
+        self._notify(transition)
+        return allowed
+
+    def release_probe(self):
+        """放行后没有得到上游结果（会话停止未发出请求，或请求被取消）时归还半开探测名额，不计入成败"""
+        with self.lock:
+            if self.state == HALF_OPEN:
+                self.probes_in_flight = max(0, self.probes_in_flight - 1)
+
+    def record(self, status_code=None, error=False, retry_after=None):
+        """请求结束后反馈结果
+
+        Args:
+            status_code: 响应状态码，请求异常时为None
+            error: 是否发生网络异常或超时
+            retry_after: 上游通过Retry-After要求等待的秒数
+        """
+        failed = (
+            error
+            or status_code == 429
+            or (status_code is not None and status_code >= 500)
+        )
+        transition = None
+        with self.lock:
+            if self.state == HALF_OPEN:
+                self.probes_in_flight = max(0, self.probes_in_flight - 1)
+
+            if failed:
+                self.stats["failures"] += 1
+                self.failures += 1
+                if self.state == HALF_OPEN:
+                    transition = self._open("探测请求失败", retry_after)
+                elif self.state == CLOSED and (retry_after is not None or self.failures >= self.failure_threshold):
+                    reason = f"上游要求等待 {retry_after:.1f} 秒" if retry_after is not None else f"连续失败 {self.failures} 次"
+                    transition = self._open(reason, retry_after)
+            elif status_code is not None and status_code < 400:
+                self.failures = 0
+                if self.state == HALF_OPEN:
+                    self.open_count = 0
+                    transition = self._transition(CLOSED, "探测请求成功")
+        self._notify(transition)
+
+    def _open(self, reason, retry_after=None):
+        # 必须在获取锁的情况下调用此方法
+        duration = min(self.max_open_seconds, self.base_open_seconds * (2 ** self.open_count))
+        # 加入抖动，避免所有进程在同一时刻结束打开状态
+        duration = duration / 2 + random.uniform(0, duration / 2)
+        if retry_after is not None:
+            duration = max(duration, retry_after)
+        self.open_count += 1
+        self.open_until = time.monotonic() + duration
+        return self._transition(OPEN, f"{reason}，{duration:.1f} 秒后进入半开状态")
+
+    def _transition(self, state, reason):
+        # 必须在获取锁的情况下调用此方法
+        old_state, self.state = self.state, state
+        if state == HALF_OPEN:
+            self.probes_in_flight = 0
+            self.stats["half_opened"] += 1
+        elif state == OPEN:
+            self.stats["opened"] += 1
+        else:
+            self.failures = 0
+            self.stats["closed"] += 1
+        self.transitions.append({"time": time.time(), "from": old_state, "to": state, "reason": reason})
+        return old_state, state, reason
+
+    def _notify(self, transition):
+        if transition is None:
+            return
+        old_state, state, reason = transition
+        print(f"DeepSeek熔断器 {old_state} -> {state}: {reason}")
+        for listener in self.listeners:
+            try:
+                listener(old_state, state, reason)
+            except Exception as e:
+                print(f"熔断器状态回调异常: {str(e)}")
+
+    @property
+    def is_open(self):
+        return self.state == OPEN and time.monotonic() < self.open_until
+
+    def backoff(self, attempt):
+        """第attempt次连续失败后的重试等待时间：指数增长，上限RETRY_BACKOFF_MAX，并带随机抖动"""
+        delay = min(self.retry_max, self.retry_base * (2 ** min(attempt, 16)))
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    def snapshot(self):
+        """返回熔断器状态和最近的状态变化，用于监控"""
+        with self.lock:
+            return {
+                "state": self.state,
+                "consecutive_failures": self.failures,
+                "open_count": self.open_count,
+                "reopens_in": round(max(0.0, self.open_until - time.monotonic()), 2) if self.state == OPEN else None,
+                **self.stats,
+                "transitions": list(self.transitions),
+            }
+
+# 创建全局熔断器实例
+circuit_breaker = CircuitBreaker()
@@ -0,0 +1,234 @@
+import asyncio
+import threading
+from collections import deque
+
+from app.core.config import settings
+from app.services.backpressure import queue_backpressure
+from app.services.deepseek_common import distribute_tokens, encode_message
+from app.services.message_cache import normalize_emotion
+from app.services.queue_backend import queue_backend
+
+class SharedGenerator:
+    """一组参数相同的会话共享的生成流
+
+    生成结果按序号追加到有界日志中，每个订阅者记录自己的游标（下一条要投递的序号）。
+    """
+
+    def __init__(self, group_id, log_size):
+        self.group_id = group_id
+        self.subscribers = {}  # session_id -> 游标
+        self.log = deque(maxlen=log_size)  # (消息帧, token数)
+        self.base_seq = 0  # 日志中第一条消息的序号
+        self.lock = threading.RLock()
+
+    @property
+    def end_seq(self):
+        return self.base_seq + len(self.log)
+
+    def append(self, items):
+        # 必须在获取锁的情况下调用此方法
+        overflow = len(self.log) + len(items) - self.log.maxlen
+        if overflow > 0:
+            self.base_seq += min(overflow, len(self.log))
+        self.log.extend(items)
+
+
+class GenerationCoalescer:
+    """合并参数相同(情绪、最小字数、最大字数)的会话，让它们订阅同一个生成器
+
+    共享生成器按引用计数管理，最后一个订阅者离开时才停止；生成结果扇出到所有订阅者
+    的会话队列。订阅者队列达到高水位时暂不投递、游标停在原处，消费到低水位后从游标处补发；
+    所有订阅者都暂停时共享生成器也随之暂停。
+    """
+
+    def __init__(self):
+        """初始化合并器"""
+        self.enabled = settings.GENERATION_COALESCE
+        self.log_size = max(1, settings.COALESCE_LOG_SIZE)
+        self.warm_start = max(0, settings.QUEUE_LOW_WATERMARK)  # 新订阅者可以立即拿到的最近消息数
+        self.groups = {}  # group_id -> SharedGenerator
+        self.session_groups = {}  # session_id -> group_id
+        self.lock = threading.Lock()  # 保护groups和session_groups，只在group.lock之内或单独获取
+        self.stats_lock = threading.Lock()
+        self.stats = {
+            "groups_created": 0,
+            "subscriptions": 0,
+            "published_messages": 0,
+            "delivered_messages": 0,
+            "skipped_messages": 0,
+        }
+        queue_backpressure.add_listener(self._on_gate_change)
+
+    @staticmethod
+    def group_key(emotion_type, min_length, max_length):
+        """共享生成器的ID"""
+        return f"group:{normalize_emotion(emotion_type)}:{min_length}:{max_length}"
+
+    def is_group(self, generator_id):
+        """生成器ID是否对应一个共享生成器（最后一个订阅者离开后仍在收尾的生成器也算）"""
+        return generator_id.startswith("group:")
+
+    def subscribe(self, session_id, emotion_type, min_length, max_length):
+        """会话订阅参数相同的共享生成器，没有则创建
+
+        会与生成线程争用group.lock并同步写入会话队列，在事件循环中须交给线程池执行
+
+        Returns:
+            (共享生成器ID, 是否新创建)，新创建时需要由调用方启动生成
+        """
+        group_id = self.group_key(emotion_type, min_length, max_length)
+        while True:
+            with self.lock:
+                group = self.groups.get(group_id)
+                created = group is None
+                if created:
+                    group = self.groups[group_id] = SharedGenerator(group_id, self.log_size)
+
+            with group.lock:
+                with self.lock:
+                    # 获取group.lock之前最后一个订阅者可能刚好离开，此时重新创建
+                    if self.groups.get(group_id) is not group:
+                        continue
+                    self.session_groups[session_id] = group_id
+                # 新订阅者从最近的几条消息开始，加入已有的生成流时可以立即收到消息
+                group.subscribers[session_id] = max(group.base_seq, group.end_seq - self.warm_start)
+                self._deliver(group, [session_id])
+                self._update_gate(group)
+                break
+
+        with self.stats_lock:
+            self.stats["subscriptions"] += 1
+            if created:
+                self.stats["groups_created"] += 1
+        print(f"[会话 {session_id}] 订阅共享生成器 {group_id}，当前订阅数: {len(group.subscribers)}")
+        return group_id, created
+
+    def unsubscribe(self, session_id):
+        """会话退订共享生成器，与subscribe一样须在线程池中执行
+
+        Returns:
+            (共享生成器ID, 剩余订阅数)，会话没有订阅时返回(None, 0)
+        """
+        with self.lock:
+            group_id = self.session_groups.pop(session_id, None)
+            group = self.groups.get(group_id)
+        if group is None:
+            return None, 0
+
+        with group.lock:
+            group.subscribers.pop(session_id, None)
+            remaining = len(group.subscribers)
+            if remaining == 0:
+                with self.lock:
+                    if self.groups.get(group_id) is group:
+                        del self.groups[group_id]
+            else:
+                self._update_gate(group)
+        print(f"[会话 {session_id}] 退订共享生成器 {group_id}，剩余订阅数: {remaining}")
+        return group_id, remaining
+
+    def publish(self, group_id, messages, tokens):
+        """共享生成器产出一批消息，追加到日志并扇出给所有未暂停的订阅者
+
+        Args:
+            group_id: 共享生成器ID
+            messages: 消息列表
+            tokens: 这批消息消耗的总token数
+        """
+        group = self.groups.get(group_id)
+        if group is None:
+            return
+        with group.lock:
+            # 每条消息只编码一次，扇出时各订阅者共用同一个消息帧
+            group.append([
+                (encode_message(message, share), share)
+                for message, share in zip(messages, distribute_tokens(tokens, len(messages)))
+            ])
+            with self.stats_lock:
+                self.stats["published_messages"] += len(messages)
+            self._deliver(group, list(group.subscribers))
+            self._update_gate(group)
+
+    def _deliver(self, group, session_ids):
+        """把订阅者游标之后的消息一次写入各自的会话队列"""
+        # 必须在获取group.lock的情况下调用此方法
+        batches = []
+        delivered = []
+        skipped = 0
+        for session_id in session_ids:
+            cursor = group.subscribers.get(session_id)
+            if cursor is None or queue_backpressure.is_paused(session_id):
+                continue
+            if cursor < group.base_seq:
+                # 落后太多，日志中已经没有的消息直接跳过
+                skipped += group.base_seq - cursor
+                cursor = group.base_seq
+            items = list(group.log)[cursor - group.base_seq:]
+            if not items:
+                continue
+            batches.append((session_id, [frame for frame, _ in items], sum(tokens for _, tokens in items)))
+            group.subscribers[session_id] = group.end_seq
+            delivered.append((session_id, len(items)))
+
+        if not delivered:
+            return
+        results = queue_backend.enqueue_many(batches)
+        with self.stats_lock:
+            self.stats["delivered_messages"] += sum(count for _, count in delivered)
+            self.stats["skipped_messages"] += skipped
+        # 每个订阅者对应一个结果，即入队后的队列长度
+        for (session_id, _), queue_length in zip(delivered, results):
+            queue_backpressure.on_enqueued(session_id, queue_length)
+
+    def _update_gate(self, group):
+        """所有订阅者都暂停时暂停共享生成器，任一订阅者恢复时恢复"""
+        # 必须在获取group.lock的情况下调用此方法
+        if any(not queue_backpressure.is_paused(session_id) for session_id in group.subscribers):
+            queue_backpressure.resume(group.group_id)
+        else:
+            queue_backpressure.pause(group.group_id)
+
+    def _on_gate_change(self, session_id, paused):
+        """订阅者的水位闸门变化时补发积压的消息，并同步共享生成器的闸门
+
+        分发端在事件循环中恢复闸门时，补发（同步写Redis并与生成线程争用group.lock）交给线程池执行，
+        不阻塞事件循环；订阅者自身的闸门已由水位控制器切换。
+        """
+        if self.session_groups.get(session_id) is None:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # 生成线程中：已在入队路径上，直接同步处理
+            self._sync_subscriber(session_id)
+            return
+        loop.run_in_executor(None, self._sync_subscriber, session_id)
+
+    def _sync_subscriber(self, session_id):
+        """按订阅者当前的闸门状态补发积压的消息，并同步共享生成器的闸门"""
+        group = self.groups.get(self.session_groups.get(session_id))
+        if group is None:
+            return
+        try:
+            with group.lock:
+                # 读取当前状态而不是回调时的状态，线程池中执行顺序不影响结果
+                if not queue_backpressure.is_paused(session_id):
+                    self._deliver(group, [session_id])
+                self._update_gate(group)
+        except Exception as e:
+            print(f"[会话 {session_id}] 补发共享生成器消息发生异常: {str(e)}")
+
+    def snapshot(self):
+        """返回共享生成器状态，用于监控"""
+        with self.stats_lock:
+            published = self.stats["published_messages"]
+            return {
+                "enabled": self.enabled,
+                "groups": len(self.groups),
+                "subscribers": len(self.session_groups),
+                "fanout_ratio": round(self.stats["delivered_messages"] / published, 2) if published else None,
+                **self.stats,
+            }
+
+# 创建全局合并器实例
+generation_coalescer = GenerationCoalescer()
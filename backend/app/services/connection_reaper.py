@@ -0,0 +1,116 @@
+import asyncio
+import time
+
+from app.core.config import settings
+from app.services.admission import admission_controller
+from app.services.coalescer import generation_coalescer
+from app.services.deepseek_service import deepseek_service
+from app.services.session_registry import session_registry
+from app.services.websocket_manager import websocket_manager
+
+
+class ConnectionReaper:
+    """WebSocket心跳和空闲会话回收
+
+    每隔WS_PING_INTERVAL秒向所有连接发送ping，超过WS_PING_INTERVAL+WS_PONG_TIMEOUT秒没有收到客户端任何消息的
+    连接视为半开连接，由服务端断开，会话进入重连宽限期，宽限期后停止生成器；
+    同时回收没有对应会话的生成器和准入名额（连接处理异常退出等情况遗留的生成线程）。
+    """
+
+    def __init__(self):
+        """初始化心跳和回收任务"""
+        self.interval = settings.WS_PING_INTERVAL
+        self.timeout = self.interval + max(1, settings.WS_PONG_TIMEOUT)
+        self.suspects = set()  # 上一轮检查时没有对应会话的生成器ID，连续两轮都没有才回收
+        self.slot_suspects = set()  # 上一轮检查时没有对应连接和会话的准入名额
+        self.task = None
+        self.stats = {
+            "pings": 0,
+            "dead_connections": 0,
+            "orphan_generators": 0,
+            "orphan_slots": 0,
+        }
+
+    def start(self):
+        """启动后台心跳任务"""
+        if self.interval > 0 and (self.task is None or self.task.done()):
+            self.task = asyncio.create_task(self._run(), name="connection-reaper")
+
+    async def stop(self):
+        """停止后台心跳任务"""
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.check()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"连接心跳检查发生异常: {str(e)}")
+
+    async def check(self):
+        """向存活的连接发送ping，断开失联的连接，并回收遗留的生成器"""
+        now = time.monotonic()
+        closing = []
+        for session_id, websocket in list(websocket_manager.active_connections.items()):
+            session = websocket_manager.sessions.get(session_id)
+            if session is None:
+                continue
+            if now - session.last_seen > self.timeout:
+                self.stats["dead_connections"] += 1
+                # 1001: 对端离开，客户端恢复网络后可以带session_id和last_seq重连
+                closing.append(websocket_manager.close_client(
+                    session_id, websocket, 1001, f"超过{self.timeout}秒未收到客户端消息"
+                ))
+            elif websocket_manager.send_control(session_id, {"type": "ping", "timestamp": time.time()}):
+                # 由连接的发送任务写入，发送超时时由它断开连接
+                self.stats["pings"] += 1
+        if closing:
+            await asyncio.gather(*closing)
+
+        self._reap_orphans()
+
+    def _reap_orphans(self):
+        """停止连续两轮检查都没有对应会话的生成器，归还没有对应连接和会话的准入名额"""
+        orphans = set()
+        for generator_id in deepseek_service.active_generators():
+            if generation_coalescer.is_group(generator_id):
+                # 共享生成器随最后一个订阅者退订而停止
+                continue
+            if generator_id in websocket_manager.sessions or generator_id in session_registry.local_generators:
+                continue
+            orphans.add(generator_id)
+
+        for generator_id in orphans & self.suspects:
+            print(f"回收没有对应会话的生成器: {generator_id}")
+            deepseek_service.stop_generation(generator_id)
+            self.stats["orphan_generators"] += 1
+        self.suspects = orphans - self.suspects
+
+        slots = {
+            session_id for session_id in admission_controller.active
+            if session_id not in websocket_manager.sessions and session_id not in websocket_manager.active_connections
+        }
+        for session_id in slots & self.slot_suspects:
+            admission_controller.release(session_id)
+            self.stats["orphan_slots"] += 1
+        self.slot_suspects = slots - self.slot_suspects
+
+    def snapshot(self):
+        """返回心跳和回收状态，用于监控"""
+        return {
+            "ping_interval": self.interval,
+            "timeout": self.timeout,
+            **self.stats,
+        }
+
+# 创建全局连接心跳和回收实例
+connection_reaper = ConnectionReaper()
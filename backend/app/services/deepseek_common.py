@@ -0,0 +1,197 @@
+import json
+import re
+import struct
+
+# DeepSeek对话补全接口路径
+COMPLETIONS_PATH = "/v1/chat/completions"
+
+# 单条消息的max_tokens，批量生成时按条数放大
+MAX_TOKENS_PER_MESSAGE = 50
+
+# 队列消息帧的格式版本；帧头依次为版本号、token数、消息字数（网络字节序），其后是消息内容的JSON字符串
+MESSAGE_FORMAT_VERSION = 1
+MESSAGE_HEADER = struct.Struct("!BHH")
+MAX_HEADER_VALUE = 0xFFFF
+
+# 模型在多行输出中可能附带的序号或列表符号，如 "1. " "2、" "- "
+LINE_PREFIX_PATTERN = re.compile(r"^\s*(?:\d+[.、:：)）]|[-*•])\s*")
+
+
+def build_headers(api_key):
+    """构建DeepSeek API请求头
+
+    Args:
+        api_key: DeepSeek API密钥
+    """
+    return {
+        "Content-Type": "application/json",
+        "Authorization": f"Bearer {api_key}"
+    }
+
+
+def build_request_data(emotion_type, min_length, max_length, batch_size=1, stream=False,
+                       max_tokens_per_message=MAX_TOKENS_PER_MESSAGE, temperature=0.8, length_hint=""):
+    """构建一次对话补全请求的数据
+
+    每次请求都构建新的数据对象，避免不同会话之间共享引用
+
+    Args:
+        emotion_type: 用户请求的情绪类型
+        min_length: 最小字数
+        max_length: 最大字数
+        batch_size: 一次请求生成的消息条数，大于1时要求模型每行输出一句
+        stream: 是否以SSE流式返回
+        max_tokens_per_message: 单条消息的max_tokens
+        temperature: 采样温度
+        length_hint: 附加在提示词末尾的字数要求
+    """
+    if batch_size > 1:
+        prompt = f"""请以朋友的口吻，生成{batch_size}句能给人{emotion_type}情绪价值的暖心话语，要求：
+1. 每句字数在{min_length}-{max_length}之间
+2. 语气真诚温暖，像朋友间的鼓励
+3. 表达自然流畅，有共情和理解，每句内容不要重复
+4. 不要使用标点符号
+5. 每句单独一行，不要编号，直接输出内容，不要有任何前缀或解释
+"""
+    else:
+        prompt = f"""请以朋友的口吻，生成一句能给人{emotion_type}情绪价值的暖心话语，要求：
+1. 字数在{min_length}-{max_length}之间
+2. 语气真诚温暖，像朋友间的鼓励
+3. 表达自然流畅，有共情和理解
+4. 不要使用标点符号
+5. 直接输出内容，不要有任何前缀或解释
+"""
+    if length_hint:
+        prompt += f"6. {length_hint}\n"
+    request_data = {
+        "model": "deepseek-chat",
+        "messages": [{"role": "user", "content": prompt}],
+        "temperature": temperature,
+        "max_tokens": max_tokens_per_message * max(1, batch_size)
+    }
+    if stream:
+        # 流式返回时在最后一个数据块中附带usage
+        request_data["stream"] = True
+        request_data["stream_options"] = {"include_usage": True}
+    return request_data
+
+
+def split_messages(content, min_length, max_length):
+    """把模型输出拆分成多条消息，并按字数范围过滤
+
+    Args:
+        content: 模型返回的文本
+        min_length: 最小字数
+        max_length: 最大字数
+
+    Returns:
+        (符合长度要求的消息列表, 被过滤掉的消息列表)
+    """
+    accepted = []
+    rejected = []
+    for line in content.splitlines():
+        message = LINE_PREFIX_PATTERN.sub("", line).strip()
+        if not message:
+            continue
+        if min_length <= len(message) <= max_length:
+            accepted.append(message)
+        else:
+            rejected.append(message)
+    return accepted, rejected
+
+
+class CompletionStreamParser:
+    """增量解析SSE格式的流式补全，每遇到换行就切出一行完整的文本"""
+
+    def __init__(self):
+        self.buffer = ""
+        self.total_tokens = None  # 流结束时由usage给出
+        self.done = False
+
+    def feed(self, raw_line):
+        """处理一行SSE数据，返回新完成的文本行"""
+        if not raw_line.startswith("data:"):
+            return []
+        data = raw_line[5:].strip()
+        if data == "[DONE]":
+            return self.finish()
+
+        chunk = json.loads(data)
+        usage = chunk.get("usage")
+        if usage:
+            self.total_tokens = usage.get("total_tokens")
+        for choice in chunk.get("choices") or []:
+            content = (choice.get("delta") or {}).get("content")
+            if content:
+                self.buffer += content
+
+        if "\n" not in self.buffer:
+            return []
+        *lines, self.buffer = self.buffer.split("\n")
+        return lines
+
+    def finish(self):
+        """流结束，返回缓冲区中剩余的最后一行"""
+        self.done = True
+        line, self.buffer = self.buffer, ""
+        return [line] if line.strip() else []
+
+
+def distribute_tokens(total_tokens, count):
+    """把一批消息的总token数平均分摊到每条消息"""
+    if count <= 0:
+        return []
+    share, remainder = divmod(total_tokens, count)
+    return [share + (1 if i < remainder else 0) for i in range(count)]
+
+
+def encode_message(message, tokens):
+    """把单条消息编码为队列中的二进制帧
+
+    消息内容预先编码为JSON字符串，分发时可以直接拼入WebSocket帧，不需要再解析和序列化
+    """
+    payload = json.dumps(message, ensure_ascii=False).encode("utf-8")
+    header = MESSAGE_HEADER.pack(
+        MESSAGE_FORMAT_VERSION,
+        min(max(0, tokens), MAX_HEADER_VALUE),
+        min(len(message), MAX_HEADER_VALUE)
+    )
+    return header + payload
+
+
+def encode_messages(messages, total_tokens):
+    """把一批消息编码为队列中的二进制帧，总token数平均分摊到每条消息
+
+    Args:
+        messages: 消息内容列表
+        total_tokens: 这批消息消耗的总token数
+    """
+    return [
+        encode_message(message, tokens)
+        for message, tokens in zip(messages, distribute_tokens(total_tokens, len(messages)))
+    ]
+
+
+def decode_message(frame):
+    """解析队列中的消息帧，不解析消息内容
+
+    Returns:
+        (消息内容的JSON字符串, token数, 消息字数)
+    """
+    if frame[:1] == b"{":
+        # 升级前入队的JSON消息
+        data = json.loads(frame)
+        content = data["content"]
+        return json.dumps(content, ensure_ascii=False), data.get("tokens", 0), len(content)
+    if len(frame) < MESSAGE_HEADER.size:
+        raise ValueError("消息帧不完整")
+    version, tokens, length = MESSAGE_HEADER.unpack_from(frame)
+    if version != MESSAGE_FORMAT_VERSION:
+        raise ValueError(f"不支持的消息帧版本: {version}")
+    return frame[MESSAGE_HEADER.size:].decode("utf-8"), tokens, length
+
+
+def estimate_tokens(message):
+    """在没有usage信息时估算消息的token数"""
+    return len(message) // 2 + 1
+
@@ -1,15 +1,29 @@
-import httpx
 import asyncio
-import json
+import httpx
+import itertools
 import time
-import threading
-import concurrent.futures
-from queue import Queue
 from concurrent.futures import ThreadPoolExecutor
 from threading import Lock
 
 from app.core.config import settings
-from app.core.redis_client import redis_client
+from app.services.async_engine import AsyncGenerationEngine
+from app.services.deepseek_common import (
+    COMPLETIONS_PATH,
+    CompletionStreamParser,
+    build_headers,
+    build_request_data,
+    encode_messages,
+    estimate_tokens,
+    split_messages,
+)
+from app.services.backpressure import queue_backpressure
+from app.services.circuit_breaker import circuit_breaker, parse_retry_after
+from app.services.coalescer import generation_coalescer
+from app.services.fallback_corpus import default_message_ticker, fallback_corpus
+from app.services.length_tuner import length_tuner
+from app.services.message_cache import SeenMessages, message_cache
+from app.services.queue_backend import queue_backend
+from app.services.rate_limiter import deepseek_limiter
 
 class DeepSeekService:
     """DeepSeek API服务，负责多线程请求和消息队列管理"""
@@ -18,13 +32,25 @@ class DeepSeekService:
         """初始化服务"""
         self.base_url = settings.DEEPSEEK_BASE_URL
         self.api_key = settings.DEEPSEEK_API_KEY
-        self.thread_count_per_session = 12  # 每个会话的线程数
+        self.thread_count_per_session = settings.WORKERS_PER_SESSION  # 每个会话的线程数（async引擎下为协程数）
+        self.engine = settings.GENERATION_ENGINE  # 生成引擎: thread 或 async
+        self.batch_size = max(1, settings.GENERATION_BATCH_SIZE)  # 每次请求生成的消息条数
+        self.stream = settings.DEEPSEEK_STREAM  # 是否使用流式补全
+        self.coalesce = generation_coalescer.enabled  # 参数相同的会话是否共享生成器
         self.active_sessions = {}  # 存储活跃会话的线程控制标志
+        self.session_epochs = {}  # 每个生成器最近一次启动的编号，共享生成器ID会被复用，线程据此判断自己是否已过期
+        self.epoch_counter = itertools.count(1)
         self.session_executors = {}  # 每个会话独立的线程池
         self.session_threads = {}  # 存储每个会话的线程列表
+        self.session_seen = {}  # 每个会话最近收到的消息，避免缓存重复下发
+        self.session_params = {}  # 每个生成器当前的字数范围 (min_length, max_length)，可就地更新
         self.lock = Lock()  # 用于保护共享资源的锁
+        # 合并模式下的订阅变更在线程池中执行（会争用共享生成器的锁并同步写Redis），按调用顺序逐个进行
+        self.membership_lock = asyncio.Lock()
+        self.membership_tasks = set()  # 事件循环中发起、尚未完成的退订和切换任务
+        self.async_engine = AsyncGenerationEngine(self.base_url, self.api_key)  # 所有会话共享的异步引擎
         
-    async def generate_messages(self, emotion_type, session_id, min_length=5, max_length=15):
+    async def generate_messages(self, emotion_type, session_id, min_length=5, max_length=15, reset_queue=True):
         """生成情绪价值消息并放入Redis队列
         
         Args:
@@ -32,78 +58,220 @@ class DeepSeekService:
             session_id: 会话ID，用于标识Redis队列
             min_length: 最小字数
             max_length: 最大字数
+            reset_queue: 是否清空会话队列，其他节点接手生成时保留已有消息
         """
-        # 队列名称
-        queue_name = f"messages:{session_id}"
+        # 清空可能存在的旧队列，创建计数器（初始化为0）并设置过期时间
+        if reset_queue:
+            await queue_backend.init_session(session_id)
         
-        # 清空可能存在的旧队列
-        redis_client.clear_queue(queue_name)
+        # 合并模式：参数相同的会话订阅同一个共享生成器，只有第一个订阅者需要启动生成
+        if self.api_key and self.coalesce:
+            queue_backpressure.register(session_id)
+            async with self.membership_lock:
+                await self._subscribe(emotion_type, session_id, min_length, max_length)
+            return
         
-        # 创建计数器
-        token_counter = f"tokens:{session_id}"
-        redis_client.increment_counter(token_counter, 0)  # 初始化为0
+        self._start_generator(emotion_type, session_id, min_length, max_length)
+    
+    def _start_generator(self, emotion_type, generator_id, min_length, max_length):
+        """启动一个生成器，生成器ID为会话ID或共享生成器ID
         
+        Args:
+            emotion_type: 用户请求的情绪类型
+            generator_id: 生成器ID
+            min_length: 最小字数
+            max_length: 最大字数
+        """
         # 线程安全地设置会话控制标志
         with self.lock:
-            self.active_sessions[session_id] = True
+            self.active_sessions[generator_id] = True
             
             # 如果已存在该会话的线程池，先关闭它
-            if session_id in self.session_executors:
-                self._cleanup_session_resources(session_id)
+            if generator_id in self.session_executors:
+                self._cleanup_session_resources(generator_id)
+            
+            # 为本次启动分配新的编号，之前以相同ID启动的线程随之退出
+            epoch = self.session_epochs[generator_id] = next(self.epoch_counter)
+            
+            # 会话去重记录、字数范围与队列水位闸门
+            self.session_seen[generator_id] = SeenMessages()
+            self.session_params[generator_id] = (min_length, max_length)
+            queue_backpressure.register(generator_id)
+            
+            # 如果没有配置API密钥，加入共用的预设消息定时器，不为会话创建线程
+            if not self.api_key:
+                print("未配置DeepSeek API密钥，使用预设消息")
+                default_message_ticker.add(generator_id, min_length, max_length)
+                return
+            
+            # async引擎下不为会话创建线程池
+            if self.engine == "async":
+                self.async_engine.start_session(
+                    emotion_type,
+                    generator_id,
+                    min_length,
+                    max_length,
+                    self.thread_count_per_session,
+                    lambda messages, tokens: self._emit(generator_id, messages, tokens),
+                    lambda tokens: self._add_tokens(generator_id, tokens),
+                    self.batch_size,
+                    self.stream,
+                    self.session_seen[generator_id]
+                )
+                return
             
             # 为该会话创建新的线程池
-            self.session_executors[session_id] = ThreadPoolExecutor(
+            self.session_executors[generator_id] = ThreadPoolExecutor(
                 max_workers=self.thread_count_per_session,
-                thread_name_prefix=f"session-{session_id}-"
-            )
-            self.session_threads[session_id] = []
-        
-        # 如果没有配置API密钥，使用预设消息
-        if not self.api_key:
-            print(f"未配置DeepSeek API密钥，使用预设消息")
-            # 启动一个线程循环发送预设消息
-            default_thread = threading.Thread(
-                target=self._send_default_messages,
-                args=(queue_name, token_counter, session_id, min_length, max_length),
-                daemon=True,
-                name=f"default-{session_id}"
+                thread_name_prefix=f"session-{generator_id}-"
             )
-            default_thread.start()
-            
-            # 记录线程
-            with self.lock:
-                self.session_threads[session_id].append(default_thread)
-            return
-        
+            self.session_threads[generator_id] = []
+
         # 启动多个线程请求DeepSeek API
         with self.lock:
-            executor = self.session_executors.get(session_id)
+            executor = self.session_executors.get(generator_id)
             if executor:
                 for i in range(self.thread_count_per_session):
-                    future = executor.submit(
+                    executor.submit(
                         self._request_deepseek_api,
                         emotion_type,
-                        queue_name,
-                        token_counter,
-                        session_id,
+                        generator_id,
+                        epoch,
                         i,
                         min_length,
                         max_length
                     )
     
+    async def _subscribe(self, emotion_type, session_id, min_length, max_length):
+        """订阅共享生成器，新创建时启动生成"""
+        # 必须在获取membership_lock的情况下调用此方法
+        generator_id, created = await asyncio.to_thread(
+            generation_coalescer.subscribe, session_id, emotion_type, min_length, max_length
+        )
+        if created:
+            self._start_generator(emotion_type, generator_id, min_length, max_length)
+    
+    async def _switch_group(self, emotion_type, session_id, min_length, max_length):
+        """改为订阅新参数对应的共享生成器，旧的共享生成器没有订阅者时停止"""
+        async with self.membership_lock:
+            current = generation_coalescer.session_groups.get(session_id)
+            if current is None or current == generation_coalescer.group_key(emotion_type, min_length, max_length):
+                # 会话已结束，或参数对应的仍是同一个共享生成器
+                return
+            group_id, remaining = await asyncio.to_thread(generation_coalescer.unsubscribe, session_id)
+            if group_id is None:
+                return
+            if not remaining:
+                self._stop_generator(group_id)
+            await self._subscribe(emotion_type, session_id, min_length, max_length)
+    
+    async def _leave_group(self, session_id):
+        """退订共享生成器，最后一个订阅者离开时停止它"""
+        async with self.membership_lock:
+            group_id, remaining = await asyncio.to_thread(generation_coalescer.unsubscribe, session_id)
+            self._finish_leave(session_id, group_id, remaining)
+    
+    def _finish_leave(self, session_id, group_id, remaining):
+        """退订后停止会话自己的生成器，或在没有剩余订阅者时停止共享生成器"""
+        if group_id is not None:
+            queue_backpressure.unregister(session_id)
+            if remaining:
+                return
+            session_id = group_id
+        self._stop_generator(session_id)
+    
+    def _run_membership(self, coro):
+        """在事件循环中后台执行订阅变更，不阻塞调用方
+        
+        Returns:
+            是否已交给后台任务，不在事件循环中时返回False，由调用方同步处理
+        """
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            coro.close()
+            return False
+        task = loop.create_task(self._log_membership_errors(coro))
+        self.membership_tasks.add(task)
+        task.add_done_callback(self.membership_tasks.discard)
+        return True
+    
+    @staticmethod
+    async def _log_membership_errors(coro):
+        try:
+            await coro
+        except Exception as e:
+            print(f"更新共享生成器订阅发生异常: {str(e)}")
+    
+    def update_params(self, emotion_type, session_id, min_length, max_length):
+        """就地更新会话的字数范围，不创建新会话、不重启生成线程
+        
+        生成线程/协程在下一轮请求前读取新的字数范围；已在队列中的旧消息由分发端按新范围过滤
+        
+        Args:
+            emotion_type: 用户请求的情绪类型
+            session_id: 会话ID
+            min_length: 新的最小字数
+            max_length: 新的最大字数
+        """
+        # 合并模式下改为订阅新参数对应的共享生成器，由后台任务完成，不阻塞事件循环
+        if self.api_key and self.coalesce:
+            if self._run_membership(self._switch_group(emotion_type, session_id, min_length, max_length)):
+                return
+            group_id, remaining = generation_coalescer.unsubscribe(session_id)
+            if group_id is not None:
+                if not remaining:
+                    self._stop_generator(group_id)
+                generator_id, created = generation_coalescer.subscribe(session_id, emotion_type, min_length, max_length)
+                if created:
+                    self._start_generator(emotion_type, generator_id, min_length, max_length)
+                return
+        
+        with self.lock:
+            if not self.active_sessions.get(session_id):
+                return
+            self.session_params[session_id] = (min_length, max_length)
+        self.async_engine.update_session(session_id, min_length, max_length)
+        default_message_ticker.update(session_id, min_length, max_length)
+        print(f"[会话 {session_id}] 字数范围已更新为 {min_length}-{max_length} 字")
+    
     def stop_generation(self, session_id):
         """停止指定会话的消息生成
         
         Args:
             session_id: 会话ID
         """
+        # 合并模式下先退订，最后一个订阅者离开时才停止共享生成器；在事件循环中调用时由后台任务完成
+        if self.api_key and self.coalesce and self._run_membership(self._leave_group(session_id)):
+            return
+        self._finish_leave(session_id, *generation_coalescer.unsubscribe(session_id))
+    
+    def _stop_generator(self, generator_id):
+        """停止生成器并清理其资源"""
         with self.lock:
-            if session_id in self.active_sessions:
-                self.active_sessions[session_id] = False
-                print(f"已停止会话 {session_id} 的消息生成")
+            if generator_id in self.active_sessions:
+                self.active_sessions[generator_id] = False
+                print(f"已停止会话 {generator_id} 的消息生成")
                 
                 # 清理会话资源
-                self._cleanup_session_resources(session_id)
+                self._cleanup_session_resources(generator_id)
+    
+    def active_generators(self):
+        """返回正在运行的生成器ID列表（会话ID或共享生成器ID）"""
+        with self.lock:
+            return [generator_id for generator_id, active in self.active_sessions.items() if active]
+    
+    def _is_session_active(self, session_id, epoch=None):
+        """线程安全地检查会话是否仍然活跃
+        
+        Args:
+            session_id: 会话ID或共享生成器ID
+            epoch: 生成线程所属的启动编号，生成器停止后以相同ID重新启动时，旧线程不再视为活跃
+        """
+        with self.lock:
+            if epoch is not None and self.session_epochs.get(session_id) != epoch:
+                return False
+            return self.active_sessions.get(session_id, False)
     
     def _cleanup_session_resources(self, session_id):
         """清理会话相关的资源
@@ -112,6 +280,10 @@ class DeepSeekService:
             session_id: 会话ID
         """
         # 必须在获取锁的情况下调用此方法
+        if self.async_engine.stop_session(session_id):
+            print(f"已取消会话 {session_id} 的异步请求协程")
+        default_message_ticker.remove(session_id)
+        
         if session_id in self.session_executors:
             try:
                 # 尝试关闭线程池
@@ -125,77 +297,120 @@ class DeepSeekService:
         # 移除会话线程记录
         if session_id in self.session_threads:
             del self.session_threads[session_id]
+        self.session_seen.pop(session_id, None)
+        self.session_params.pop(session_id, None)
+        self.session_epochs.pop(session_id, None)
+        
+        # 移除水位闸门，唤醒挂起的生成线程让其退出
+        queue_backpressure.unregister(session_id)
     
-    def _send_default_messages(self, queue_name, token_counter, session_id, min_length, max_length):
-        """发送预设消息到Redis队列
+    def _emit(self, generator_id, messages, tokens):
+        """把生成器产出的一批消息交给下游
         
-        Args:
-            queue_name: Redis队列名称
-            token_counter: Token计数器名称
-            session_id: 会话ID
-            min_length: 最小字数
-            max_length: 最大字数
+        共享生成器扇出给所有订阅者；普通会话原子地更新token计数并把整批消息放入会话队列
         """
-        # 线程局部变量，确保独立性
-        thread_queue_name = str(queue_name)
-        thread_token_counter = str(token_counter)
-        thread_session_id = str(session_id)
-        thread_min_length = int(min_length)
-        thread_max_length = int(max_length)
+        if generation_coalescer.is_group(generator_id):
+            generation_coalescer.publish(generator_id, messages, tokens)
+            return
+        queue_length = queue_backend.enqueue(generator_id, encode_messages(messages, tokens), tokens)
+        queue_backpressure.on_enqueued(generator_id, queue_length)
+    
+    def _add_tokens(self, generator_id, tokens):
+        """补记流式请求结束时usage给出的token差额，共享生成器不补记"""
+        if not generation_coalescer.is_group(generator_id):
+            queue_backend.add_tokens(generator_id, tokens)
+    
+    def _emit_fallback(self, session_id, thread_id, emotion_type, min_length, max_length):
+        """API不可用时用一条预设消息代替"""
+        # 使用线程ID和时间戳确保每个线程获取不同的消息
+        message = fallback_corpus.pick(min_length, max_length, int(time.time()) + thread_id)
         
-        message_index = 0
+        # 更新token计数并将消息放入Redis队列
+        self._emit(session_id, [message], estimate_tokens(message))
         
-        print(f"[会话 {thread_session_id} 预设消息] 开始发送预设消息 ({thread_min_length}-{thread_max_length} 字)")
+        print(f"[会话 {session_id} 线程 {thread_id}] 使用预设消息 '{emotion_type}': {message}")
+    
+    def _post_completion(self, client, headers, request_data):
+        """以普通方式请求补全，并把结果反馈给限流器和熔断器
         
-        # 过滤符合长度要求的预设消息
-        filtered_messages = [msg for msg in settings.DEFAULT_MESSAGES if thread_min_length <= len(msg) <= thread_max_length]
+        Returns:
+            (状态码, 补全文本或错误信息, 总token数)
+        """
+        request_start = time.monotonic()
+        try:
+            response = client.post(
+                f"{self.base_url}{COMPLETIONS_PATH}",
+                headers=headers,
+                json=request_data
+            )
+        except Exception:
+            deepseek_limiter.release(latency=time.monotonic() - request_start, error=True)
+            circuit_breaker.record(error=True)
+            raise
+        deepseek_limiter.release(response.status_code, time.monotonic() - request_start)
+        circuit_breaker.record(response.status_code, retry_after=parse_retry_after(response.headers.get("Retry-After")))
         
-        # 如果没有符合要求的消息，使用原始列表
-        if not filtered_messages:
-            filtered_messages = settings.DEFAULT_MESSAGES
-            print(f"[会话 {thread_session_id} 预设消息] 警告: 没有符合长度要求的预设消息，使用全部消息")
-        else:
-            print(f"[会话 {thread_session_id} 预设消息] 找到 {len(filtered_messages)} 条符合要求的预设消息")
+        if response.status_code != 200:
+            return response.status_code, response.text, None
         
-        # 安全地检查会话状态
-        while True:
-            is_active = False
-            with self.lock:
-                is_active = self.active_sessions.get(thread_session_id, False)
-            
-            if not is_active:
-                print(f"[会话 {thread_session_id} 预设消息] 会话已停止，退出发送循环")
-                break
-                
-            # 从预设消息中选择一条
-            message = filtered_messages[message_index % len(filtered_messages)]
-            message_index += 1
-            
-            # 计算token数并更新计数器
-            message_tokens = len(message) // 2 + 1
-            redis_client.increment_counter(thread_token_counter, message_tokens)
-            
-            # 将消息放入Redis队列
-            redis_client.push_message(thread_queue_name, json.dumps({
-                "content": message,
-                "tokens": message_tokens
-            }))
-            
-            print(f"[会话 {thread_session_id} 预设消息] 发送: {message} (tokens: {message_tokens})")
-            
-            # 控制生成速率，降低密度
-            time.sleep(1.5 / settings.MESSAGES_PER_SECOND)
+        result = response.json()
+        content = result["choices"][0]["message"]["content"].strip()
+        tokens = result.get("usage", {}).get("total_tokens", estimate_tokens(content))
+        return response.status_code, content, tokens
+    
+    def _stream_completion(self, client, headers, request_data, session_id, epoch, on_lines):
+        """以SSE流式请求补全，每完成一行就交给on_lines处理
+        
+        会话停止时立即退出读取，关闭连接让上游停止生成
         
-        print(f"[会话 {thread_session_id} 预设消息] 预设消息生成线程已结束")
+        Returns:
+            (状态码, 错误信息, usage给出的总token数)
+        """
+        request_start = time.monotonic()
+        released = False
+        try:
+            with client.stream(
+                "POST",
+                f"{self.base_url}{COMPLETIONS_PATH}",
+                headers=headers,
+                json=request_data
+            ) as response:
+                # 以首字节耗时作为限流器的延迟信号
+                deepseek_limiter.release(response.status_code, time.monotonic() - request_start)
+                circuit_breaker.record(response.status_code, retry_after=parse_retry_after(response.headers.get("Retry-After")))
+                released = True
+                
+                if response.status_code != 200:
+                    response.read()
+                    return response.status_code, response.text, None
+                
+                parser = CompletionStreamParser()
+                for raw_line in response.iter_lines():
+                    if not self._is_session_active(session_id, epoch):
+                        break
+                    lines = parser.feed(raw_line)
+                    if lines:
+                        on_lines(lines)
+                    if parser.done:
+                        break
+                else:
+                    lines = parser.finish()
+                    if lines:
+                        on_lines(lines)
+                return response.status_code, None, parser.total_tokens
+        except Exception:
+            if not released:
+                deepseek_limiter.release(latency=time.monotonic() - request_start, error=True)
+                circuit_breaker.record(error=True)
+            raise
     
-    def _request_deepseek_api(self, emotion_type, queue_name, token_counter, session_id, thread_id, min_length, max_length):
+    def _request_deepseek_api(self, emotion_type, session_id, epoch, thread_id, min_length, max_length):
         """请求DeepSeek API生成情绪价值消息
         
         Args:
             emotion_type: 用户请求的情绪类型
-            queue_name: Redis队列名称
-            token_counter: Token计数器名称
-            session_id: 会话ID
+            session_id: 会话ID或共享生成器ID
+            epoch: 生成器的启动编号，与当前编号不一致时线程退出
             thread_id: 线程ID，用于日志
             min_length: 最小字数
             max_length: 最大字数
@@ -205,8 +420,6 @@ class DeepSeekService:
         thread_min_length = int(min_length)
         thread_max_length = int(max_length)
         thread_session_id = str(session_id)
-        thread_queue_name = str(queue_name)
-        thread_token_counter = str(token_counter)
         
         print(f"[会话 {thread_session_id} 线程 {thread_id}] 开始生成 '{thread_emotion_type}' 类型消息 ({thread_min_length}-{thread_max_length} 字)")
         
@@ -214,107 +427,129 @@ class DeepSeekService:
         client = httpx.Client(timeout=30.0)
         
         # 构建请求头
-        headers = {
-            "Content-Type": "application/json",
-            "Authorization": f"Bearer {self.api_key}"
-        }
+        headers = build_headers(self.api_key)
+        
+        # 该会话已收到的消息
+        with self.lock:
+            seen = self.session_seen.get(thread_session_id) or SeenMessages()
+        
+        # 连续失败次数，决定重试前的退避时间
+        failures = 0
         
         # 持续请求，直到会话结束
         while True:
-            # 安全地检查会话状态
-            is_active = False
-            with self.lock:
-                is_active = self.active_sessions.get(thread_session_id, False)
+            # 队列达到高水位时挂起，直到分发端消费到低水位
+            queue_backpressure.wait(thread_session_id)
             
-            if not is_active:
+            # 安全地检查会话状态，生成器已停止或已以相同ID重新启动时退出
+            if not self._is_session_active(thread_session_id, epoch):
                 print(f"[会话 {thread_session_id} 线程 {thread_id}] 会话已停止，退出生成循环")
                 break
+            
+            # 字数范围可能已被就地更新，每轮开始时重新读取
+            with self.lock:
+                thread_min_length, thread_max_length = self.session_params.get(
+                    thread_session_id, (thread_min_length, thread_max_length)
+                )
+            
+            # 优先从共享缓存取消息，缓存中没有该会话未收到过的消息时才请求API补充
+            cached = message_cache.draw(thread_emotion_type, thread_min_length, thread_max_length, self.batch_size, seen)
+            if cached:
+                messages = [message for message, _ in cached]
+                self._emit(thread_session_id, messages, sum(tokens for _, tokens in cached))
+                seen.add(messages)
+                print(f"[会话 {thread_session_id} 线程 {thread_id}] 缓存命中 {len(messages)} 条 '{thread_emotion_type}' 消息: {' / '.join(messages)}")
+                time.sleep(1)
+                continue
+            
+            # 熔断器打开时不请求上游，直接使用预设消息
+            if not circuit_breaker.allow():
+                self._emit_fallback(thread_session_id, thread_id, thread_emotion_type, thread_min_length, thread_max_length)
+                time.sleep(circuit_breaker.backoff(0))
+                continue
+            
+            # 获取全局请求预算，会话停止时放弃等待
+            if not deepseek_limiter.acquire(lambda: self._is_session_active(thread_session_id, epoch)):
+                circuit_breaker.release_probe()
+                continue
                 
             try:
                 # 在每次请求时重新构建提示词，确保使用当前线程的参数
-                current_prompt = f"""请以朋友的口吻，生成一句能给人{thread_emotion_type}情绪价值的暖心话语，要求：
-1. 字数在{thread_min_length}-{thread_max_length}之间
-2. 语气真诚温暖，像朋友间的鼓励
-3. 表达自然流畅，有共情和理解
-4. 不要使用标点符号
-5. 直接输出内容，不要有任何前缀或解释
-"""
+                request_data = build_request_data(
+                    thread_emotion_type,
+                    thread_min_length,
+                    thread_max_length,
+                    self.batch_size,
+                    self.stream,
+                    **length_tuner.params(thread_min_length, thread_max_length)
+                )
                 
-                # 每次请求都构建新的数据对象，避免引用共享
-                request_data = {
-                    "model": "deepseek-chat",
-                    "messages": [{"role": "user", "content": current_prompt}],
-                    "temperature": 0.8,
-                    "max_tokens": 50
-                }
+                # 本次请求入队的消息数与按估算计入的token数
+                produced = {"messages": 0, "tokens": 0}
                 
-                # 发送请求
-                response = client.post(
-                    f"{self.base_url}/v1/chat/completions",
-                    headers=headers,
-                    json=request_data
-                )
+                def accept(lines, tokens=None):
+                    # 按行拆分并过滤不符合长度要求的消息
+                    messages, rejected = split_messages("\n".join(lines), thread_min_length, thread_max_length)
+                    length_tuner.record(thread_min_length, thread_max_length, messages, rejected)
+                    for message in rejected:
+                        print(f"[会话 {thread_session_id} 线程 {thread_id}] 消息长度不符合要求 ({len(message)} 字): {message}")
+                    if not messages:
+                        return
+                    if tokens is None:
+                        tokens = sum(estimate_tokens(message) for message in messages)
+                    self._emit(thread_session_id, messages, tokens)
+                    seen.add(messages)
+                    message_cache.put(thread_emotion_type, messages, tokens)
+                    produced["messages"] += len(messages)
+                    produced["tokens"] += tokens
+                    print(f"[会话 {thread_session_id} 线程 {thread_id}] 成功生成 {len(messages)} 条 '{thread_emotion_type}' 消息: {' / '.join(messages)} (tokens: {tokens})")
+                
+                if self.stream:
+                    # 流式请求：每完成一行立即入队，结束后按usage补齐token计数
+                    status_code, error_text, total_tokens = self._stream_completion(
+                        client, headers, request_data, thread_session_id, epoch, accept
+                    )
+                    if produced["messages"] and total_tokens and total_tokens > produced["tokens"]:
+                        self._add_tokens(thread_session_id, total_tokens - produced["tokens"])
+                else:
+                    status_code, content, total_tokens = self._post_completion(client, headers, request_data)
+                    error_text = content
+                    if status_code == 200:
+                        accept([content], total_tokens)
                 
                 # 检查响应状态
-                if response.status_code == 200:
-                    result = response.json()
-                    message = result["choices"][0]["message"]["content"].strip()
-                    tokens = result.get("usage", {}).get("total_tokens", len(message) // 2 + 1)
-                    
-                    # 过滤不符合长度要求的消息
-                    if thread_min_length <= len(message) <= thread_max_length:
-                        # 更新token计数
-                        redis_client.increment_counter(thread_token_counter, tokens)
-                        
-                        # 将消息放入Redis队列
-                        redis_client.push_message(thread_queue_name, json.dumps({
-                            "content": message,
-                            "tokens": tokens
-                        }))
-                        
-                        print(f"[会话 {thread_session_id} 线程 {thread_id}] 成功生成 '{thread_emotion_type}' 消息: {message} (tokens: {tokens})")
-                        
-                        ime.sleep(1)
-                        # 成功生成消息后立即继续，不延迟
+                if status_code == 200:
+                    failures = 0
+                    if produced["messages"]:
+                        time.sleep(1)
                         continue
                     else:
-                        print(f"[会话 {thread_session_id} 线程 {thread_id}] 消息长度不符合要求 ({len(message)} 字): {message}")
                         # 长度不符合要求，短暂延迟后重试
                         time.sleep(0.5)
                 else:
-                    print(f"[会话 {thread_session_id} 线程 {thread_id}] API请求失败: {response.status_code} {response.text}")
+                    print(f"[会话 {thread_session_id} 线程 {thread_id}] API请求失败: {status_code} {error_text}")
                     # 如果API请求失败，使用预设消息
-                    filtered_messages = [msg for msg in settings.DEFAULT_MESSAGES if thread_min_length <= len(msg) <= thread_max_length]
-                    if not filtered_messages:
-                        filtered_messages = settings.DEFAULT_MESSAGES
-                    
-                    # 使用线程ID和时间戳确保每个线程获取不同的消息
-                    message_index = (int(time.time()) + thread_id) % len(filtered_messages)
-                    message = filtered_messages[message_index]
-                    tokens = len(message) // 2 + 1
-                    
-                    # 更新token计数
-                    redis_client.increment_counter(thread_token_counter, tokens)
+                    self._emit_fallback(thread_session_id, thread_id, thread_emotion_type, thread_min_length, thread_max_length)
                     
-                    # 将消息放入Redis队列
-                    redis_client.push_message(thread_queue_name, json.dumps({
-                        "content": message,
-                        "tokens": tokens
-                    }))
-                    
-                    print(f"[会话 {thread_session_id} 线程 {thread_id}] 使用预设消息 '{thread_emotion_type}': {message}")
-                    
-                    # API失败后短暂延迟再重试
-                    time.sleep(1.0)
+                    # API失败后按指数退避（带抖动）再重试，避免所有线程同时重试
+                    time.sleep(circuit_breaker.backoff(failures))
+                    failures += 1
             
             except Exception as e:
                 print(f"[会话 {thread_session_id} 线程 {thread_id}] 发生异常: {str(e)}")
-                # 异常情况下延迟重试
-                time.sleep(2.0)
+                # 异常情况下按指数退避（带抖动）再重试
+                time.sleep(circuit_breaker.backoff(failures + 1))
+                failures += 1
         
         # 关闭HTTP客户端
         client.close()
         print(f"[会话 {thread_session_id} 线程 {thread_id}] '{thread_emotion_type}' 类型消息生成线程已结束")
 
+    async def close(self):
+        """关闭服务持有的共享资源"""
+        if self.membership_tasks:
+            await asyncio.gather(*self.membership_tasks, return_exceptions=True)
+        await self.async_engine.close()
+
 # 创建全局服务实例
 deepseek_service = DeepSeekService()
@@ -0,0 +1,245 @@
+import mmap
+import os
+import random
+import threading
+import time
+from array import array
+
+from app.core.config import settings
+from app.services.backpressure import queue_backpressure
+from app.services.deepseek_common import encode_message, estimate_tokens
+from app.services.queue_backend import queue_backend
+
+class FallbackCorpus:
+    """预设语句库，进程内只加载一次，并按字数建立索引
+
+    语句按字数排序存放，index_start[n]为第一条字数不小于n的语句位置，
+    因此任意字数范围对应一段连续区间，取用是O(1)的。
+    开启mmap时只保存每条语句在文件中的字节偏移，取用时再解码，大语料也不会常驻为Python字符串。
+    """
+
+    def __init__(self, path, use_mmap=False):
+        """初始化语句库
+
+        Args:
+            path: 语句文件路径，每行一句，以#开头的行为注释
+            use_mmap: 是否以mmap方式读取语句文件
+        """
+        self.path = path
+        self.use_mmap = use_mmap
+        self.loaded = False
+        self.lock = threading.Lock()
+        self.phrases = []  # 非mmap模式下按字数排序的语句
+        self.buffer = None  # mmap模式下的文件映射
+        self.starts = array("Q")  # mmap模式下按字数排序的语句字节偏移
+        self.ends = array("Q")
+        self.index_start = [0]
+        self.max_length = 0
+
+    def _ensure_loaded(self):
+        if self.loaded:
+            return
+        with self.lock:
+            if not self.loaded:
+                self._load()
+                self.loaded = True
+
+    def _load(self):
+        """读取语句文件并建立字数索引，文件不存在时使用配置中的预设消息"""
+        records = []  # (字数, 语句或字节偏移)
+        try:
+            with open(self.path, "rb") as f:
+                if self.use_mmap:
+                    self.buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                    data = self.buffer
+                else:
+                    data = f.read()
+            position = 0
+            size = len(data)
+            while position < size:
+                end = data.find(b"\n", position)
+                if end == -1:
+                    end = size
+                line = data[position:end].decode("utf-8").strip()
+                if line and not line.startswith("#"):
+                    if self.use_mmap:
+                        # 记录去掉首尾空白后的字节区间
+                        raw = data[position:end]
+                        start = position + (len(raw) - len(raw.lstrip()))
+                        records.append((len(line), (start, start + len(line.encode("utf-8")))))
+                    else:
+                        records.append((len(line), line))
+                position = end + 1
+        except OSError as e:
+            print(f"无法读取预设语句文件 {self.path}: {str(e)}，使用内置预设消息")
+            self.use_mmap = False
+            self.buffer = None
+
+        if not records:
+            self.use_mmap = False
+            records = [(len(message), message) for message in settings.DEFAULT_MESSAGES]
+
+        records.sort(key=lambda record: record[0])
+        if self.use_mmap:
+            for _, (start, end) in records:
+                self.starts.append(start)
+                self.ends.append(end)
+        else:
+            self.phrases = [phrase for _, phrase in records]
+
+        # index_start[n]: 第一条字数>=n的语句位置
+        self.max_length = records[-1][0]
+        self.index_start = [0] * (self.max_length + 2)
+        position = 0
+        for length in range(self.max_length + 2):
+            while position < len(records) and records[position][0] < length:
+                position += 1
+            self.index_start[length] = position
+        print(f"已加载 {len(records)} 条预设语句（{'mmap' if self.use_mmap else '内存'}模式）")
+
+    def __len__(self):
+        self._ensure_loaded()
+        return self.index_start[-1]
+
+    def _phrase(self, position):
+        if self.use_mmap:
+            return self.buffer[self.starts[position]:self.ends[position]].decode("utf-8")
+        return self.phrases[position]
+
+    def _range(self, min_length, max_length):
+        """字数范围对应的语句区间，没有符合要求的语句时返回全部语句"""
+        top = self.max_length + 1
+        start = self.index_start[min(max(min_length, 0), top)]
+        end = self.index_start[min(max(max_length + 1, 0), top)]
+        if end <= start:
+            return 0, len(self)
+        return start, end
+
+    def count(self, min_length, max_length):
+        """字数范围内的语句数"""
+        self._ensure_loaded()
+        start, end = self._range(min_length, max_length)
+        return end - start
+
+    def pick(self, min_length, max_length, index=None):
+        """从字数范围内取一条语句
+
+        Args:
+            min_length: 最小字数
+            max_length: 最大字数
+            index: 指定时按序号轮流取用，否则随机取用
+        """
+        self._ensure_loaded()
+        start, end = self._range(min_length, max_length)
+        offset = random.randrange(end - start) if index is None else index % (end - start)
+        return self._phrase(start + offset)
+
+
+class DefaultMessageTicker:
+    """预设消息模式下所有会话共用的定时器
+
+    一个线程按固定间隔为所有会话各取一条预设语句，一次管道写入所有会话的队列，
+    不再为每个会话单独启动一个休眠线程。没有会话时线程挂起等待。
+    """
+
+    def __init__(self, corpus):
+        """初始化定时器
+
+        Args:
+            corpus: 预设语句库
+        """
+        self.corpus = corpus
+        self.interval = 1.5 / settings.MESSAGES_PER_SECOND
+        self.sessions = {}  # session_id -> {"min_length", "max_length", "index"}
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.thread = None
+        self.stats = {
+            "ticks": 0,
+            "messages": 0,
+        }
+
+    def add(self, session_id, min_length, max_length):
+        """加入一个预设消息会话"""
+        with self.lock:
+            self.sessions[session_id] = {
+                "min_length": min_length,
+                "max_length": max_length,
+                "index": random.randrange(1 << 16),
+            }
+            self.wakeup.set()
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self._run, daemon=True, name="default-message-ticker")
+                self.thread.start()
+        print(f"[会话 {session_id} 预设消息] 开始发送预设消息 ({min_length}-{max_length} 字)，"
+              f"找到 {self.corpus.count(min_length, max_length)} 条符合要求的预设消息")
+
+    def update(self, session_id, min_length, max_length):
+        """就地更新会话的字数范围，下一次定时写入时生效"""
+        with self.lock:
+            state = self.sessions.get(session_id)
+            if state is None:
+                return False
+            state["min_length"] = min_length
+            state["max_length"] = max_length
+        return True
+
+    def remove(self, session_id):
+        """移除一个预设消息会话"""
+        with self.lock:
+            removed = self.sessions.pop(session_id, None) is not None
+            if not self.sessions:
+                self.wakeup.clear()
+        return removed
+
+    def _run(self):
+        while True:
+            # 没有会话时挂起，直到有新会话加入
+            self.wakeup.wait()
+            try:
+                self._tick()
+            except Exception as e:
+                print(f"预设消息定时器发生异常: {str(e)}")
+            time.sleep(self.interval)
+
+    def _tick(self):
+        """为每个未暂停的会话写入一条预设语句"""
+        with self.lock:
+            batch = []
+            for session_id, state in self.sessions.items():
+                if queue_backpressure.is_paused(session_id):
+                    continue
+                message = self.corpus.pick(state["min_length"], state["max_length"], state["index"])
+                state["index"] += 1
+                batch.append((session_id, message))
+        if not batch:
+            return
+
+        batches = []
+        for session_id, message in batch:
+            tokens = estimate_tokens(message)
+            batches.append((session_id, [encode_message(message, tokens)], tokens))
+        results = queue_backend.enqueue_many(batches)
+        for (session_id, _), queue_length in zip(batch, results):
+            queue_backpressure.on_enqueued(session_id, queue_length)
+
+        with self.lock:
+            self.stats["ticks"] += 1
+            self.stats["messages"] += len(batch)
+
+    def snapshot(self):
+        """返回定时器状态，用于监控"""
+        with self.lock:
+            return {
+                "sessions": len(self.sessions),
+                "interval": round(self.interval, 3),
+                "corpus_size": len(self.corpus) if self.corpus.loaded else None,
+                **self.stats,
+            }
+
+
+DEFAULT_CORPUS_PATH = os.path.join(os.path.dirname(os.path.dirname(__file__)), "data", "fallback_phrases.txt")
+
+# 创建全局预设语句库和定时器实例
+fallback_corpus = FallbackCorpus(settings.FALLBACK_CORPUS_PATH or DEFAULT_CORPUS_PATH, settings.FALLBACK_CORPUS_MMAP)
+default_message_ticker = DefaultMessageTicker(fallback_corpus)
@@ -0,0 +1,205 @@
+import math
+import threading
+from collections import Counter, OrderedDict
+
+from app.core.config import settings
+from app.services.deepseek_common import MAX_TOKENS_PER_MESSAGE, estimate_tokens
+
+# 默认采样温度，放宽调节时向它回归
+BASE_TEMPERATURE = 0.8
+MIN_TEMPERATURE = 0.3
+
+
+class RangeTuning:
+    """单个字数范围的长度统计和当前的请求参数"""
+
+    def __init__(self, min_length, max_length):
+        self.min_length = min_length
+        self.max_length = max_length
+        self.accepted = 0
+        self.rejected_short = 0
+        self.rejected_long = 0
+        self.wasted_tokens = 0  # 被过滤掉的输出按估算消耗的token数
+        self.lengths = Counter()  # 输出字数分布
+        self.window = {"accepted": 0, "short": 0, "long": 0}  # 当前调节窗口内的计数
+
+        self.max_tokens_per_message = MAX_TOKENS_PER_MESSAGE
+        self.temperature = BASE_TEMPERATURE
+        self.strictness = 0  # 提示词中字数要求的强调程度，0为原始提示词
+        self.bias = None  # 最近一次调节时输出偏 short 还是 long
+        self.adjustments = 0
+
+    @property
+    def min_max_tokens(self):
+        # 中文约1字1token以内，低于最大字数时会把合格的句子截断
+        return max(10, self.max_length)
+
+    @property
+    def max_max_tokens(self):
+        return max(MAX_TOKENS_PER_MESSAGE * 2, self.max_length * 2)
+
+    def length_hint(self):
+        """按当前强调程度生成提示词中额外的字数要求"""
+        if self.strictness == 0:
+            return ""
+        hint = f"字数要求很重要：每句必须是{self.min_length}-{self.max_length}个字，输出前请逐字数一遍"
+        if self.strictness >= 2 and self.bias == "long":
+            hint += f"，之前的输出普遍偏长，请控制在{self.max_length}字以内"
+        elif self.strictness >= 2 and self.bias == "short":
+            hint += f"，之前的输出普遍偏短，请至少写{self.min_length}个字"
+        return hint
+
+    def percentile(self, fraction):
+        total = sum(self.lengths.values())
+        if not total:
+            return None
+        threshold = total * fraction
+        seen = 0
+        for length in sorted(self.lengths):
+            seen += self.lengths[length]
+            if seen >= threshold:
+                return length
+        return None
+
+
+class LengthTuner:
+    """统计每个字数范围的输出长度和被过滤的比例，并自动调整请求参数
+
+    每个调节窗口结束时，接受率低于目标则收紧：输出偏长时降低温度和max_tokens，
+    偏短时提高max_tokens，同时在提示词中加重字数要求；接受率明显高于目标时逐步放宽回默认参数。
+    """
+
+    def __init__(self):
+        """初始化调节器"""
+        self.enabled = settings.LENGTH_TUNING_ENABLED
+        self.target = settings.LENGTH_ACCEPT_TARGET
+        self.window_size = max(1, settings.LENGTH_TUNING_WINDOW)
+        self.max_ranges = 1000  # 最多保留的字数范围，超出时淘汰最久未用的
+        self.ranges = OrderedDict()  # (min_length, max_length) -> RangeTuning
+        self.lock = threading.Lock()
+
+    def _get(self, min_length, max_length):
+        # 必须在获取锁的情况下调用此方法
+        key = (min_length, max_length)
+        tuning = self.ranges.get(key)
+        if tuning is None:
+            tuning = self.ranges[key] = RangeTuning(min_length, max_length)
+            if len(self.ranges) > self.max_ranges:
+                self.ranges.popitem(last=False)
+        else:
+            self.ranges.move_to_end(key)
+        return tuning
+
+    def params(self, min_length, max_length):
+        """字数范围当前的请求参数，供build_request_data使用"""
+        if not self.enabled:
+            return {}
+        with self.lock:
+            tuning = self._get(min_length, max_length)
+            return {
+                "max_tokens_per_message": tuning.max_tokens_per_message,
+                "temperature": tuning.temperature,
+                "length_hint": tuning.length_hint(),
+            }
+
+    def record(self, min_length, max_length, accepted, rejected):
+        """记录一次请求输出的过滤结果
+
+        Args:
+            min_length: 最小字数
+            max_length: 最大字数
+            accepted: 通过长度过滤的消息列表
+            rejected: 被过滤掉的消息列表
+        """
+        if not accepted and not rejected:
+            return
+        with self.lock:
+            tuning = self._get(min_length, max_length)
+            for message in accepted:
+                tuning.lengths[len(message)] += 1
+            for message in rejected:
+                tuning.lengths[len(message)] += 1
+                tuning.wasted_tokens += estimate_tokens(message)
+                side = "short" if len(message) < min_length else "long"
+                tuning.window[side] += 1
+                if side == "short":
+                    tuning.rejected_short += 1
+                else:
+                    tuning.rejected_long += 1
+            tuning.accepted += len(accepted)
+            tuning.window["accepted"] += len(accepted)
+
+            if sum(tuning.window.values()) >= self.window_size:
+                self._adjust(tuning)
+
+    def _adjust(self, tuning):
+        """按窗口内的接受率调整请求参数"""
+        # 必须在获取锁的情况下调用此方法
+        window = tuning.window
+        rate = window["accepted"] / sum(window.values())
+        tuning.window = {"accepted": 0, "short": 0, "long": 0}
+        if not self.enabled:
+            return
+
+        before = (tuning.max_tokens_per_message, tuning.temperature, tuning.strictness)
+        if rate < self.target:
+            tuning.bias = "long" if window["long"] >= window["short"] else "short"
+            tuning.strictness = min(2, tuning.strictness + 1)
+            if tuning.bias == "long":
+                tuning.temperature = max(MIN_TEMPERATURE, round(tuning.temperature - 0.1, 2))
+                tuning.max_tokens_per_message = max(tuning.min_max_tokens, int(tuning.max_tokens_per_message * 0.85))
+            else:
+                tuning.max_tokens_per_message = min(tuning.max_max_tokens, math.ceil(tuning.max_tokens_per_message * 1.25))
+        elif rate >= min(1.0, self.target + 0.1):
+            # 接受率有余量时逐步回到默认参数，保持输出的多样性
+            tuning.strictness = max(0, tuning.strictness - 1)
+            tuning.temperature = min(BASE_TEMPERATURE, round(tuning.temperature + 0.05, 2))
+            if tuning.max_tokens_per_message < MAX_TOKENS_PER_MESSAGE:
+                tuning.max_tokens_per_message = min(MAX_TOKENS_PER_MESSAGE, tuning.max_tokens_per_message + 5)
+            elif tuning.max_tokens_per_message > MAX_TOKENS_PER_MESSAGE:
+                tuning.max_tokens_per_message = max(MAX_TOKENS_PER_MESSAGE, tuning.max_tokens_per_message - 5)
+            if tuning.strictness == 0:
+                tuning.bias = None
+
+        after = (tuning.max_tokens_per_message, tuning.temperature, tuning.strictness)
+        if after != before:
+            tuning.adjustments += 1
+            print(f"[字数范围 {tuning.min_length}-{tuning.max_length}] 接受率 {rate:.0%}，调整请求参数: "
+                  f"max_tokens/条 {before[0]}->{after[0]}，temperature {before[1]}->{after[1]}，提示强调 {before[2]}->{after[2]}")
+
+    def snapshot(self):
+        """返回每个字数范围的接受/过滤计数和当前参数，用于监控"""
+        with self.lock:
+            ranges = {}
+            totals = {"accepted": 0, "rejected": 0, "wasted_tokens": 0}
+            for (min_length, max_length), tuning in self.ranges.items():
+                rejected = tuning.rejected_short + tuning.rejected_long
+                total = tuning.accepted + rejected
+                ranges[f"{min_length}-{max_length}"] = {
+                    "accepted": tuning.accepted,
+                    "rejected_short": tuning.rejected_short,
+                    "rejected_long": tuning.rejected_long,
+                    "acceptance_rate": round(tuning.accepted / total, 4) if total else None,
+                    "wasted_tokens": tuning.wasted_tokens,
+                    "length_p10": tuning.percentile(0.1),
+                    "length_p50": tuning.percentile(0.5),
+                    "length_p90": tuning.percentile(0.9),
+                    "max_tokens_per_message": tuning.max_tokens_per_message,
+                    "temperature": tuning.temperature,
+                    "strictness": tuning.strictness,
+                    "adjustments": tuning.adjustments,
+                }
+                totals["accepted"] += tuning.accepted
+                totals["rejected"] += rejected
+                totals["wasted_tokens"] += tuning.wasted_tokens
+            total = totals["accepted"] + totals["rejected"]
+            return {
+                "enabled": self.enabled,
+                "target": self.target,
+                "acceptance_rate": round(totals["accepted"] / total, 4) if total else None,
+                **totals,
+                "ranges": ranges,
+            }
+
+# 创建全局长度调节器实例
+length_tuner = LengthTuner()
@@ -0,0 +1,244 @@
+import json
+import random
+import re
+import threading
+import time
+import unicodedata
+from collections import OrderedDict, deque
+
+from app.core.config import settings
+from app.core.redis_client import redis_client
+from app.services.deepseek_common import distribute_tokens
+
+# 归一化情绪类型时去掉的空白和标点
+EMOTION_STRIP_PATTERN = re.compile(r"[\s\W_]+", re.UNICODE)
+
+
+def normalize_emotion(emotion_type):
+    """归一化情绪类型，使写法略有差异的请求命中同一个缓存分桶"""
+    normalized = unicodedata.normalize("NFKC", emotion_type or "").lower()
+    return EMOTION_STRIP_PATTERN.sub("", normalized) or "default"
+
+
+class SeenMessages:
+    """会话最近收到的消息，避免缓存把同一句话反复发给同一个用户"""
+
+    def __init__(self, maxlen=200):
+        self.order = deque()
+        self.items = set()
+        self.maxlen = maxlen
+        self.lock = threading.Lock()
+
+    def add(self, messages):
+        with self.lock:
+            for message in messages:
+                if message in self.items:
+                    continue
+                self.order.append(message)
+                self.items.add(message)
+                if len(self.order) > self.maxlen:
+                    self.items.discard(self.order.popleft())
+
+    def __contains__(self, message):
+        return message in self.items
+
+
+class MessageCache:
+    """已通过长度过滤的LLM输出的共享缓存，按(归一化情绪, 字数)分桶
+
+    本地为LRU（按分桶最近访问排序，超出总条数时从最久未用的分桶淘汰），
+    可选Redis二级缓存让多个进程共享生成结果。条目过期、超过最大复用次数或
+    因容量被淘汰时都会计入淘汰计数。
+    """
+
+    def __init__(self):
+        """初始化缓存"""
+        self.enabled = settings.MESSAGE_CACHE_ENABLED
+        self.max_entries = settings.MESSAGE_CACHE_SIZE
+        self.ttl = settings.MESSAGE_CACHE_TTL
+        self.max_serves = settings.MESSAGE_CACHE_MAX_SERVES
+        self.use_redis = settings.MESSAGE_CACHE_BACKEND == "redis"
+        self.redis_bucket_size = settings.MESSAGE_CACHE_REDIS_BUCKET_SIZE
+        self.redis_refresh_interval = 5.0  # 同一范围最短的Redis回源间隔（秒）
+
+        # (情绪, 字数) -> {消息: [token数, 过期时间, 已复用次数]}
+        self.buckets = OrderedDict()
+        self.size = 0
+        self.last_redis_refresh = {}
+        self.lock = threading.Lock()
+        self.stats = {
+            "hits": 0,
+            "misses": 0,
+            "messages_served": 0,
+            "stores": 0,
+            "evictions_size": 0,
+            "evictions_ttl": 0,
+            "evictions_served": 0,
+            "redis_loads": 0,
+            "tokens_saved": 0,
+        }
+
+    @staticmethod
+    def _redis_key(emotion, length):
+        return f"cache:{emotion}:{length}"
+
+    def put(self, emotion_type, messages, total_tokens):
+        """把一批新生成的消息放入缓存
+
+        Args:
+            emotion_type: 情绪类型
+            messages: 已通过长度过滤的消息列表
+            total_tokens: 这批消息消耗的总token数
+        """
+        if not self.enabled or not messages:
+            return
+        emotion = normalize_emotion(emotion_type)
+        expires_at = time.time() + self.ttl
+        entries = list(zip(messages, distribute_tokens(total_tokens, len(messages))))
+
+        with self.lock:
+            for message, tokens in entries:
+                bucket = self.buckets.setdefault((emotion, len(message)), {})
+                if message not in bucket:
+                    self.size += 1
+                bucket[message] = [tokens, expires_at, 0]
+                self.buckets.move_to_end((emotion, len(message)))
+                self.stats["stores"] += 1
+            self._evict_overflow()
+
+        if self.use_redis:
+            try:
+                pipe = redis_client.connection.pipeline(transaction=False)
+                for message, tokens in entries:
+                    key = self._redis_key(emotion, len(message))
+                    pipe.lpush(key, json.dumps({"content": message, "tokens": tokens}))
+                    pipe.ltrim(key, 0, self.redis_bucket_size - 1)
+                    pipe.expire(key, self.ttl)
+                pipe.execute()
+            except Exception as e:
+                print(f"写入共享消息缓存失败: {str(e)}")
+
+    def draw(self, emotion_type, min_length, max_length, count, seen=None):
+        """从缓存中取出最多count条符合字数范围的消息，优先复用次数最少的条目
+
+        Args:
+            emotion_type: 情绪类型
+            min_length: 最小字数
+            max_length: 最大字数
+            count: 需要的消息条数
+            seen: 该会话已收到过的消息，这些消息不会再次取出
+
+        Returns:
+            [(消息, token数), ...]，缓存不足时返回空列表
+        """
+        if not self.enabled:
+            return []
+        emotion = normalize_emotion(emotion_type)
+        result = self._draw_local(emotion, min_length, max_length, count, seen)
+        if not result and self.use_redis and self._load_from_redis(emotion, min_length, max_length):
+            result = self._draw_local(emotion, min_length, max_length, count, seen)
+
+        with self.lock:
+            if result:
+                self.stats["hits"] += 1
+                self.stats["messages_served"] += len(result)
+                self.stats["tokens_saved"] += sum(tokens for _, tokens in result)
+            else:
+                self.stats["misses"] += 1
+        return result
+
+    def _draw_local(self, emotion, min_length, max_length, count, seen):
+        """从本地LRU取消息"""
+        now = time.time()
+        candidates = []
+        with self.lock:
+            for length in range(min_length, max_length + 1):
+                key = (emotion, length)
+                bucket = self.buckets.get(key)
+                if not bucket:
+                    continue
+                self.buckets.move_to_end(key)
+                for message, entry in list(bucket.items()):
+                    if entry[1] <= now:
+                        self._remove(key, message, "evictions_ttl")
+                    elif seen is None or message not in seen:
+                        candidates.append((entry[2], random.random(), key, message))
+
+            result = []
+            for _, _, key, message in sorted(candidates)[:count]:
+                entry = self.buckets[key][message]
+                entry[2] += 1
+                result.append((message, entry[0]))
+                if entry[2] >= self.max_serves:
+                    self._remove(key, message, "evictions_served")
+            return result
+
+    def _load_from_redis(self, emotion, min_length, max_length):
+        """本地未命中时从Redis二级缓存回源，同一范围有最短回源间隔"""
+        range_key = (emotion, min_length, max_length)
+        now = time.time()
+        with self.lock:
+            if now - self.last_redis_refresh.get(range_key, 0) < self.redis_refresh_interval:
+                return False
+            if len(self.last_redis_refresh) > 10000:
+                self.last_redis_refresh.clear()
+            self.last_redis_refresh[range_key] = now
+
+        try:
+            pipe = redis_client.connection.pipeline(transaction=False)
+            for length in range(min_length, max_length + 1):
+                pipe.lrange(self._redis_key(emotion, length), 0, -1)
+            results = pipe.execute()
+        except Exception as e:
+            print(f"读取共享消息缓存失败: {str(e)}")
+            return False
+
+        loaded = 0
+        expires_at = now + self.ttl
+        with self.lock:
+            for values in results:
+                for value in values:
+                    item = json.loads(value)
+                    message = item["content"]
+                    bucket = self.buckets.setdefault((emotion, len(message)), {})
+                    if message in bucket:
+                        continue
+                    bucket[message] = [item.get("tokens", 0), expires_at, 0]
+                    self.size += 1
+                    loaded += 1
+            self._evict_overflow()
+            self.stats["redis_loads"] += loaded
+        return loaded > 0
+
+    def _remove(self, key, message, reason):
+        # 必须在获取锁的情况下调用此方法
+        bucket = self.buckets[key]
+        del bucket[message]
+        self.size -= 1
+        self.stats[reason] += 1
+        if not bucket:
+            del self.buckets[key]
+
+    def _evict_overflow(self):
+        """超出容量时从最久未访问的分桶中淘汰最早放入的条目"""
+        # 必须在获取锁的情况下调用此方法
+        while self.size > self.max_entries and self.buckets:
+            key, bucket = next(iter(self.buckets.items()))
+            self._remove(key, next(iter(bucket)), "evictions_size")
+
+    def snapshot(self):
+        """返回缓存状态和命中率，用于监控"""
+        with self.lock:
+            lookups = self.stats["hits"] + self.stats["misses"]
+            return {
+                "enabled": self.enabled,
+                "backend": "redis" if self.use_redis else "local",
+                "size": self.size,
+                "max_entries": self.max_entries,
+                "buckets": len(self.buckets),
+                "hit_rate": round(self.stats["hits"] / lookups, 4) if lookups else None,
+                **self.stats,
+            }
+
+# 创建全局消息缓存实例
+message_cache = MessageCache()
@@ -0,0 +1,230 @@
+import asyncio
+import threading
+from collections import deque
+
+from app.core.config import settings
+from app.core.redis_client import redis_client
+from app.services.stream_reader import stream_reader
+
+class RedisQueueBackend:
+    """会话队列存放在Redis中（列表或流），生成端和分发端可以运行在不同进程或节点上"""
+
+    name = "redis"
+
+    def __init__(self):
+        """初始化Redis队列后端"""
+        self.stream = redis_client.queue_transport == "stream"
+        self.poll_interval = 0.1  # 列表模式下队列为空时的轮询间隔（秒）
+
+    @staticmethod
+    def _keys(session_id):
+        return f"messages:{session_id}", f"tokens:{session_id}"
+
+    async def init_session(self, session_id):
+        """会话开始时清空旧队列并创建token计数器"""
+        await redis_client.init_session(*self._keys(session_id))
+
+    def enqueue(self, session_id, frames, tokens):
+        """把一批消息帧放入会话队列并累加token计数
+
+        Args:
+            session_id: 会话ID
+            frames: encode_message编码的消息帧列表
+            tokens: 计入计数器的token数
+
+        Returns:
+            入队后的队列长度
+        """
+        queue_name, counter_name = self._keys(session_id)
+        return redis_client.enqueue(queue_name, counter_name, frames, tokens)
+
+    def enqueue_many(self, batches):
+        """一次管道把多个会话的消息帧放入各自的队列
+
+        Args:
+            batches: [(会话ID, 消息帧列表, token数), ...]
+
+        Returns:
+            与batches对应的入队后队列长度列表
+        """
+        pipe = redis_client.connection.pipeline(transaction=False)
+        for session_id, frames, tokens in batches:
+            queue_name, counter_name = self._keys(session_id)
+            redis_client.enqueue(queue_name, counter_name, frames, tokens, client=pipe)
+        return pipe.execute()
+
+    def add_tokens(self, session_id, tokens):
+        """只累加token计数"""
+        redis_client.increment_counter(self._keys(session_id)[1], tokens)
+
+    async def pop(self, session_id, max_count=1):
+        """最多取出会话的max_count条消息帧，队列为空时等待一段时间后返回空列表
+
+        Returns:
+            (消息帧列表, token计数, 剩余队列长度)
+        """
+        queue_name, counter_name = self._keys(session_id)
+        if self.stream:
+            # 流模式：等待共用的阻塞读取器交付，队列为空时不产生Redis命令
+            frames, total_tokens, queue_length = await stream_reader.pop(queue_name, counter_name, max_count)
+        else:
+            # 列表模式：计数器和剩余队列长度在同一次往返中读取
+            frames, total_tokens, queue_length = await redis_client.pop_messages_with_stats(queue_name, counter_name, max_count)
+            if not frames:
+                await asyncio.sleep(self.poll_interval)
+        return frames, total_tokens, queue_length
+
+    async def get_counter(self, session_id):
+        """读取会话的token计数"""
+        return await redis_client.get_counter_async(self._keys(session_id)[1])
+
+    def release(self, session_id):
+        """会话分发结束，Redis中的键由过期时间回收"""
+        if self.stream:
+            stream_reader.unregister(self._keys(session_id)[0])
+
+    def snapshot(self):
+        """返回队列后端状态，用于监控"""
+        return {
+            "backend": self.name,
+            "transport": redis_client.queue_transport,
+        }
+
+
+class MemorySessionQueue:
+    """进程内的单个会话队列"""
+
+    def __init__(self, max_size):
+        self.items = deque()
+        self.max_size = max_size
+        self.tokens = 0
+        self.waiter = None  # 分发任务等待新消息的 (loop, future)
+
+
+class MemoryQueueBackend:
+    """进程内的有界会话队列，生成端和分发端必须在同一进程
+
+    消息帧直接交给分发任务，不经过Redis往返；
+    生成线程入队后通过call_soon_threadsafe唤醒等待中的分发任务。
+    队列超过上限时丢弃最早的消息。
+    """
+
+    name = "memory"
+
+    def __init__(self):
+        """初始化进程内队列后端"""
+        self.max_size = max(1, settings.MEMORY_QUEUE_SIZE)
+        self.wait_timeout = 5.0  # 分发任务单次等待新消息的最长时间（秒）
+        self.queues = {}  # 会话ID -> MemorySessionQueue
+        self.lock = threading.Lock()
+        self.stats = {
+            "enqueued": 0,
+            "dropped": 0,
+        }
+
+    async def init_session(self, session_id):
+        """会话开始时创建空队列和token计数"""
+        with self.lock:
+            self.queues[session_id] = MemorySessionQueue(self.max_size)
+
+    def enqueue(self, session_id, frames, tokens):
+        """把一批消息帧放入会话队列并累加token计数，返回入队后的队列长度"""
+        return self.enqueue_many([(session_id, frames, tokens)])[0]
+
+    def enqueue_many(self, batches):
+        """把多个会话的消息帧放入各自的队列，返回入队后的队列长度列表"""
+        lengths = []
+        waiters = []
+        with self.lock:
+            for session_id, frames, tokens in batches:
+                queue = self.queues.get(session_id)
+                if queue is None:
+                    lengths.append(0)
+                    continue
+                queue.items.extend(frames)
+                queue.tokens += tokens
+                overflow = len(queue.items) - queue.max_size
+                for _ in range(max(0, overflow)):
+                    queue.items.popleft()
+                self.stats["enqueued"] += len(frames)
+                self.stats["dropped"] += max(0, overflow)
+                lengths.append(len(queue.items))
+                if queue.waiter is not None:
+                    waiters.append(queue.waiter)
+                    queue.waiter = None
+        for loop, future in waiters:
+            loop.call_soon_threadsafe(self._wake, future)
+        return lengths
+
+    @staticmethod
+    def _wake(future):
+        if not future.done():
+            future.set_result(None)
+
+    def add_tokens(self, session_id, tokens):
+        """只累加token计数"""
+        with self.lock:
+            queue = self.queues.get(session_id)
+            if queue is not None:
+                queue.tokens += tokens
+
+    async def pop(self, session_id, max_count=1):
+        """最多取出会话的max_count条消息帧，队列为空时挂起等待生成端入队
+
+        Returns:
+            (消息帧列表, token计数, 剩余队列长度)
+        """
+        with self.lock:
+            queue = self.queues.get(session_id)
+            future = None
+            if queue is not None and not queue.items:
+                future = asyncio.get_running_loop().create_future()
+                queue.waiter = (future.get_loop(), future)
+        if queue is None:
+            await asyncio.sleep(self.wait_timeout)
+            return [], 0, 0
+
+        if future is not None:
+            try:
+                await asyncio.wait_for(future, self.wait_timeout)
+            except asyncio.TimeoutError:
+                pass
+            finally:
+                with self.lock:
+                    if queue.waiter is not None and queue.waiter[1] is future:
+                        queue.waiter = None
+
+        with self.lock:
+            frames = [queue.items.popleft() for _ in range(min(max_count, len(queue.items)))]
+            return frames, queue.tokens, len(queue.items)
+
+    async def get_counter(self, session_id):
+        """读取会话的token计数"""
+        queue = self.queues.get(session_id)
+        return queue.tokens if queue is not None else 0
+
+    def release(self, session_id):
+        """会话分发结束，释放队列"""
+        with self.lock:
+            self.queues.pop(session_id, None)
+
+    def snapshot(self):
+        """返回队列后端状态，用于监控"""
+        with self.lock:
+            return {
+                "backend": self.name,
+                "sessions": len(self.queues),
+                "queued": sum(len(queue.items) for queue in self.queues.values()),
+                "max_size": self.max_size,
+                **self.stats,
+            }
+
+
+def create_queue_backend():
+    """按配置创建会话队列后端"""
+    if settings.QUEUE_BACKEND == "memory":
+        return MemoryQueueBackend()
+    return RedisQueueBackend()
+
+# 创建全局会话队列后端实例
+queue_backend = create_queue_backend()
@@ -0,0 +1,271 @@
+import asyncio
+import threading
+import time
+
+from app.core.config import settings
+from app.core.redis_client import redis_client
+
+# 集群共享令牌桶脚本：按Redis服务器时间补充令牌，成功时扣除一个令牌
+# 返回值为0表示获取成功，否则为建议等待的毫秒数
+TOKEN_BUCKET_SCRIPT = """
+local key = KEYS[1]
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local now = redis.call('TIME')
+local now_ms = tonumber(now[1]) * 1000 + math.floor(tonumber(now[2]) / 1000)
+local state = redis.call('HMGET', key, 'tokens', 'ts')
+local tokens = tonumber(state[1]) or burst
+local ts = tonumber(state[2]) or now_ms
+tokens = math.min(burst, tokens + math.max(0, now_ms - ts) * rate / 1000)
+local wait_ms = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+else
+    wait_ms = math.ceil((1 - tokens) * 1000 / rate)
+end
+redis.call('HSET', key, 'tokens', tokens, 'ts', now_ms)
+redis.call('PEXPIRE', key, math.ceil(burst * 1000 / rate) + 1000)
+return wait_ms
+"""
+
+class AdaptiveRateLimiter:
+    """DeepSeek请求的全局预算控制器
+
+    令牌桶限制整体请求速率（可选Redis共享，实现集群级预算），
+    并发窗口按AIMD调整：请求成功时加性增长，遇到429/5xx或延迟突增时乘性减小。
+    并发窗口按进程维护，同步线程和事件循环中的协程共用同一个窗口。
+    """
+
+    def __init__(self):
+        """初始化限流器"""
+        self.rate = settings.DEEPSEEK_RATE_LIMIT  # 每秒请求数，0表示不限速
+        self.burst = max(1, settings.DEEPSEEK_BURST)
+        self.backend = settings.RATE_LIMIT_BACKEND  # local 或 redis
+        self.bucket_key = "deepseek:token_bucket"
+        self.min_window = max(1, settings.DEEPSEEK_MIN_CONCURRENCY)
+        self.max_window = max(self.min_window, settings.DEEPSEEK_MAX_CONCURRENCY)
+        self.window = float(min(self.max_window, max(self.min_window, settings.DEEPSEEK_INITIAL_CONCURRENCY)))
+        self.latency_spike = settings.LATENCY_SPIKE_SECONDS
+
+        self.tokens = float(self.burst)
+        self.last_refill = time.monotonic()
+        self.in_flight = 0
+        self.last_decrease = 0.0
+        self.latency_ewma = None
+        self.stats = {
+            "acquired": 0,
+            "throttled": 0,
+            "successes": 0,
+            "failures": 0,
+            "increases": 0,
+            "decreases": 0,
+        }
+
+        self.lock = threading.Lock()
+        self.condition = threading.Condition(self.lock)
+        self.async_waiters = []  # 等待窗口空出的协程 (loop, future)
+        self._bucket_script = None
+        self._async_bucket_script = None
+
+    def _take_token(self):
+        """从令牌桶取一个令牌，成功返回0，否则返回建议等待的秒数"""
+        if self.rate <= 0:
+            return 0
+        if self.backend == "redis":
+            try:
+                if self._bucket_script is None:
+                    self._bucket_script = redis_client.connection.register_script(TOKEN_BUCKET_SCRIPT)
+                wait_ms = self._bucket_script(keys=[self.bucket_key], args=[self.rate, self.burst])
+                return int(wait_ms) / 1000
+            except Exception as e:
+                # Redis不可用时退回本地令牌桶
+                print(f"共享令牌桶不可用，使用本地令牌桶: {str(e)}")
+        return self._take_local_token()
+
+    async def _take_token_async(self):
+        """_take_token的异步版本，共享令牌桶经异步连接访问，不阻塞事件循环"""
+        if self.rate <= 0:
+            return 0
+        if self.backend == "redis":
+            try:
+                if self._async_bucket_script is None:
+                    self._async_bucket_script = redis_client.async_connection.register_script(TOKEN_BUCKET_SCRIPT)
+                wait_ms = await self._async_bucket_script(keys=[self.bucket_key], args=[self.rate, self.burst])
+                return int(wait_ms) / 1000
+            except Exception as e:
+                print(f"共享令牌桶不可用，使用本地令牌桶: {str(e)}")
+        return self._take_local_token()
+
+    def _take_local_token(self):
+        """从进程内令牌桶取一个令牌"""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.last_refill) * self.rate)
+            self.last_refill = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return (1 - self.tokens) / self.rate
+
+    def try_acquire(self):
+        """尝试获取一次请求许可
+
+        Returns:
+            0表示获取成功；None表示并发窗口已满，需要等待释放；正数表示令牌不足需等待的秒数
+        """
+        if not self._reserve():
+            return None
+        return self._settle(self._take_token())
+
+    async def try_acquire_async(self):
+        """try_acquire的异步版本，返回值含义相同"""
+        if not self._reserve():
+            return None
+        try:
+            wait = await self._take_token_async()
+        except BaseException:
+            # 协程在访问共享令牌桶时被取消，归还占用的并发名额
+            with self.lock:
+                self.in_flight -= 1
+                self._notify()
+            raise
+        return self._settle(wait)
+
+    def _reserve(self):
+        """在并发窗口中占用一个名额，窗口已满时返回False"""
+        with self.lock:
+            if self.in_flight >= int(self.window):
+                self.stats["throttled"] += 1
+                return False
+            self.in_flight += 1
+            return True
+
+    def _settle(self, wait):
+        """根据取令牌的结果确认或归还并发名额，返回值同try_acquire"""
+        if wait > 0:
+            with self.lock:
+                self.in_flight -= 1
+                self.stats["throttled"] += 1
+                self._notify()
+            return wait
+
+        with self.lock:
+            self.stats["acquired"] += 1
+        return 0
+
+    def acquire(self, is_active=None):
+        """阻塞式获取请求许可，供线程引擎使用
+
+        Args:
+            is_active: 返回会话是否仍然活跃的函数，会话停止时放弃等待
+
+        Returns:
+            是否获取成功
+        """
+        while is_active is None or is_active():
+            wait = self.try_acquire()
+            if wait == 0:
+                return True
+            with self.condition:
+                # 窗口已满时等待释放通知，定期醒来检查会话状态
+                self.condition.wait(timeout=1.0 if wait is None else min(wait, 1.0))
+        return False
+
+    async def acquire_async(self):
+        """异步获取请求许可，供async引擎使用，协程被取消时放弃等待"""
+        loop = asyncio.get_running_loop()
+        while True:
+            wait = await self.try_acquire_async()
+            if wait == 0:
+                return True
+            if wait is not None:
+                await asyncio.sleep(wait)
+                continue
+            future = loop.create_future()
+            with self.lock:
+                self.async_waiters.append((loop, future))
+            try:
+                await asyncio.wait_for(future, timeout=1.0)
+            except asyncio.TimeoutError:
+                pass
+            finally:
+                with self.lock:
+                    if (loop, future) in self.async_waiters:
+                        self.async_waiters.remove((loop, future))
+
+    def release(self, status_code=None, latency=None, error=False):
+        """请求结束后归还许可，并根据结果调整并发窗口
+
+        Args:
+            status_code: 响应状态码，请求异常时为None
+            latency: 请求耗时（秒）
+            error: 是否发生网络异常或超时
+        """
+        with self.lock:
+            self.in_flight = max(0, self.in_flight - 1)
+
+            if latency is not None:
+                self.latency_ewma = latency if self.latency_ewma is None else self.latency_ewma * 0.8 + latency * 0.2
+
+            overloaded = (
+                error
+                or status_code == 429
+                or (status_code is not None and status_code >= 500)
+                or (latency is not None and latency > self.latency_spike)
+            )
+            if overloaded:
+                self.stats["failures"] += 1
+                self._decrease()
+            elif status_code is not None and status_code < 400:
+                self.stats["successes"] += 1
+                # 加性增长：每完成一个窗口的请求，窗口增加AIMD_INCREASE
+                if self.window < self.max_window:
+                    self.window = min(self.max_window, self.window + settings.AIMD_INCREASE / self.window)
+                    self.stats["increases"] += 1
+
+            self._notify()
+
+    def _decrease(self):
+        """乘性减小并发窗口，同一个冷却期内只减小一次，避免一批失败把窗口打到底"""
+        # 必须在获取锁的情况下调用此方法
+        now = time.monotonic()
+        cooldown = self.latency_ewma or 1.0
+        if now - self.last_decrease < cooldown:
+            return
+        self.last_decrease = now
+        new_window = max(self.min_window, self.window * settings.AIMD_DECREASE)
+        if new_window < self.window:
+            print(f"DeepSeek并发窗口下调: {self.window:.2f} -> {new_window:.2f}")
+            self.window = new_window
+            self.stats["decreases"] += 1
+
+    def _notify(self):
+        """唤醒等待许可的线程和协程"""
+        # 必须在获取锁的情况下调用此方法
+        self.condition.notify_all()
+        for loop, future in self.async_waiters:
+            loop.call_soon_threadsafe(self._wake, future)
+        self.async_waiters.clear()
+
+    @staticmethod
+    def _wake(future):
+        if not future.done():
+            future.set_result(None)
+
+    def snapshot(self):
+        """返回限流器当前状态，用于监控"""
+        with self.lock:
+            return {
+                "backend": self.backend,
+                "rate_limit": self.rate,
+                "burst": self.burst,
+                "window": round(self.window, 2),
+                "min_window": self.min_window,
+                "max_window": self.max_window,
+                "in_flight": self.in_flight,
+                "latency_ewma": round(self.latency_ewma, 3) if self.latency_ewma is not None else None,
+                **self.stats,
+            }
+
+# 创建全局限流器实例
+deepseek_limiter = AdaptiveRateLimiter()
@@ -0,0 +1,348 @@
+import asyncio
+import os
+import socket
+import time
+import uuid
+
+from app.core.config import settings
+from app.core.redis_client import redis_client
+from app.services.backpressure import queue_backpressure
+from app.services.deepseek_service import deepseek_service
+from app.services.queue_backend import queue_backend
+
+# 待认领的生成任务（会话ID列表）
+JOBS_KEY = "sessions:jobs"
+
+# 每个节点的控制列表前缀，其他节点更新了该节点所运行生成器的参数时推入会话ID
+CONTROL_KEY_PREFIX = "sessions:control:"
+
+# 只有租约仍属于本节点时才续期/释放，避免误操作其他节点接手后的租约
+RENEW_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('PEXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+RELEASE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+# 更新会话参数并递增版本号；生成器在其他节点时把会话ID推入该节点的控制列表，使其立即应用
+# KEYS[1]为参数，KEYS[2]为生成租约；ARGV依次为最小字数、最大字数、本节点ID、会话ID、控制列表过期毫秒数
+# 返回 {新版本号, 被通知的节点ID或false}
+UPDATE_PARAMS_SCRIPT = """
+redis.call('HSET', KEYS[1], 'min_length', ARGV[1], 'max_length', ARGV[2])
+local version = redis.call('HINCRBY', KEYS[1], 'version', 1)
+local owner = redis.call('GET', KEYS[2])
+if owner and owner ~= ARGV[3] then
+    local control = '""" + CONTROL_KEY_PREFIX + """' .. owner
+    redis.call('RPUSH', control, ARGV[4])
+    redis.call('PEXPIRE', control, ARGV[5])
+    return {version, owner}
+end
+return {version, false}
+"""
+
+
+class SessionRegistry:
+    """基于Redis的多节点会话注册表
+
+    持有WebSocket的节点为会话写入连接租约和生成参数，并把生成任务放入共享的任务列表；
+    任意节点在本地生成器数量未达上限时认领任务（生成租约），生成结果经Redis会话队列
+    交付给持有连接的节点。各节点定期心跳续租，并据此处理节点故障：
+    连接租约消失的生成器被停止，生成租约消失的会话被重新放回任务列表由其他节点接手。
+    参数更新经生成节点的控制列表立即送达，心跳时的版本比对作为兜底。
+    """
+
+    def __init__(self):
+        """初始化会话注册表"""
+        self.enabled = settings.SESSION_ROUTING == "redis"
+        if self.enabled and queue_backend.name != "redis":
+            print("进程内队列无法跨节点交付消息，会话路由退回本地模式")
+            self.enabled = False
+        self.node_id = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.lease_ms = max(1, settings.SESSION_LEASE_SECONDS) * 1000
+        self.heartbeat_interval = max(1, settings.SESSION_LEASE_SECONDS) / 3
+        self.capacity = max(1, settings.NODE_GENERATOR_CAPACITY)
+        self.local_sockets = {}  # 本节点持有连接的会话ID -> 注册时间
+        self.local_generators = {}  # 本节点运行生成器的会话ID -> 已应用的参数版本
+        self.requeued = {}  # 会话ID -> 最近一次重新放回任务列表的时间
+        self.tasks = []
+        self.pending = set()  # 尚未完成的注销任务
+        self._renew = redis_client.async_connection.register_script(RENEW_SCRIPT)
+        self._release = redis_client.async_connection.register_script(RELEASE_SCRIPT)
+        self._update_params = redis_client.async_connection.register_script(UPDATE_PARAMS_SCRIPT)
+        self.stats = {
+            "registered": 0,
+            "claimed": 0,
+            "requeued": 0,
+            "orphans_stopped": 0,
+            "leases_lost": 0,
+            "remote_updates": 0,
+            "updates_pushed": 0,
+        }
+
+    @staticmethod
+    def _socket_key(session_id):
+        return f"sessions:socket:{session_id}"
+
+    @staticmethod
+    def _generator_key(session_id):
+        return f"sessions:generator:{session_id}"
+
+    @staticmethod
+    def _params_key(session_id):
+        return f"sessions:params:{session_id}"
+
+    @property
+    def control_key(self):
+        return f"{CONTROL_KEY_PREFIX}{self.node_id}"
+
+    def start(self):
+        """启动心跳、任务认领和参数更新协程"""
+        if self.enabled and not self.tasks:
+            self.tasks = [
+                asyncio.create_task(self._heartbeat_loop(), name="session-registry-heartbeat"),
+                asyncio.create_task(self._claim_loop(), name="session-registry-claim"),
+                asyncio.create_task(self._control_loop(), name="session-registry-control"),
+            ]
+            print(f"会话注册表已启动，节点ID: {self.node_id}")
+
+    async def stop(self):
+        """停止后台协程，把本节点的生成任务交还给其他节点"""
+        for task in self.tasks:
+            task.cancel()
+        for task in self.tasks:
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        self.tasks = []
+        if self.pending:
+            await asyncio.gather(*self.pending, return_exceptions=True)
+        if not self.local_generators:
+            return
+
+        connection = redis_client.async_connection
+        pipe = connection.pipeline(transaction=False)
+        for session_id in self.local_generators:
+            await self._release(keys=[self._generator_key(session_id)], args=[self.node_id], client=pipe)
+            pipe.rpush(JOBS_KEY, session_id)
+        await pipe.execute()
+        for session_id in list(self.local_generators):
+            deepseek_service.stop_generation(session_id)
+        self.local_generators.clear()
+
+    async def register(self, session_id, emotion_type, min_length, max_length):
+        """持有连接的节点登记会话，并放入生成任务等待任意节点认领"""
+        params = {
+            "emotion_type": emotion_type,
+            "min_length": min_length,
+            "max_length": max_length,
+            "version": 0,
+        }
+        pipe = redis_client.async_connection.pipeline(transaction=True)
+        pipe.set(self._socket_key(session_id), self.node_id, px=self.lease_ms)
+        pipe.delete(self._params_key(session_id))
+        pipe.hset(self._params_key(session_id), mapping=params)
+        pipe.pexpire(self._params_key(session_id), self.lease_ms)
+        pipe.rpush(JOBS_KEY, session_id)
+        await pipe.execute()
+        self.local_sockets[session_id] = time.monotonic()
+        self.stats["registered"] += 1
+
+    async def update_params(self, emotion_type, session_id, min_length, max_length):
+        """更新会话的字数范围，生成器在其他节点时通知该节点立即应用"""
+        version, owner = await self._update_params(
+            keys=[self._params_key(session_id), self._generator_key(session_id)],
+            args=[min_length, max_length, self.node_id, session_id, self.lease_ms]
+        )
+        if owner:
+            self.stats["updates_pushed"] += 1
+        if session_id in self.local_generators:
+            self.local_generators[session_id] = version
+            deepseek_service.update_params(emotion_type, session_id, min_length, max_length)
+
+    def unregister(self, session_id):
+        """连接关闭时注销会话，租约由后台任务删除，其他节点上的生成器在下一次心跳时停止"""
+        self.local_sockets.pop(session_id, None)
+        self.requeued.pop(session_id, None)
+        owned = self.local_generators.pop(session_id, None) is not None
+        task = asyncio.create_task(self._unregister(session_id, owned))
+        self.pending.add(task)
+        task.add_done_callback(self.pending.discard)
+
+    async def _unregister(self, session_id, owned):
+        try:
+            pipe = redis_client.async_connection.pipeline(transaction=False)
+            pipe.delete(self._socket_key(session_id), self._params_key(session_id))
+            if owned:
+                await self._release(keys=[self._generator_key(session_id)], args=[self.node_id], client=pipe)
+            await pipe.execute()
+        except Exception as e:
+            print(f"[会话 {session_id}] 注销会话发生异常: {str(e)}")
+
+    async def live_sessions(self, session_ids):
+        """返回仍持有连接租约（某个节点上仍有WebSocket）的会话ID集合"""
+        pipe = redis_client.async_connection.pipeline(transaction=False)
+        for session_id in session_ids:
+            pipe.exists(self._socket_key(session_id))
+        results = await pipe.execute()
+        return {session_id for session_id, alive in zip(session_ids, results) if alive}
+
+    async def _claim_loop(self):
+        connection = redis_client.async_connection
+        while True:
+            try:
+                if len(self.local_generators) >= self.capacity:
+                    # 本节点已满，任务留给其他节点
+                    await asyncio.sleep(self.heartbeat_interval)
+                    continue
+                result = await connection.blpop(JOBS_KEY, timeout=1)
+                if result:
+                    await self._claim(connection, result[1])
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"认领生成任务发生异常: {str(e)}")
+                await asyncio.sleep(1)
+
+    async def _claim(self, connection, session_id):
+        """认领一个会话的生成任务，连接已关闭或已被其他节点认领时忽略"""
+        pipe = connection.pipeline(transaction=False)
+        pipe.set(self._generator_key(session_id), self.node_id, nx=True, px=self.lease_ms)
+        pipe.exists(self._socket_key(session_id))
+        pipe.hgetall(self._params_key(session_id))
+        acquired, socket_alive, params = await pipe.execute()
+        if not acquired:
+            return
+        if not socket_alive or not params:
+            await self._release(keys=[self._generator_key(session_id)], args=[self.node_id])
+            return
+
+        self.local_generators[session_id] = int(params.get("version", 0))
+        self.stats["claimed"] += 1
+        # 队列已由持有连接的节点初始化，接手时保留其中尚未分发的消息
+        await deepseek_service.generate_messages(
+            params["emotion_type"],
+            session_id,
+            int(params["min_length"]),
+            int(params["max_length"]),
+            reset_queue=False
+        )
+        print(f"[会话 {session_id}] 节点 {self.node_id} 认领生成任务")
+
+    async def _control_loop(self):
+        connection = redis_client.async_connection
+        while True:
+            try:
+                result = await connection.blpop(self.control_key, timeout=1)
+                if result:
+                    params = await connection.hgetall(self._params_key(result[1]))
+                    if params:
+                        self._apply_params(result[1], params)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"应用参数更新发生异常: {str(e)}")
+                await asyncio.sleep(1)
+
+    def _apply_params(self, session_id, params):
+        """版本号比本节点已应用的新时，把其他节点写入的参数应用到本地生成器"""
+        applied = self.local_generators.get(session_id)
+        version = int(params.get("version", 0))
+        if applied is None or version == applied:
+            return
+        self.local_generators[session_id] = version
+        self.stats["remote_updates"] += 1
+        deepseek_service.update_params(
+            params["emotion_type"], session_id, int(params["min_length"]), int(params["max_length"])
+        )
+
+    async def _heartbeat_loop(self):
+        while True:
+            await asyncio.sleep(self.heartbeat_interval)
+            try:
+                await self.heartbeat()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"会话注册表心跳发生异常: {str(e)}")
+
+    async def heartbeat(self):
+        """续租本节点的连接和生成器，并处理其他节点故障或会话结束"""
+        sockets = list(self.local_sockets)
+        generators = list(self.local_generators)
+        if not sockets and not generators:
+            return
+
+        pipe = redis_client.async_connection.pipeline(transaction=False)
+        for session_id in sockets:
+            pipe.set(self._socket_key(session_id), self.node_id, px=self.lease_ms)
+            pipe.pexpire(self._params_key(session_id), self.lease_ms)
+            pipe.exists(self._generator_key(session_id))
+        for session_id in generators:
+            await self._renew(keys=[self._generator_key(session_id)], args=[self.node_id, self.lease_ms], client=pipe)
+            pipe.exists(self._socket_key(session_id))
+            pipe.hgetall(self._params_key(session_id))
+            if queue_backend.stream:
+                pipe.xlen(f"messages:{session_id}")
+            else:
+                pipe.llen(f"messages:{session_id}")
+        results = await pipe.execute()
+
+        now = time.monotonic()
+        requeue = []
+        for index, session_id in enumerate(sockets):
+            has_generator = results[index * 3 + 2]
+            registered = self.local_sockets.get(session_id)
+            if has_generator or registered is None or now - registered < self.lease_ms / 1000:
+                continue
+            # 生成节点失联（或尚无节点认领），每个租约周期最多重新放回一次
+            if now - self.requeued.get(session_id, 0) >= self.lease_ms / 1000:
+                self.requeued[session_id] = now
+                requeue.append(session_id)
+
+        offset = len(sockets) * 3
+        for index, session_id in enumerate(generators):
+            renewed, socket_alive, params, queue_length = results[offset + index * 4:offset + index * 4 + 4]
+            if session_id not in self.local_generators:
+                continue
+            if not renewed or not socket_alive or not params:
+                # 连接已关闭、持有连接的节点失联，或租约已被其他节点接手
+                self.local_generators.pop(session_id, None)
+                deepseek_service.stop_generation(session_id)
+                if renewed:
+                    await self._release(keys=[self._generator_key(session_id)], args=[self.node_id])
+                    self.stats["orphans_stopped"] += 1
+                else:
+                    self.stats["leases_lost"] += 1
+                continue
+
+            # 通常已由控制列表送达，这里兜底处理通知丢失（如生成器刚被其他节点接手）的情况
+            self._apply_params(session_id, params)
+            # 分发端在其他节点时由心跳检查队列长度，降到低水位后恢复暂停的生成
+            if queue_backpressure.is_paused(session_id):
+                queue_backpressure.on_dequeued(session_id, queue_length)
+
+        if requeue:
+            await redis_client.async_connection.rpush(JOBS_KEY, *requeue)
+            self.stats["requeued"] += len(requeue)
+
+    def snapshot(self):
+        """返回本节点的会话路由状态，用于监控"""
+        return {
+            "enabled": self.enabled,
+            "node_id": self.node_id,
+            "local_sockets": len(self.local_sockets),
+            "local_generators": len(self.local_generators),
+            "capacity": self.capacity,
+            **self.stats,
+        }
+
+# 创建全局会话注册表实例
+session_registry = SessionRegistry()
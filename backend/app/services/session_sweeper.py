@@ -0,0 +1,162 @@
+import asyncio
+import time
+
+from app.core.config import settings
+from app.core.redis_client import redis_client
+from app.services.session_registry import session_registry
+
+# 清理任务检查的会话键
+SESSION_KEY_PATTERNS = ("messages:*", "tokens:*")
+
+
+class SessionKeySweeper:
+    """定期回收已结束会话遗留的Redis键
+
+    会话键正常情况下带有滑动过期时间，由Redis自行回收；清理任务用SCAN分批找出没有过期时间的键
+    （升级前创建的键、进程异常退出时遗留的键），仍属于本进程活跃会话的补上过期时间，
+    其余的直接UNLINK，并按MEMORY USAGE统计回收的内存。
+
+    SESSION_KEY_TTL为0时所有会话键都没有过期时间，其他进程或节点的活跃会话无法与遗留键区分：
+    多节点路由开启时只回收没有连接租约的会话键，否则不回收。
+    """
+
+    def __init__(self):
+        """初始化清理任务"""
+        self.interval = settings.SESSION_SWEEP_INTERVAL
+        self.ttl = max(0, settings.SESSION_KEY_TTL)
+        self.scan_count = 500
+        self.is_active = lambda session_id: False  # 判断会话是否仍在本进程活跃
+        self.task = None
+        self.stats = {
+            "runs": 0,
+            "scanned_keys": 0,
+            "reclaimed_keys": 0,
+            "reclaimed_bytes": 0,
+            "adopted_keys": 0,
+            "last_run": None,
+            "last_duration": None,
+        }
+
+    def start(self, is_active):
+        """启动后台清理任务
+
+        Args:
+            is_active: 函数is_active(session_id)，判断会话是否仍在本进程活跃
+        """
+        self.is_active = is_active
+        if self.interval > 0 and (self.task is None or self.task.done()):
+            self.task = asyncio.create_task(self._run(), name="session-key-sweeper")
+
+    async def stop(self):
+        """停止后台清理任务"""
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.sweep()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"清理会话键发生异常: {str(e)}")
+
+    async def sweep(self):
+        """扫描一遍会话键，返回本次回收的键数和字节数"""
+        connection = redis_client.async_connection
+        started = time.monotonic()
+        reclaimed_keys = 0
+        reclaimed_bytes = 0
+        for pattern in SESSION_KEY_PATTERNS:
+            batch = []
+            async for key in connection.scan_iter(match=pattern, count=self.scan_count):
+                batch.append(key)
+                if len(batch) >= self.scan_count:
+                    keys, size = await self._reclaim(connection, batch)
+                    reclaimed_keys += keys
+                    reclaimed_bytes += size
+                    batch = []
+            if batch:
+                keys, size = await self._reclaim(connection, batch)
+                reclaimed_keys += keys
+                reclaimed_bytes += size
+
+        self.stats["runs"] += 1
+        self.stats["last_run"] = time.time()
+        self.stats["last_duration"] = round(time.monotonic() - started, 3)
+        if reclaimed_keys:
+            print(f"清理会话键: 回收 {reclaimed_keys} 个键，约 {reclaimed_bytes / 1024:.1f} KB")
+        return reclaimed_keys, reclaimed_bytes
+
+    async def _reclaim(self, connection, keys):
+        """回收一批键中没有过期时间且不属于活跃会话的键"""
+        self.stats["scanned_keys"] += len(keys)
+        pipe = connection.pipeline(transaction=False)
+        for key in keys:
+            pipe.ttl(key)
+        ttls = await pipe.execute()
+
+        # TTL为-1表示没有过期时间，-2表示键已不存在
+        orphans = []
+        adopted = []
+        for key, ttl in zip(keys, ttls):
+            if ttl != -1:
+                continue
+            if self.is_active(key.split(":", 1)[1]):
+                adopted.append(key)
+            else:
+                orphans.append(key)
+
+        if orphans and session_registry.enabled:
+            # 其他节点上仍有连接的会话不是遗留键
+            live = await session_registry.live_sessions([key.split(":", 1)[1] for key in orphans])
+            orphans = [key for key in orphans if key.split(":", 1)[1] not in live]
+        elif not self.ttl:
+            # 会话键本就不过期，无法判断是否属于其他进程的活跃会话
+            orphans = []
+
+        if adopted and self.ttl:
+            pipe = connection.pipeline(transaction=False)
+            for key in adopted:
+                pipe.expire(key, self.ttl)
+            await pipe.execute()
+            self.stats["adopted_keys"] += len(adopted)
+        if not orphans:
+            return 0, 0
+
+        sizes = await self._memory_usage(connection, orphans)
+        pipe = connection.pipeline(transaction=False)
+        for key in orphans:
+            pipe.unlink(key)
+        removed = sum(await pipe.execute())
+        self.stats["reclaimed_keys"] += removed
+        self.stats["reclaimed_bytes"] += sizes
+        return removed, sizes
+
+    @staticmethod
+    async def _memory_usage(connection, keys):
+        """统计一批键占用的内存，服务器不支持MEMORY USAGE时返回0"""
+        try:
+            pipe = connection.pipeline(transaction=False)
+            for key in keys:
+                pipe.memory_usage(key)
+            return sum(size or 0 for size in await pipe.execute())
+        except Exception:
+            return 0
+
+    def snapshot(self):
+        """返回清理任务状态，用于监控"""
+        return {
+            "interval": self.interval,
+            "session_key_ttl": self.ttl,
+            **self.stats,
+        }
+
+# 创建全局会话键清理任务实例
+session_sweeper = SessionKeySweeper()
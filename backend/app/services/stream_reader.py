@@ -0,0 +1,173 @@
+import asyncio
+import uuid
+from collections import deque
+
+from app.core.config import settings
+from app.core.redis_client import redis_client
+
+class StreamState:
+    """单个会话流的读取状态"""
+
+    def __init__(self, counter_name):
+        self.counter_name = counter_name
+        self.last_id = "0-0"  # 已读取的最后一个条目ID
+        self.buffer = deque()  # 已读取、尚未分发的消息
+        self.total_tokens = 0  # 最近一次读取时的token计数
+        self.stream_length = 0  # 最近一次读取后流中尚未读取的条数
+        self.waiter = None  # 分发任务等待新消息的future
+
+
+class StreamReader:
+    """多路复用的Redis Streams读取器
+
+    所有本地缓冲已空的会话由一个协程通过一条XREAD BLOCK同时等待，有新条目时立即交付，
+    空闲会话不产生任何Redis命令。已读取的条目随即从流中删除，流长度始终是未读取的条数，
+    供水位控制使用。会话开始等待而读取器正阻塞在不包含该会话的XREAD上时，
+    向本进程的唤醒流追加一条记录，让读取器带上新会话重新阻塞。
+    """
+
+    def __init__(self):
+        """初始化读取器"""
+        self.enabled = settings.QUEUE_TRANSPORT == "stream"
+        self.count = max(1, settings.STREAM_READ_COUNT)
+        self.block_ms = max(1, settings.STREAM_BLOCK_MS)
+        self.wakeup_key = f"streams:wakeup:{uuid.uuid4().hex}"
+        self.wakeup_id = "0-0"
+        self.streams = {}  # 队列名称 -> StreamState
+        self.blocking_keys = None  # 当前XREAD BLOCK正在等待的流，未阻塞时为None
+        self.pending = None  # 有会话开始等待时设置，读取器空闲时在上面挂起
+        self.task = None
+        self.stats = {
+            "reads": 0,
+            "messages": 0,
+            "wakeups": 0,
+        }
+
+    def _ensure_running(self):
+        if self.pending is None:
+            self.pending = asyncio.Event()
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self._run(), name="stream-reader")
+
+    async def pop(self, queue_name, counter_name, max_count=1):
+        """最多取出会话流中的max_count条消息，本地缓冲为空时挂起等待读取器交付
+
+        Args:
+            queue_name: 会话流名称
+            counter_name: 会话token计数器名称
+            max_count: 最多取出的条数
+
+        Returns:
+            (消息列表, token计数, 剩余未分发的条数)，等待超时时消息列表为空
+        """
+        state = self.streams.get(queue_name)
+        if state is None:
+            state = self.streams[queue_name] = StreamState(counter_name)
+
+        if not state.buffer:
+            state.waiter = asyncio.get_running_loop().create_future()
+            self._ensure_running()
+            self.pending.set()
+            if self.blocking_keys is not None and queue_name not in self.blocking_keys:
+                await self._wakeup()
+            try:
+                await asyncio.wait_for(state.waiter, self.block_ms / 1000)
+            except asyncio.TimeoutError:
+                pass
+            finally:
+                state.waiter = None
+
+        if not state.buffer:
+            return [], state.total_tokens, 0
+        messages = [state.buffer.popleft() for _ in range(min(max_count, len(state.buffer)))]
+        return messages, state.total_tokens, len(state.buffer) + state.stream_length
+
+    def unregister(self, queue_name):
+        """会话分发结束时移除读取状态"""
+        state = self.streams.pop(queue_name, None)
+        if state is not None and state.waiter is not None and not state.waiter.done():
+            state.waiter.cancel()
+
+    async def _wakeup(self):
+        """打断读取器当前的阻塞读取"""
+        self.stats["wakeups"] += 1
+        pipe = redis_client.async_connection.pipeline(transaction=False)
+        pipe.xadd(self.wakeup_key, {"w": 1}, maxlen=1)
+        pipe.expire(self.wakeup_key, 3600)
+        await pipe.execute()
+
+    async def _run(self):
+        connection = redis_client.async_queue_connection
+        while True:
+            waiting = [name for name, state in self.streams.items() if state.waiter is not None and not state.buffer]
+            if not waiting:
+                # 没有等待中的会话时挂起，不发送任何命令
+                self.pending.clear()
+                await self.pending.wait()
+                continue
+
+            streams = {self.wakeup_key: self.wakeup_id}
+            streams.update({name: self.streams[name].last_id for name in waiting})
+            try:
+                self.blocking_keys = set(waiting)
+                try:
+                    result = await connection.xread(streams, count=self.count, block=self.block_ms)
+                finally:
+                    self.blocking_keys = None
+                self.stats["reads"] += 1
+                await self._deliver(connection, result or [])
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"读取会话流发生异常: {str(e)}")
+                await asyncio.sleep(1)
+
+    async def _deliver(self, connection, result):
+        """把读取到的消息帧放入各会话的缓冲，删除已读取的条目并唤醒等待的分发任务"""
+        read = []
+        for name, entries in result:
+            if not entries:
+                continue
+            name = name.decode()
+            if name == self.wakeup_key:
+                self.wakeup_id = entries[-1][0]
+                continue
+            state = self.streams.get(name)
+            if state is None:
+                continue
+            state.last_id = entries[-1][0]
+            state.buffer.extend(fields[b"m"] for _, fields in entries)
+            read.append((name, state, [entry_id for entry_id, _ in entries]))
+        if not read:
+            return
+
+        # 同一次往返删除已读取的条目，读取剩余条数和token计数，并刷新会话键的过期时间
+        pipe = connection.pipeline(transaction=False)
+        for name, state, ids in read:
+            pipe.xdel(name, *ids)
+            pipe.xlen(name)
+            pipe.get(state.counter_name)
+        for name, state, _ in read:
+            redis_client.refresh_ttl(pipe, name, state.counter_name)
+        results = await pipe.execute()
+
+        for index, (name, state, ids) in enumerate(read):
+            state.stream_length = results[index * 3 + 1]
+            value = results[index * 3 + 2]
+            state.total_tokens = int(value) if value else 0
+            self.stats["messages"] += len(ids)
+            if state.waiter is not None and not state.waiter.done():
+                state.waiter.set_result(None)
+
+    def snapshot(self):
+        """返回读取器状态，用于监控"""
+        return {
+            "enabled": self.enabled,
+            "streams": len(self.streams),
+            "waiting": sum(1 for state in self.streams.values() if state.waiter is not None),
+            "buffered": sum(len(state.buffer) for state in self.streams.values()),
+            **self.stats,
+        }
+
+# 创建全局会话流读取器实例
+stream_reader = StreamReader()
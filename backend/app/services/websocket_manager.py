@@ -1,13 +1,53 @@
 import asyncio
 import json
 import time
-from typing import Dict, List
+from collections import deque
+from typing import Dict, List, Optional, Tuple
 
 from fastapi import WebSocket
 
 from app.core.config import settings
-from app.core.redis_client import redis_client
+from app.services.admission import admission_controller
+from app.services.backpressure import queue_backpressure
+from app.services.deepseek_common import decode_message
 from app.services.deepseek_service import deepseek_service
+from app.services.queue_backend import queue_backend
+from app.services.session_registry import session_registry
+
+def build_message_frame(content_json, seq, session_duration, token_count, message_count):
+    """拼接下发给客户端的消息，消息内容直接使用队列中预先编码好的JSON字符串"""
+    return (
+        f'{{"type":"message","content":{content_json},"seq":{seq},"session_duration":{round(session_duration, 2)},'
+        f'"token_count":{token_count},"message_count":{message_count}}}'
+    )
+
+def build_batch_frame(content_jsons, seq, session_duration, token_count, message_count):
+    """拼接批量模式下的一帧，多条消息共用一份统计信息，seq为帧内最后一条消息的序号"""
+    return (
+        f'{{"type":"messages","contents":[{",".join(content_jsons)}],"seq":{seq},"session_duration":{round(session_duration, 2)},'
+        f'"token_count":{token_count},"message_count":{message_count}}}'
+    )
+
+class StreamSession:
+    """单个会话的分发状态，连接断开后在宽限期内保留，供客户端重连时恢复"""
+
+    def __init__(self, emotion_type, min_length, max_length, batch, replay_size):
+        self.emotion_type = emotion_type
+        self.min_length = min_length  # 当前的字数范围，分发时按此过滤
+        self.max_length = max_length
+        self.batch = batch
+        self.start_time = time.time()
+        self.seq = 0  # 最近一条已下发消息的序号，同时也是已下发的消息数
+        self.token_count = 0
+        self.replay = deque(maxlen=replay_size)  # 最近已下发的 (序号, 消息JSON)，重连时补发
+        self.detached_at = None  # 连接断开的时间，连接中为None
+        self.expiry = None  # 宽限期结束时关闭会话的定时器
+        self.outbox = deque()  # 已编号、等待发送任务写入连接的 (序号, 消息JSON)
+        self.control = deque()  # 等待发送任务写入连接的控制消息（ping、pong等），先于发件箱发送
+        self.outbox_ready = asyncio.Event()  # 发件箱有新消息
+        self.outbox_drained = asyncio.Event()  # 发件箱中积压的消息已全部发出
+        self.lagging = False  # 发件箱达到过上限，且发送任务尚未把积压消息发完
+        self.last_seen = time.monotonic()  # 最近一次收到客户端消息（包括pong）的时间
 
 class WebSocketManager:
     """WebSocket连接管理器，负责处理WebSocket连接和消息分发"""
@@ -16,6 +56,24 @@ class WebSocketManager:
         """初始化连接管理器"""
         self.active_connections: Dict[str, WebSocket] = {}
         self.tasks: Dict[str, asyncio.Task] = {}
+        self.sessions: Dict[str, StreamSession] = {}  # 分发状态，包括宽限期内等待重连的会话
+        self.resume_grace = max(0, settings.WS_RESUME_GRACE_SECONDS)  # 断开后保留会话的时间（秒）
+        self.replay_size = max(0, settings.WS_REPLAY_BUFFER_SIZE)
+        self.batch_window = max(1, settings.WS_BATCH_WINDOW_MS) / 1000  # 批量模式的下发间隔（秒）
+        self.batch_max_size = max(1, settings.WS_BATCH_MAX_SIZE)  # 批量模式每帧最多的消息条数
+        self.outbox_size = max(1, settings.WS_OUTBOX_SIZE)  # 每个连接待发送消息的上限
+        self.send_timeout = max(0.1, settings.WS_SEND_TIMEOUT)  # 单帧发送的最长等待时间（秒）
+        self.slow_client_policy = settings.WS_SLOW_CLIENT_POLICY
+        if self.slow_client_policy not in ("drop_oldest", "coalesce", "disconnect"):
+            print(f"未知的慢客户端处理策略 {self.slow_client_policy}，使用coalesce")
+            self.slow_client_policy = "coalesce"
+        self.stats = {
+            "lag_events": 0,
+            "dropped_messages": 0,
+            "coalesced_frames": 0,
+            "send_timeouts": 0,
+            "slow_disconnects": 0,
+        }
     
     async def connect(self, websocket: WebSocket, session_id: str):
         """处理新的WebSocket连接
@@ -27,24 +85,83 @@ class WebSocketManager:
         await websocket.accept()
         self.active_connections[session_id] = websocket
     
-    def disconnect(self, session_id: str):
+    def disconnect(self, session_id: str, websocket: Optional[WebSocket] = None):
         """处理WebSocket断开连接
         
+        宽限期内只暂停分发，生成器和会话队列继续保留，客户端可以带session_id和last_seq重连恢复
+        
         Args:
             session_id: 会话ID
+            websocket: 断开的连接；会话已因接收过慢被断开或已由新连接恢复时忽略
         """
+        if websocket is not None and self.active_connections.get(session_id) is not websocket:
+            return
         if session_id in self.active_connections:
             del self.active_connections[session_id]
         
-        # 取消相关任务
-        if session_id in self.tasks and not self.tasks[session_id].done():
-            self.tasks[session_id].cancel()
-            del self.tasks[session_id]
+        # 取消分发任务，任务结束时自行从self.tasks中移除
+        task = self.tasks.get(session_id)
+        if task is not None and not task.done() and task is not asyncio.current_task():
+            task.cancel()
+        
+        session = self.sessions.get(session_id)
+        if session is not None and self.resume_grace > 0:
+            if session.expiry is not None:
+                session.expiry.cancel()
+            session.detached_at = time.time()
+            session.expiry = asyncio.get_running_loop().call_later(self.resume_grace, self.close_session, session_id)
+            return
+        self.close_session(session_id)
+    
+    def close_session(self, session_id: str):
+        """结束会话：停止生成器并释放会话队列
+        
+        Args:
+            session_id: 会话ID
+        """
+        session = self.sessions.pop(session_id, None)
+        if session is not None and session.expiry is not None:
+            session.expiry.cancel()
+            print(f"会话重连宽限期已过: {session_id}, 已下发 {session.seq} 条消息")
+        
+        # 分发任务仍在运行时由它结束时释放队列
+        if session_id not in self.tasks:
+            queue_backend.release(session_id)
         
-        # 停止后端消息生成线程
+        # 停止后端消息生成线程，多节点部署时注销会话，其他节点上的生成器随之停止
         deepseek_service.stop_generation(session_id)
+        if session_registry.enabled:
+            session_registry.unregister(session_id)
+        # 归还生成名额，唤醒排队等待的连接
+        admission_controller.release(session_id)
+    
+    def attach(self, session_id: str):
+        """把宽限期内保留的会话交给重连的客户端
+        
+        Args:
+            session_id: 客户端重连时带上的会话ID
+            
+        Returns:
+            会话的分发状态，会话不存在、已过期或仍有连接时返回None
+        """
+        session = self.sessions.get(session_id)
+        if session is None or session.detached_at is None:
+            return None
+        if session.expiry is not None:
+            session.expiry.cancel()
+            session.expiry = None
+        session.detached_at = None
+        session.last_seen = time.monotonic()
+        return session
     
-    async def start_message_stream(self, emotion_type: str, session_id: str, min_length: int = 5, max_length: int = 15):
+    def touch(self, session_id: str):
+        """记录收到客户端消息，心跳检查据此判断连接是否仍然可用"""
+        session = self.sessions.get(session_id)
+        if session is not None:
+            session.last_seen = time.monotonic()
+    
+    async def start_message_stream(self, emotion_type: str, session_id: str, min_length: int = 5, max_length: int = 15,
+                                   batch: bool = False):
         """启动消息流处理
         
         Args:
@@ -52,80 +169,288 @@ class WebSocketManager:
             session_id: 会话ID
             min_length: 最小字数
             max_length: 最大字数
+            batch: 是否按时间窗口把多条消息合并为一帧下发
         """
         # 启动DeepSeek API请求和消息生成
-        await deepseek_service.generate_messages(emotion_type, session_id, min_length, max_length)
+        self.sessions[session_id] = StreamSession(emotion_type, min_length, max_length, batch, self.replay_size)
+        if session_registry.enabled:
+            # 多节点部署：初始化队列后登记会话，生成任务由任意有余量的节点认领
+            await queue_backend.init_session(session_id)
+            await session_registry.register(session_id, emotion_type, min_length, max_length)
+        else:
+            await deepseek_service.generate_messages(emotion_type, session_id, min_length, max_length)
         
         # 创建消息分发任务
         self.tasks[session_id] = asyncio.create_task(
             self._dispatch_messages(session_id)
         )
     
+    async def resume_message_stream(self, session_id: str, last_seq: int):
+        """客户端重连后补发错过的消息，并从会话队列继续分发
+        
+        Args:
+            session_id: 会话ID，须已通过attach取回
+            last_seq: 客户端最后收到的消息序号
+            
+        Returns:
+            (补发的消息数, 已移出补发缓冲区而无法补发的消息数)
+        """
+        session = self.sessions[session_id]
+        entries = [entry for entry in session.replay if entry[0] > last_seq]
+        first_seq = entries[0][0] if entries else session.seq + 1
+        missed = max(0, first_seq - last_seq - 1)
+        
+        # 断开前未发出的消息已在补发缓冲区中，由发送任务按序号补发
+        session.outbox.clear()
+        session.outbox.extend(entries)
+        session.control.clear()
+        session.lagging = False
+        
+        self.tasks[session_id] = asyncio.create_task(
+            self._dispatch_messages(session_id)
+        )
+        return len(entries), missed
+    
+    async def update_params(self, emotion_type: str, session_id: str, min_length: int, max_length: int):
+        """就地更新会话的字数范围
+        
+        生成端在下一轮请求时使用新范围，队列中已有的不符合新范围的消息在分发时丢弃
+        
+        Args:
+            emotion_type: 用户请求的情绪类型
+            session_id: 会话ID
+            min_length: 新的最小字数
+            max_length: 新的最大字数
+        """
+        session = self.sessions.get(session_id)
+        if session is not None:
+            session.min_length, session.max_length = min_length, max_length
+        if session_registry.enabled:
+            await session_registry.update_params(emotion_type, session_id, min_length, max_length)
+        else:
+            deepseek_service.update_params(emotion_type, session_id, min_length, max_length)
+    
+    def send_control(self, session_id: str, payload: dict):
+        """把控制消息交给连接的发送任务写入，保证每个连接只有发送任务一个写入方
+        
+        Args:
+            session_id: 会话ID
+            payload: 控制消息，如ping、pong、params_updated
+            
+        Returns:
+            是否已交给发送任务，会话不存在或没有连接时返回False
+        """
+        session = self.sessions.get(session_id)
+        if session is None or session_id not in self.active_connections:
+            return False
+        session.control.append(json.dumps(payload, ensure_ascii=False, separators=(",", ":")))
+        session.outbox_ready.set()
+        return True
+    
+    def _build_frames(self, session: StreamSession, entries: List[Tuple[int, str]]):
+        """按会话的下发模式把 (序号, 消息JSON) 拼接为要发送的文本帧"""
+        session_duration = time.time() - session.start_time
+        if session.batch:
+            content_jsons = [content_json for _, content_json in entries]
+            return [build_batch_frame(content_jsons, entries[-1][0], session_duration, session.token_count, entries[-1][0])]
+        return [
+            build_message_frame(content_json, seq, session_duration, session.token_count, seq)
+            for seq, content_json in entries
+        ]
+    
+    def _push_outbox(self, session: StreamSession, entries: List[Tuple[int, str]]):
+        """把已编号的消息放入发件箱
+        
+        Returns:
+            发件箱是否已达到上限（客户端接收跟不上分发速度）
+        """
+        session.outbox.extend(entries)
+        session.outbox_ready.set()
+        if len(session.outbox) < self.outbox_size:
+            return False
+        
+        if not session.lagging:
+            session.lagging = True
+            self.stats["lag_events"] += 1
+        if self.slow_client_policy == "drop_oldest":
+            # 丢弃最早的消息，客户端可由序号的跳跃得知
+            while len(session.outbox) > self.outbox_size:
+                session.outbox.popleft()
+                self.stats["dropped_messages"] += 1
+        return True
+    
+    def _take_outbox(self, session: StreamSession):
+        """取出下一帧要发送的消息：批量模式最多WS_BATCH_MAX_SIZE条，普通模式一条
+        
+        积压时发送任务不等待批量时间窗口，连续发送填满的帧
+        """
+        count = min(len(session.outbox), self.batch_max_size if session.batch else 1)
+        entries = [session.outbox.popleft() for _ in range(count)]
+        if not session.outbox:
+            session.outbox_drained.set()
+        return entries
+    
+    async def close_client(self, session_id: str, websocket: WebSocket, code: int, reason: str):
+        """服务端主动断开连接，会话进入重连宽限期
+        
+        Args:
+            session_id: 会话ID
+            websocket: 要断开的连接
+            code: WebSocket关闭码
+            reason: 记录在日志中的原因
+        """
+        print(f"服务端断开连接: {session_id}, {reason}")
+        try:
+            # 对端可能已经失联，关闭握手只等待很短时间
+            await asyncio.wait_for(websocket.close(code=code), 1.0)
+        except Exception:
+            pass
+        self.disconnect(session_id, websocket)
+    
+    async def _close_slow_client(self, session_id: str, websocket: WebSocket, reason: str):
+        """断开接收过慢的客户端，1013表示稍后重试，客户端可以带session_id和last_seq重连"""
+        self.stats["slow_disconnects"] += 1
+        await self.close_client(session_id, websocket, 1013, f"客户端接收过慢，{reason}")
+    
+    async def _send_messages(self, session_id: str, session: StreamSession, websocket: WebSocket):
+        """把控制消息和发件箱中的消息写入WebSocket，单帧发送超时视为连接失效
+        
+        发送在独立任务中进行，客户端网络不佳时不会阻塞从会话队列取消息；
+        连接的所有写入都经过这里，控制消息先于积压的普通消息发送
+        """
+        try:
+            while self.active_connections.get(session_id) is websocket:
+                if session.control:
+                    texts = [session.control.popleft()]
+                elif session.outbox:
+                    entries = self._take_outbox(session)
+                    if session.lagging and len(entries) > 1:
+                        # 积压的消息合并进同一帧发送
+                        self.stats["coalesced_frames"] += 1
+                    texts = self._build_frames(session, entries)
+                else:
+                    # 发件箱已清空，客户端已跟上
+                    session.lagging = False
+                    session.outbox_ready.clear()
+                    await session.outbox_ready.wait()
+                    continue
+                
+                for text in texts:
+                    try:
+                        await asyncio.wait_for(websocket.send_text(text), self.send_timeout)
+                    except asyncio.TimeoutError:
+                        self.stats["send_timeouts"] += 1
+                        await self._close_slow_client(session_id, websocket, f"发送超过{self.send_timeout}秒")
+                        return
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            print(f"发送消息发生异常: {session_id}, {str(e)}")
+    
     async def _dispatch_messages(self, session_id: str):
-        """从Redis队列获取消息并分发到WebSocket
+        """从会话队列获取消息并分发到WebSocket
+        
+        消息编号后放入连接的发件箱，由发送任务写入WebSocket；
+        客户端接收跟不上时按WS_SLOW_CLIENT_POLICY丢弃最早的消息、暂停取消息直到积压发完，或断开连接
         
         Args:
             session_id: 会话ID
         """
-        # 队列名称
-        queue_name = f"messages:{session_id}"
-        token_counter = f"tokens:{session_id}"
+        session = self.sessions[session_id]
+        websocket = self.active_connections[session_id]
+        session.outbox_ready.set()
+        sender = asyncio.create_task(self._send_messages(session_id, session, websocket))
         
-        # 记录开始时间
-        start_time = time.time()
-        message_count = 0
+        # 批量模式每个时间窗口下发一帧，包含这段时间内已就绪的消息；普通模式每条消息一帧
+        max_count = self.batch_max_size if session.batch else 1
+        interval = self.batch_window if session.batch else 1.5 / settings.MESSAGES_PER_SECOND
         
         try:
             while session_id in self.active_connections:
-                # 从Redis队列获取消息（非阻塞）
-                message_json = redis_client.pop_message(queue_name)
+                # 取已就绪的消息，队列为空时由队列后端等待一段时间后返回空列表
+                frames, total_tokens, queue_length = await queue_backend.pop(session_id, max_count)
                 
-                if message_json:
-                    # 解析消息
-                    message_data = json.loads(message_json)
-                    content = message_data["content"]
-                    tokens = message_data.get("tokens", 0)
+                if frames:
+                    entries = []
+                    for frame in frames:
+                        # 只解析帧头，消息内容保持编码好的JSON字符串
+                        try:
+                            content_json, tokens, length = decode_message(frame)
+                        except ValueError as e:
+                            print(f"丢弃无法解析的消息: {session_id}, {str(e)}")
+                            continue
+                        
+                        # 参数更新前入队的消息可能不符合新的字数范围，直接丢弃
+                        if session.min_length <= length <= session.max_length:
+                            # 按下发顺序编号，并保留在补发缓冲区中供重连时补发
+                            session.seq += 1
+                            entries.append((session.seq, content_json))
+                            session.replay.append((session.seq, content_json))
                     
-                    # 更新计数
-                    message_count += 1
+                    # 全部被丢弃时立即取下一批
+                    if not entries:
+                        continue
                     
-                    # 计算会话时长
-                    session_duration = time.time() - start_time
+                    # 放入发件箱，由发送任务写入WebSocket
+                    session.token_count = total_tokens
+                    if self._push_outbox(session, entries):
+                        if self.slow_client_policy == "disconnect":
+                            await self._close_slow_client(session_id, websocket, f"积压超过{self.outbox_size}条消息")
+                            break
+                        if self.slow_client_policy == "coalesce":
+                            # 暂停取消息直到积压的消息全部发出，队列积压后由背压暂停生成端，不浪费token
+                            session.outbox_drained.clear()
+                            await session.outbox_drained.wait()
                     
-                    # 获取总token数
-                    total_tokens = redis_client.get_counter(token_counter)
-                    
-                    # 发送消息到WebSocket
-                    await self.active_connections[session_id].send_json({
-                        "type": "message",
-                        "content": content,
-                        "session_duration": round(session_duration, 2),
-                        "token_count": total_tokens,
-                        "message_count": message_count
-                    })
+                    # 生成端因高水位暂停时，消费到低水位以下后唤醒生成端
+                    if queue_backpressure.is_paused(session_id):
+                        queue_backpressure.on_dequeued(session_id, queue_length)
                     
                     # 控制发送速率，降低密度
-                    await asyncio.sleep(1.5 / settings.MESSAGES_PER_SECOND)
+                    await asyncio.sleep(interval)
                 else:
-                    # 队列为空，等待一小段时间
-                    await asyncio.sleep(0.1)
+                    # 队列已空，生成端仍处于暂停状态时立即恢复
+                    queue_backpressure.on_dequeued(session_id, 0)
         
         except asyncio.CancelledError:
             print(f"消息分发任务已取消: {session_id}")
-            # 确保停止后端消息生成
-            deepseek_service.stop_generation(session_id)
         except Exception as e:
             print(f"消息分发发生异常: {session_id}, {str(e)}")
-            # 确保停止后端消息生成
-            deepseek_service.stop_generation(session_id)
+            # 与宽限期结束时相同地结束会话：停止生成器、注销会话并归还名额，再关闭连接（1011: 服务端内部错误）
+            self.close_session(session_id)
+            sender.cancel()
+            if self.active_connections.get(session_id) is websocket:
+                del self.active_connections[session_id]
+                try:
+                    await asyncio.wait_for(websocket.close(code=1011), 1.0)
+                except Exception:
+                    pass
         finally:
-            # 记录会话结束
-            end_time = time.time()
-            session_duration = end_time - start_time
-            total_tokens = redis_client.get_counter(token_counter)
-            print(f"消息分发结束: {session_id}, 持续时间: {session_duration:.2f}秒, 消息数: {message_count}, Token数: {total_tokens}")
-            # 确保停止后端消息生成
-            deepseek_service.stop_generation(session_id)
+            sender.cancel()
+            if self.tasks.get(session_id) is asyncio.current_task():
+                del self.tasks[session_id]
+            if self.sessions.get(session_id) is not session:
+                # 会话已结束，记录会话结束并释放队列
+                session_duration = time.time() - session.start_time
+                total_tokens = await queue_backend.get_counter(session_id)
+                queue_backend.release(session_id)
+                print(f"消息分发结束: {session_id}, 持续时间: {session_duration:.2f}秒, 消息数: {session.seq}, Token数: {total_tokens}")
+                # 确保停止后端消息生成
+                deepseek_service.stop_generation(session_id)
+            elif session.detached_at is not None:
+                print(f"消息分发暂停: {session_id}, 已下发 {session.seq} 条消息，等待客户端重连")
+
+    def snapshot(self):
+        """返回连接和慢客户端状态，用于监控"""
+        sessions = [self.sessions[session_id] for session_id in self.active_connections if session_id in self.sessions]
+        return {
+            "connections": len(self.active_connections),
+            "detached_sessions": len(self.sessions) - len(sessions),
+            "lagging_clients": sum(1 for session in sessions if session.lagging),
+            "outbox_messages": sum(len(session.outbox) for session in sessions),
+            "slow_client_policy": self.slow_client_policy,
+            **self.stats,
+        }
 
 # 创建全局WebSocket管理器实例
 websocket_manager = WebSocketManager()
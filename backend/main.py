@@ -10,6 +10,20 @@ from typing import Optional
 from app.core.config import settings
 from app.core.redis_client import redis_client
 from app.services.websocket_manager import websocket_manager
+from app.services.deepseek_service import deepseek_service
+from app.services.admission import admission_controller
+from app.services.backpressure import queue_backpressure
+from app.services.circuit_breaker import circuit_breaker
+from app.services.coalescer import generation_coalescer
+from app.services.connection_reaper import connection_reaper
+from app.services.fallback_corpus import default_message_ticker
+from app.services.length_tuner import length_tuner
+from app.services.message_cache import message_cache
+from app.services.queue_backend import queue_backend
+from app.services.rate_limiter import deepseek_limiter
+from app.services.session_registry import session_registry
+from app.services.session_sweeper import session_sweeper
+from app.services.stream_reader import stream_reader
 
 # 创建FastAPI应用
 app = FastAPI(
@@ -26,6 +40,22 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# 启动时开始定期回收遗留的会话键和连接心跳，多节点部署时加入会话注册表
+@app.on_event("startup")
+async def startup_event():
+    session_sweeper.start(lambda session_id: session_id in websocket_manager.sessions)
+    connection_reaper.start()
+    session_registry.start()
+
+# 关闭时释放共享资源
+@app.on_event("shutdown")
+async def shutdown_event():
+    await session_sweeper.stop()
+    await connection_reaper.stop()
+    await session_registry.stop()
+    await deepseek_service.close()
+    await redis_client.close_async()
+
 # 根路由
 @app.get("/")
 async def root():
@@ -45,20 +75,74 @@ async def health_check():
         "timestamp": time.time()
     }
 
+# 运行指标
+@app.get("/metrics")
+async def metrics():
+    return {
+        "limiter": deepseek_limiter.snapshot(),
+        "message_cache": message_cache.snapshot(),
+        "backpressure": queue_backpressure.snapshot(),
+        "coalescer": generation_coalescer.snapshot(),
+        "default_ticker": default_message_ticker.snapshot(),
+        "length_tuner": length_tuner.snapshot(),
+        "circuit_breaker": circuit_breaker.snapshot(),
+        "queue_backend": queue_backend.snapshot(),
+        "stream_reader": stream_reader.snapshot(),
+        "session_sweeper": session_sweeper.snapshot(),
+        "session_registry": session_registry.snapshot(),
+        "websocket": websocket_manager.snapshot(),
+        "connection_reaper": connection_reaper.snapshot(),
+        "admission": admission_controller.snapshot(),
+        "timestamp": time.time()
+    }
+
+async def wait_for_admission(websocket: WebSocket, session_id: str):
+    """排队等待准入名额，期间继续读取连接，客户端在排队时断开能立即发现并让出队列位置
+    
+    Returns:
+        是否获得名额
+    
+    Raises:
+        WebSocketDisconnect: 客户端在排队期间断开
+    """
+    waiter = asyncio.create_task(admission_controller.wait(session_id))
+    try:
+        while True:
+            receiver = asyncio.create_task(websocket.receive())
+            await asyncio.wait({waiter, receiver}, return_when=asyncio.FIRST_COMPLETED)
+            if not receiver.done():
+                receiver.cancel()
+                return waiter.result()
+            message = receiver.result()
+            if message["type"] == "websocket.disconnect":
+                raise WebSocketDisconnect(message.get("code", 1000))
+            # 排队期间客户端发来的其他消息（如ping）忽略
+            if waiter.done():
+                return waiter.result()
+    finally:
+        waiter.cancel()
+
 # WebSocket路由，支持自定义字数范围
 @app.websocket("/ws/{emotion_type}")
 async def websocket_endpoint(
     websocket: WebSocket, 
     emotion_type: str,
     min_length: Optional[int] = Query(5),
-    max_length: Optional[int] = Query(15)
+    max_length: Optional[int] = Query(15),
+    batch: bool = Query(False),
+    session_id: Optional[str] = Query(None),
+    last_seq: int = Query(0)
 ):
     # 验证字数范围参数
     min_length = max(1, min(30, min_length))  # 限制在1-30之间
     max_length = max(min_length, min(50, max_length))  # 确保max_length >= min_length且不超过50
     
-    # 生成唯一的会话ID
-    session_id = f"session:{uuid.uuid4()}"
+    # 带session_id重连时恢复宽限期内保留的会话，沿用其参数；否则生成唯一的会话ID
+    session = websocket_manager.attach(session_id) if session_id else None
+    if session is not None:
+        emotion_type, min_length, max_length, batch = session.emotion_type, session.min_length, session.max_length, session.batch
+    else:
+        session_id = f"session:{uuid.uuid4()}"
     
     # 记录会话开始时间
     start_time = time.time()
@@ -67,6 +151,26 @@ async def websocket_endpoint(
         # 建立WebSocket连接
         await websocket_manager.connect(websocket, session_id)
         
+        # 准入控制：重连恢复的会话已占有名额；名额用完时排队等待，队列已满或超时则拒绝并给出重试间隔
+        if session is None and not admission_controller.try_acquire(session_id):
+            if admission_controller.can_wait():
+                await websocket.send_json({
+                    "type": "queued",
+                    "position": len(admission_controller.waiters) + 1,
+                    "timeout": admission_controller.wait_timeout
+                })
+            admitted = await wait_for_admission(websocket, session_id)
+            if not admitted:
+                await websocket.send_json({
+                    "type": "rejected",
+                    "reason": "capacity",
+                    "retry_after": admission_controller.retry_after
+                })
+                # 1013: 稍后重试
+                await websocket.close(code=1013)
+                websocket_manager.disconnect(session_id, websocket)
+                return
+        
         # 发送会话开始消息
         await websocket.send_json({
             "type": "session_start",
@@ -74,22 +178,35 @@ async def websocket_endpoint(
             "emotion_type": emotion_type,
             "min_length": min_length,
             "max_length": max_length,
+            "batch": batch,
+            "batch_window_ms": settings.WS_BATCH_WINDOW_MS if batch else None,
+            "resumed": session is not None,
             "timestamp": start_time
         })
         
-        # 启动消息流，传递字数范围参数
-        await websocket_manager.start_message_stream(emotion_type, session_id, min_length, max_length)
+        if session is not None:
+            # 补发客户端错过的消息，生成器在断开期间一直保留
+            replayed, missed = await websocket_manager.resume_message_stream(session_id, last_seq)
+            print(f"WebSocket重连: {session_id}, 补发 {replayed} 条消息, 无法补发 {missed} 条")
+        else:
+            # 启动消息流，传递字数范围参数和是否批量下发
+            await websocket_manager.start_message_stream(emotion_type, session_id, min_length, max_length, batch)
         
         # 保持连接直到客户端断开
         while True:
             # 接收客户端消息（用于心跳检测或其他控制命令）
             data = await websocket.receive_text()
+            websocket_manager.touch(session_id)
             
             # 处理客户端消息
             try:
                 message = json.loads(data)
+                # 回应经连接的发送任务写入，不与消息分发同时写连接
                 if message.get("type") == "ping":
-                    await websocket.send_json({"type": "pong", "timestamp": time.time()})
+                    websocket_manager.send_control(session_id, {"type": "pong", "timestamp": time.time()})
+                elif message.get("type") == "pong":
+                    # 服务端心跳的回应，收到消息时已记录
+                    pass
                 elif message.get("type") == "update_params":
                     # 处理参数更新请求
                     new_min = message.get("min_length", min_length)
@@ -99,39 +216,13 @@ async def websocket_endpoint(
                     new_min = max(1, min(30, new_min))
                     new_max = max(new_min, min(50, new_max))
                     
-                    # 创建新会话ID，但先不断开旧会话
-                    new_session_id = f"session:{uuid.uuid4()}"
-                    
-                    # 先建立新会话连接
-                    await websocket_manager.connect(websocket, new_session_id)
-                    
-                    # 发送新会话开始消息，通知前端新的session_id
-                    await websocket.send_json({
-                        "type": "session_start",
-                        "session_id": new_session_id,
-                        "emotion_type": emotion_type,
-                        "min_length": new_min,
-                        "max_length": new_max,
-                        "timestamp": time.time(),
-                        "is_update": True  # 标记这是参数更新后的新会话
-                    })
-                    
-                    # 启动新的消息流
-                    await websocket_manager.start_message_stream(emotion_type, new_session_id, new_min, new_max)
-                    
-                    # 确保新会话已经开始生成消息后，再停止旧会话
-                    await asyncio.sleep(1.0)  # 给新会话一点时间启动
-                    
-                    # 现在安全地停止旧会话
-                    websocket_manager.disconnect(session_id)
-                    
-                    # 更新当前会话ID和参数
-                    session_id = new_session_id
+                    # 就地更新正在运行的生成器，不创建新会话
+                    await websocket_manager.update_params(emotion_type, session_id, new_min, new_max)
                     min_length = new_min
                     max_length = new_max
                     
                     # 发送确认消息
-                    await websocket.send_json({
+                    websocket_manager.send_control(session_id, {
                         "type": "params_updated",
                         "min_length": min_length,
                         "max_length": max_length,
@@ -142,15 +233,20 @@ async def websocket_endpoint(
                 pass
             
     except WebSocketDisconnect:
+        # 先读取token计数，断开连接后进程内队列会被释放
+        total_tokens = await queue_backend.get_counter(session_id)
+        
         # 处理WebSocket断开连接
-        websocket_manager.disconnect(session_id)
+        websocket_manager.disconnect(session_id, websocket)
         
         # 记录会话结束
         end_time = time.time()
         session_duration = end_time - start_time
-        token_counter = f"tokens:{session_id}"
-        total_tokens = redis_client.get_counter(token_counter)
         print(f"WebSocket连接断开: {session_id}, 持续时间: {session_duration:.2f}秒, Token数: {total_tokens}")
+    except Exception as e:
+        # 对端已失联时发送会抛出其他异常，同样按断开处理，及时归还准入名额
+        print(f"WebSocket连接异常: {session_id}, {str(e)}")
+        websocket_manager.disconnect(session_id, websocket)
 
 if __name__ == "__main__":
     uvicorn.run("main:app", host="0.0.0.0", port=9096, reload=True)
@@ -1,36 +1,74 @@
 from fastapi import APIRouter, WebSocket, WebSocketDisconnect
 from fastapi.websockets import WebSocketState
-import json
+import os
 import asyncio
 import logging
+from core.message_codec import decode_frame
 from core.redis_manager import get_redis_client
-from typing import List, Dict
+from typing import Dict
 
 logger = logging.getLogger(__name__)
 
 router = APIRouter()
 
-# Store active connections
-active_connections: Dict[str, WebSocket] = {}
+# Fan-out mode: "local" broadcasts queue messages to this process's sockets only,
+# "pubsub" republishes them on a Redis channel so every process broadcasts every message
+FANOUT_MODE = os.getenv("PRAISE_FANOUT", "local")
+BROADCAST_CHANNEL = "praise_broadcast"
+# Per-connection send buffer; a slow socket drops its oldest pending frames instead of stalling others
+OUTBOX_SIZE = int(os.getenv("PRAISE_OUTBOX_SIZE", "100"))
 
 class ConnectionManager:
     def __init__(self):
-        self.active_connections: List[WebSocket] = []
+        # Each connection has its own bounded outbox drained by a dedicated sender task
+        self.active_connections: Dict[WebSocket, asyncio.Queue] = {}
+        self.sender_tasks: Dict[WebSocket, asyncio.Task] = {}
+        self.dropped_frames = 0
 
     async def connect(self, websocket: WebSocket):
         await websocket.accept()
-        self.active_connections.append(websocket)
+        outbox = asyncio.Queue(maxsize=OUTBOX_SIZE)
+        self.active_connections[websocket] = outbox
+        self.sender_tasks[websocket] = asyncio.create_task(self._send_loop(websocket, outbox))
         logger.info(f"WebSocket connected. Total connections: {len(self.active_connections)}")
 
     def disconnect(self, websocket: WebSocket):
-        if websocket in self.active_connections:
-            self.active_connections.remove(websocket)
+        self.active_connections.pop(websocket, None)
+        task = self.sender_tasks.pop(websocket, None)
+        if task is not None:
+            task.cancel()
         logger.info(f"WebSocket disconnected. Total connections: {len(self.active_connections)}")
 
     async def send_personal_message(self, message: str, websocket: WebSocket):
         if websocket.client_state == WebSocketState.CONNECTED:
             await websocket.send_text(message)
 
+    def broadcast(self, message: str):
+        """
+        Queue a text frame for every connection without waiting on any socket
+        """
+        for outbox in list(self.active_connections.values()):
+            if outbox.full():
+                # Slow consumer: discard its oldest pending frame
+                outbox.get_nowait()
+                self.dropped_frames += 1
+            outbox.put_nowait(message)
+
+    async def _send_loop(self, websocket: WebSocket, outbox: asyncio.Queue):
+        """
+        Drain one connection's outbox into its socket
+        """
+        try:
+            while True:
+                message = await outbox.get()
+                if websocket.client_state != WebSocketState.CONNECTED:
+                    break
+                await websocket.send_text(message)
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            logger.error(f"Error sending to WebSocket: {e}")
+
 manager = ConnectionManager()
 
 @router.websocket("/ws/praise")
@@ -38,13 +76,9 @@ async def websocket_endpoint(websocket: WebSocket):
     """
     WebSocket endpoint for real-time praise message streaming
     """
+    # Messages reach this socket through the process-wide broadcaster
     await manager.connect(websocket)
     
-    # Start consuming messages from Redis and sending to this specific WebSocket
-    consume_task = asyncio.create_task(
-        consume_and_send_messages(websocket)
-    )
-    
     try:
         while True:
             # Keep the connection alive and handle any incoming messages
@@ -69,48 +103,83 @@ async def websocket_endpoint(websocket: WebSocket):
     except Exception as e:
         logger.error(f"WebSocket error: {e}")
     finally:
-        # Cancel the consume task
-        consume_task.cancel()
         manager.disconnect(websocket)
 
-async def consume_and_send_messages(websocket: WebSocket):
+def broadcast_frame(frame: bytes):
     """
-    Consume messages from Redis queue and send to WebSocket
+    Fan a queue frame out to all local connections
     """
-    redis_client = await get_redis_client()
-    
     try:
-        while websocket.client_state == WebSocketState.CONNECTED:
-            try:
-                # Block for a short time to get message from Redis queue
-                result = await redis_client.blpop("praise_queue", timeout=1)
-                
-                if result:
-                    # result is a tuple (key, value)
-                    message_str = result[1].decode('utf-8')
-                    
-                    try:
-                        message = json.loads(message_str)
-                        # Send message to WebSocket client
-                        await websocket.send_json([message])
-                        logger.info(f"Sent message to client: {message['text']}")
-                        
-                    except json.JSONDecodeError as e:
-                        logger.error(f"Failed to decode message from Redis: {e}")
-                        continue
-                        
-                else:
-                    # No message available, short delay to prevent busy waiting
-                    await asyncio.sleep(0.1)
-                    
-            except asyncio.CancelledError:
-                logger.info("Message consumption task cancelled")
-                break
-            except Exception as e:
-                logger.error(f"Error consuming messages: {e}")
-                await asyncio.sleep(1)  # Wait before retrying
-                
-    except Exception as e:
-        logger.error(f"Fatal error in message consumption: {e}")
-    finally:
-        logger.info("Message consumption task ended")
+        payload, tokens = decode_frame(frame)
+    except ValueError as e:
+        logger.error(f"Failed to decode message from Redis: {e}")
+        return
+
+    # Build the text frame once and share it across all sockets
+    manager.broadcast("[" + payload.decode("utf-8") + "]")
+    logger.debug(f"Broadcast message ({tokens} tokens) to {len(manager.active_connections)} clients")
+
+async def consume_praise_queue():
+    """
+    Single consumer per process: pop messages from Redis queue and fan them out
+    """
+    redis_client = await get_redis_client()
+
+    while True:
+        try:
+            if FANOUT_MODE != "pubsub" and not manager.active_connections:
+                # No local listeners: leave messages in the queue
+                await asyncio.sleep(0.1)
+                continue
+
+            # Block for a short time to get message from Redis queue
+            result = await redis_client.blpop("praise_queue", timeout=1)
+            if not result:
+                continue
+
+            # result is a tuple (key, value)
+            if FANOUT_MODE == "pubsub":
+                # Every subscribed process, including this one, broadcasts it
+                await redis_client.publish(BROADCAST_CHANNEL, result[1])
+            else:
+                broadcast_frame(result[1])
+
+        except asyncio.CancelledError:
+            logger.info("Message consumption task cancelled")
+            raise
+        except Exception as e:
+            logger.error(f"Error consuming messages: {e}")
+            await asyncio.sleep(1)  # Wait before retrying
+
+async def subscribe_broadcasts():
+    """
+    Receive messages republished by any process and fan them out locally
+    """
+    redis_client = await get_redis_client()
+
+    while True:
+        pubsub = redis_client.pubsub()
+        try:
+            await pubsub.subscribe(BROADCAST_CHANNEL)
+            async for message in pubsub.listen():
+                if message["type"] == "message":
+                    broadcast_frame(message["data"])
+
+        except asyncio.CancelledError:
+            logger.info("Broadcast subscription cancelled")
+            raise
+        except Exception as e:
+            logger.error(f"Error in broadcast subscription: {e}")
+            await asyncio.sleep(1)  # Wait before resubscribing
+        finally:
+            await pubsub.close()
+
+async def start_broadcast_tasks():
+    """
+    Start the queue consumer (and the pub/sub listener in pubsub mode)
+    """
+    tasks = [asyncio.create_task(consume_praise_queue())]
+    if FANOUT_MODE == "pubsub":
+        tasks.append(asyncio.create_task(subscribe_broadcasts()))
+    logger.info(f"Broadcast fan-out started in {FANOUT_MODE} mode")
+    return tasks
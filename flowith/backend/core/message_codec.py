@@ -0,0 +1,40 @@
+import json
+import struct
+from typing import Any, Dict, Tuple
+
+# Wire format version of queued praise frames
+MESSAGE_FORMAT_VERSION = 1
+
+# Frame header: format version, token count (network byte order).
+# The header is followed by the message serialized once as UTF-8 JSON.
+MESSAGE_HEADER = struct.Struct("!BH")
+MAX_TOKENS = 0xFFFF
+
+def encode_message(message: Dict[str, Any]) -> bytes:
+    """
+    Encode a praise message into a queue frame
+
+    The JSON payload is built once by the producer so consumers can forward
+    it to sockets without parsing and re-serializing it.
+    """
+    payload = json.dumps(message, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    tokens = min(max(0, int(message.get("tokens", 0))), MAX_TOKENS)
+    return MESSAGE_HEADER.pack(MESSAGE_FORMAT_VERSION, tokens) + payload
+
+def decode_frame(frame: bytes) -> Tuple[bytes, int]:
+    """
+    Split a queue frame into its pre-encoded JSON payload and token count
+
+    Plain JSON entries pushed before the binary format are still accepted.
+
+    Raises:
+        ValueError: If the frame is truncated or uses an unknown format version
+    """
+    if frame[:1] == b"{":
+        return frame, int(json.loads(frame).get("tokens", 0))
+    if len(frame) < MESSAGE_HEADER.size:
+        raise ValueError("Truncated message frame")
+    version, tokens = MESSAGE_HEADER.unpack_from(frame)
+    if version != MESSAGE_FORMAT_VERSION:
+        raise ValueError(f"Unsupported message format version: {version}")
+    return frame[MESSAGE_HEADER.size:], tokens
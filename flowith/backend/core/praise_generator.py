@@ -1,15 +1,32 @@
 import asyncio
 import concurrent.futures
-import json
+import os
 import uuid
 import time
 import random
 import logging
-from typing import Dict, Any
+from collections import deque
+from typing import Callable, Dict, Any
+from core.message_codec import encode_message
 from core.redis_manager import get_redis_client
 
 logger = logging.getLogger(__name__)
 
+# Production setpoint in messages per second
+TARGET_RATE = float(os.getenv("PRAISE_TARGET_RATE", "10"))
+# Upper bound on concurrent simulated API calls
+MAX_IN_FLIGHT = int(os.getenv("PRAISE_MAX_IN_FLIGHT", "20"))
+# Sliding window (seconds) for the achieved rate, and how often it is logged
+RATE_WINDOW = 10.0
+REPORT_INTERVAL = 10.0
+# praise_queue depth: production slows down above the low mark and stops at the high mark;
+# the list is trimmed to the newest QUEUE_MAX entries on every push
+QUEUE_LOW = int(os.getenv("PRAISE_QUEUE_LOW", "50"))
+QUEUE_HIGH = int(os.getenv("PRAISE_QUEUE_HIGH", "200"))
+QUEUE_MAX = int(os.getenv("PRAISE_QUEUE_MAX", "1000"))
+# How often demand is re-checked while production is idle
+IDLE_POLL_INTERVAL = 0.5
+
 # Predefined praise messages (5-15 characters in Chinese)
 PRAISE_MESSAGES = [
     "你今天真棒！",
@@ -80,78 +97,208 @@ def simulate_deepseek_api(config: Dict[str, Any] = None) -> Dict[str, Any]:
         "tokens": tokens
     }
 
-async def generate_single_praise_task(redis_client, config: Dict[str, Any] = None):
-    """
-    Single praise generation task that calls the simulated API and pushes to Redis
+class PraisePipeline:
     """
-    loop = asyncio.get_event_loop()
-    
-    try:
-        # Run the API simulation in thread pool to avoid blocking
-        with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
-            praise_data = await loop.run_in_executor(
-                executor, 
-                simulate_deepseek_api, 
-                config
-            )
-            
-        if praise_data:
-            # Create message structure
-            message = {
-                "id": str(uuid.uuid4()),
-                "text": praise_data["text"],
-                "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
-                "tokens": praise_data["tokens"]
-            }
-            
-            # Push to Redis queue
-            await redis_client.rpush("praise_queue", json.dumps(message))
-            logger.debug(f"Pushed message to Redis: {message['text']}")
-            
-            return message
-            
-    except Exception as e:
-        logger.error(f"Error in praise generation task: {e}")
-        return None
-
-async def run_praise_generators(num_generators: int = 10):
-    """
-    Run multiple praise generation tasks concurrently
+    Continuous praise producer paced to a messages-per-second setpoint
+
+    A new generation is started every 1/target_rate seconds, bounded by a cap on
+    in-flight calls, so a slow call delays only itself rather than a whole batch.
+    Simulated API calls run on one long-lived shared thread pool.
+
+    Production follows demand: it idles while no client is connected and is
+    throttled by the depth of praise_queue, which is also hard-capped.
     """
-    redis_client = await get_redis_client()
-    config = {
-        "base_url": "https://api.deepseek.com",  # Placeholder
-        "api_key": "Placeholder"  # Placeholder
-    }
-    
-    while True:
+
+    def __init__(self, target_rate: float = TARGET_RATE, max_in_flight: int = MAX_IN_FLIGHT):
+        self.target_rate = target_rate
+        self.max_in_flight = max(1, max_in_flight)
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=self.max_in_flight,
+            thread_name_prefix="praise-api"
+        )
+        self.queue_low = max(0, QUEUE_LOW)
+        self.queue_high = max(self.queue_low + 1, QUEUE_HIGH)
+        self.queue_max = max(self.queue_high, QUEUE_MAX)
+        self.demand = lambda: 0  # number of connected clients, set by the app at startup
+        self.queue_depth = 0  # praise_queue length seen at the last push or poll
+        self.in_flight = 0
+        self.started_at = None
+        self.completions = deque()  # monotonic timestamps of recent successful pushes
+        self.stats = {
+            "started": 0,
+            "succeeded": 0,
+            "failed": 0,
+            "saturated": 0,  # ticks that had to wait for an in-flight slot
+            "trimmed": 0,  # oldest queue entries dropped by the hard cap
+        }
+
+    def set_demand_source(self, demand: Callable[[], int]):
+        """
+        Register a callable returning the number of connected clients
+        """
+        self.demand = demand
+
+    def effective_rate(self) -> float:
+        """
+        Target rate adjusted for current demand and queue depth
+        """
+        if self.target_rate <= 0 or self.demand() <= 0:
+            return 0.0
+        # Calls still in flight will land in the queue too
+        depth = self.queue_depth + self.in_flight
+        if depth >= self.queue_high:
+            return 0.0
+        if depth > self.queue_low:
+            # Scale down linearly between the low and high marks
+            return self.target_rate * (self.queue_high - depth) / (self.queue_high - self.queue_low)
+        return self.target_rate
+
+    def achieved_rate(self) -> float:
+        """
+        Successful messages per second over the last RATE_WINDOW seconds
+        """
+        now = time.monotonic()
+        while self.completions and self.completions[0] < now - RATE_WINDOW:
+            self.completions.popleft()
+        if self.started_at is None:
+            return 0.0
+        # Shorter window right after startup so the rate is not under-reported
+        window = min(RATE_WINDOW, now - self.started_at)
+        return len(self.completions) / window if window > 0 else 0.0
+
+    def snapshot(self) -> Dict[str, Any]:
+        """
+        Current setpoint, achieved rate and counters
+        """
+        achieved = self.achieved_rate()
+        effective = self.effective_rate()
+        return {
+            "target_rate": self.target_rate,
+            "effective_rate": round(effective, 2),
+            "achieved_rate": round(achieved, 2),
+            "rate_error": round(achieved - effective, 2),
+            "clients": self.demand(),
+            "queue_depth": self.queue_depth,
+            "queue_max": self.queue_max,
+            "in_flight": self.in_flight,
+            "max_in_flight": self.max_in_flight,
+            **self.stats,
+        }
+
+    async def generate_one(self, redis_client, config: Dict[str, Any] = None):
+        """
+        Single praise generation that calls the simulated API and pushes to Redis
+        """
+        loop = asyncio.get_running_loop()
+        self.in_flight += 1
+        self.stats["started"] += 1
+
         try:
-            # Create tasks for concurrent generation
-            tasks = [
-                generate_single_praise_task(redis_client, config)
-                for _ in range(num_generators)
-            ]
-            
-            # Wait for all tasks to complete
-            results = await asyncio.gather(*tasks, return_exceptions=True)
-            
-            # Count successful generations
-            successful = sum(1 for result in results if result and not isinstance(result, Exception))
-            logger.info(f"Generated {successful}/{num_generators} praise messages")
-            
-            # Wait before next generation cycle (target: ~10 messages per second)
-            # With 10 generators, wait 1 second between cycles
-            await asyncio.sleep(1.0)
-            
+            # Run the API simulation in the shared thread pool to avoid blocking
+            praise_data = await loop.run_in_executor(self.executor, simulate_deepseek_api, config)
+
+            if praise_data:
+                # Create message structure
+                message = {
+                    "id": str(uuid.uuid4()),
+                    "text": praise_data["text"],
+                    "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+                    "tokens": praise_data["tokens"]
+                }
+
+                # Push the encoded frame and trim the queue to its newest entries in one transaction
+                pipe = redis_client.pipeline(transaction=True)
+                pipe.rpush("praise_queue", encode_message(message))
+                pipe.ltrim("praise_queue", -self.queue_max, -1)
+                length, _ = await pipe.execute()
+                self.queue_depth = min(length, self.queue_max)
+                self.stats["trimmed"] += max(0, length - self.queue_max)
+                logger.debug(f"Pushed message to Redis: {message['text']}")
+
+                self.stats["succeeded"] += 1
+                self.completions.append(time.monotonic())
+                return message
+
         except Exception as e:
-            logger.error(f"Error in praise generation cycle: {e}")
-            await asyncio.sleep(5.0)  # Wait longer on error
+            self.stats["failed"] += 1
+            logger.error(f"Error in praise generation task: {e}")
+            return None
+        finally:
+            self.in_flight -= 1
+
+    async def run(self, config: Dict[str, Any] = None):
+        """
+        Start generations at the target rate until cancelled
+        """
+        redis_client = await get_redis_client()
+        loop = asyncio.get_running_loop()
+        slots = asyncio.Semaphore(self.max_in_flight)
+        tasks = set()
+        next_start = loop.time()
+        last_report = loop.time()
+        self.started_at = time.monotonic()
+        idle = False
+
+        while True:
+            try:
+                rate = self.effective_rate()
+                if rate <= 0:
+                    if not idle:
+                        idle = True
+                        logger.info(f"Praise generation idle (clients: {self.demand()}, queue depth: {self.queue_depth})")
+                    await asyncio.sleep(IDLE_POLL_INTERVAL)
+                    if self.demand() > 0:
+                        # Stopped by queue depth: watch the consumers drain it
+                        self.queue_depth = await redis_client.llen("praise_queue")
+                    next_start = loop.time()
+                    continue
+                if idle:
+                    idle = False
+                    logger.info(f"Praise generation resumed at {rate:.2f}/s (clients: {self.demand()})")
+
+                if slots.locked():
+                    self.stats["saturated"] += 1
+                await slots.acquire()
+
+                # Pace starts on a fixed schedule; after a stall, resume instead of bursting to catch up
+                now = loop.time()
+                if next_start > now:
+                    await asyncio.sleep(next_start - now)
+                    now = next_start
+                next_start = max(next_start, now - 1.0) + 1.0 / rate
+
+                task = asyncio.create_task(self.generate_one(redis_client, config))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+                task.add_done_callback(lambda _: slots.release())
+
+                if now - last_report >= REPORT_INTERVAL:
+                    last_report = now
+                    stats = self.snapshot()
+                    logger.info(
+                        f"Praise generation: {stats['achieved_rate']}/s achieved vs {stats['effective_rate']}/s target "
+                        f"(error {stats['rate_error']:+}/s, in flight {self.in_flight}/{self.max_in_flight})"
+                    )
+
+            except asyncio.CancelledError:
+                for task in tasks:
+                    task.cancel()
+                raise
+            except Exception as e:
+                logger.error(f"Error in praise generation pipeline: {e}")
+                await asyncio.sleep(5.0)  # Wait longer on error
+
+praise_pipeline = PraisePipeline()
 
 async def start_praise_generation_task():
     """
     Start the background praise generation task
     """
     logger.info("Starting background praise generation...")
-    
-    # Start the praise generation loop
-    await run_praise_generators(num_generators=10)
+    config = {
+        "base_url": "https://api.deepseek.com",  # Placeholder
+        "api_key": "Placeholder"  # Placeholder
+    }
+
+    # Run the continuous generation pipeline
+    await praise_pipeline.run(config)
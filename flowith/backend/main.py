@@ -1,8 +1,8 @@
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 import asyncio
-from api.websocket import router as websocket_router
-from core.praise_generator import start_praise_generation_task
+from api.websocket import router as websocket_router, manager, start_broadcast_tasks
+from core.praise_generator import praise_pipeline, start_praise_generation_task
 from core.redis_manager import get_redis_client
 import logging
 
@@ -42,14 +42,20 @@ async def startup_event():
         logger.error(f"Failed to connect to Redis: {e}")
         raise e
     
-    # Start praise generation background task
+    # Start praise generation background task, paced by the number of connected clients
+    praise_pipeline.set_demand_source(lambda: len(manager.active_connections))
     asyncio.create_task(start_praise_generation_task())
     logger.info("Background praise generation task started")
+    
+    # Start the single queue consumer that fans messages out to all sockets
+    app.state.broadcast_tasks = await start_broadcast_tasks()
 
 @app.on_event("shutdown")
 async def shutdown_event():
     """Cleanup on shutdown"""
     logger.info("Shutting down Praise Website Backend...")
+    for task in getattr(app.state, "broadcast_tasks", []):
+        task.cancel()
     # Close Redis connections if needed
     redis_client = await get_redis_client()
     await redis_client.close()
@@ -64,6 +70,11 @@ async def health_check():
     except Exception as e:
         return {"status": "error", "redis": "disconnected", "error": str(e)}
 
+@app.get("/stats")
+async def generation_stats():
+    """Praise generation rate against its target"""
+    return praise_pipeline.snapshot()
+
 @app.get("/")
 async def root():
     """Root endpoint"""